@@ -7,8 +7,17 @@
 #
 
 STATUS_FILE="/var/cache/kano-init/status.json"
+STAGE_FILE="/var/cache/kano-init/stage"
 
-if [ `id -u` -eq 0 -a "`json-get $STATUS_FILE stage`" != "disabled" ]; then
+# kano-init keeps a plain text copy of the stage which the shell can read
+# without starting any process, json-get is only needed before it exists
+if [ -r "$STAGE_FILE" ]; then
+    read stage < "$STAGE_FILE"
+else
+    stage="`json-get $STATUS_FILE stage`"
+fi
+
+if [ "$stage" != "disabled" ] && [ `id -u` -eq 0 ]; then
     kano-init boot
     kill -HUP $PPID
 fi
@@ -0,0 +1,684 @@
+#
+# account_db.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# An in-process, transactional editor for the local account databases.
+#
+
+"""
+    Edits /etc/passwd, /etc/shadow, /etc/group and /etc/gshadow without
+    forking the shadow-utils tools.
+
+    The same locks as shadow-utils are taken, so useradd, usermod, passwd
+    and friends wait for us and vice versa. All changes are made in memory
+    and every modified file is written exactly once on commit, through a
+    temporary file that is renamed over the original.
+
+    Usage:
+
+        with AccountDB() as db:
+            db.add_group('kanousers')
+            db.add_user('kano', uid, '/home/kano', password_hash=...)
+"""
+
+import os
+import time
+import errno
+import fcntl
+
+from kano.logging import logger
+
+from kano_init.paths import PASSWD_FILE_PATH, SHADOW_FILE_PATH, \
+    GROUP_FILE_PATH, GSHADOW_FILE_PATH, PWD_LOCK_FILE_PATH, get_root_path
+
+
+# The same defaults as in /etc/login.defs
+GID_MIN = 1000
+GID_MAX = 60000
+
+LOCK_TIMEOUT = 15
+LOCK_RETRY_INTERVAL = 0.1
+
+
+class AccountDBError(Exception):
+    pass
+
+
+class _DBFile(object):
+    """
+        A passwd-style database file. Lines that can't be parsed are kept
+        verbatim so they are written back untouched.
+    """
+
+    def __init__(self, path, n_fields, optional=False):
+        self.path = path
+        self.n_fields = n_fields
+        self.optional = optional
+        self.exists = False
+        self.dirty = False
+        self._lines = []
+        self._by_name = {}
+        self._lock_file = None
+
+    def _tmp_path(self, suffix):
+        return '{}{}'.format(self.path, suffix)
+
+    def lock(self, timeout):
+        """
+            Takes the shadow-utils lock of the file, i.e. hard-links a file
+            holding our pid to `<path>.lock`. Stale locks from dead
+            processes are removed.
+        """
+
+        if not os.path.exists(self.path):
+            if self.optional:
+                return
+            raise AccountDBError("{} doesn't exist".format(self.path))
+
+        pid = os.getpid()
+        pid_file = self._tmp_path('.{}'.format(pid))
+        lock_file = self._tmp_path('.lock')
+
+        with open(pid_file, 'w') as pid_f:
+            pid_f.write('{}\0'.format(pid))
+
+        deadline = time.time() + timeout
+        try:
+            while True:
+                try:
+                    os.link(pid_file, lock_file)
+                    self._lock_file = lock_file
+                    return
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise AccountDBError(
+                            "Unable to lock {}: {}".format(self.path, exc))
+
+                if _is_stale_lock(lock_file):
+                    logger.warn("Removing stale lock {}".format(lock_file))
+                    _unlink(lock_file)
+                    continue
+
+                if time.time() > deadline:
+                    raise AccountDBError(
+                        "Timed out waiting for {}".format(lock_file))
+
+                time.sleep(LOCK_RETRY_INTERVAL)
+        finally:
+            _unlink(pid_file)
+
+    def unlock(self):
+        if self._lock_file:
+            _unlink(self._lock_file)
+            self._lock_file = None
+
+    def load(self):
+        self._lines = []
+        self._by_name = {}
+        self.dirty = False
+
+        try:
+            with open(self.path, 'r') as db_file:
+                lines = db_file.read().splitlines()
+        except IOError as exc:
+            if exc.errno == errno.ENOENT and self.optional:
+                self.exists = False
+                return
+            raise AccountDBError("Unable to read {}: {}".format(self.path,
+                                                                exc))
+
+        self.exists = True
+        for line in lines:
+            fields = line.split(':')
+            if len(fields) == self.n_fields and fields[0] and \
+                    fields[0] not in self._by_name and \
+                    not line.startswith(('#', '+', '-')):
+                self._by_name[fields[0]] = fields
+                self._lines.append(fields)
+            else:
+                self._lines.append(line)
+
+    def names(self):
+        return self._by_name.keys()
+
+    def entries(self):
+        return self._by_name.itervalues()
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def add(self, fields):
+        if not self.exists:
+            return
+
+        if len(fields) != self.n_fields:
+            raise AccountDBError("Malformed entry for {}: {}".format(
+                self.path, fields))
+
+        if fields[0] in self._by_name:
+            raise AccountDBError("'{}' already exists in {}".format(
+                fields[0], self.path))
+
+        fields = list(fields)
+        self._by_name[fields[0]] = fields
+        self._lines.append(fields)
+        self.dirty = True
+
+    def remove(self, name):
+        fields = self._by_name.pop(name, None)
+        if fields is None:
+            return
+
+        self._lines = [line for line in self._lines if line is not fields]
+        self.dirty = True
+
+    def rename(self, name, new_name):
+        if new_name in self._by_name:
+            raise AccountDBError("'{}' already exists in {}".format(
+                new_name, self.path))
+
+        fields = self._by_name.pop(name, None)
+        if fields is None:
+            return
+
+        # The same list is referenced from self._lines, so the entry keeps
+        # its position in the file
+        fields[0] = new_name
+        self._by_name[new_name] = fields
+        self.dirty = True
+
+    def touch(self):
+        self.dirty = True
+
+    def prepare(self):
+        """
+            Writes the new version next to the file as `<path>+`, keeping
+            its owner and mode, and hard-links the current version as the
+            `<path>-` backup like shadow-utils does. Nothing is replaced
+            until install() is called.
+
+            :return: Whether there is a new version to install.
+            :rtype: bool
+        """
+
+        if not self.dirty or not self.exists:
+            return False
+
+        info = os.stat(self.path)
+        tmp_path = self._tmp_path('+')
+        backup_path = self._tmp_path('-')
+
+        contents = '\n'.join(
+            ':'.join(line) if isinstance(line, list) else line
+            for line in self._lines
+        )
+        if contents:
+            contents += '\n'
+
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     info.st_mode & 0o7777)
+        try:
+            os.fchown(fd, info.st_uid, info.st_gid)
+            os.fchmod(fd, info.st_mode & 0o7777)
+            while contents:
+                contents = contents[os.write(fd, contents):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        # The backup is a hard link to the old inode, no data is copied. It
+        # is needed to undo a commit which fails halfway.
+        _unlink(backup_path)
+        os.link(self.path, backup_path)
+
+        return True
+
+    def install(self):
+        """
+            Replaces the file atomically with the version from prepare().
+        """
+
+        os.rename(self._tmp_path('+'), self.path)
+
+    def discard(self):
+        """
+            Drops the version from prepare() if it wasn't installed.
+        """
+
+        _unlink(self._tmp_path('+'))
+
+    def restore(self):
+        """
+            Puts the backup from prepare() back in place, keeping the backup.
+        """
+
+        tmp_path = self._tmp_path('+')
+        _unlink(tmp_path)
+        os.link(self._tmp_path('-'), tmp_path)
+        os.rename(tmp_path, self.path)
+
+
+def _is_stale_lock(lock_file):
+    try:
+        with open(lock_file, 'r') as lock_f:
+            pid = int(lock_f.read().strip('\0\n '))
+    except (IOError, ValueError):
+        # Either it is gone already or it is being written right now
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.ESRCH
+
+    return False
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _days_since_epoch():
+    return str(int(time.time() // (24 * 60 * 60)))
+
+
+class AccountDB(object):
+    """
+        A transaction over the local account databases under `root`.
+
+        Opening it takes the locks and loads the files, leaving the `with`
+        block without an exception commits the changes and releasing it
+        always drops the locks. Nothing is written if the block raises.
+    """
+
+    def __init__(self, root='/', lock_timeout=LOCK_TIMEOUT):
+        self.root = root
+        self.lock_timeout = lock_timeout
+        self._pwd_lock_fd = None
+        self._is_open = False
+
+        self.passwd = _DBFile(get_root_path(root, PASSWD_FILE_PATH), 7)
+        self.shadow = _DBFile(get_root_path(root, SHADOW_FILE_PATH), 9,
+                              optional=True)
+        self.group = _DBFile(get_root_path(root, GROUP_FILE_PATH), 4)
+        self.gshadow = _DBFile(get_root_path(root, GSHADOW_FILE_PATH), 4,
+                               optional=True)
+        self._pwd_lock_path = get_root_path(root, PWD_LOCK_FILE_PATH)
+
+        # The order in which the files are written on commit, passwd goes
+        # last so a new account only appears once it is complete.
+        self._files = [self.group, self.gshadow, self.shadow, self.passwd]
+
+    def open(self):
+        """
+            Takes the locks and loads the databases.
+
+            :rtype: AccountDB
+        """
+
+        if self._is_open:
+            return self
+
+        try:
+            self._lock_pwdf()
+            for db_file in self._files:
+                db_file.lock(self.lock_timeout)
+            for db_file in self._files:
+                db_file.load()
+        except Exception:
+            self.close()
+            raise
+
+        self._is_open = True
+        return self
+
+    def close(self):
+        """
+            Releases the locks, any uncommitted changes are lost.
+        """
+
+        for db_file in reversed(self._files):
+            db_file.unlock()
+
+        if self._pwd_lock_fd is not None:
+            os.close(self._pwd_lock_fd)
+            self._pwd_lock_fd = None
+
+        self._is_open = False
+
+    def commit(self):
+        """
+            Writes every modified database once. All the new versions are
+            written first and then renamed into place, and if one of them
+            can't be, the files already replaced are restored from their
+            backups, so the databases never disagree with each other.
+        """
+
+        prepared = []
+        try:
+            for db_file in self._files:
+                if db_file.prepare():
+                    prepared.append(db_file)
+        except (IOError, OSError) as exc:
+            for prepared_file in prepared + [db_file]:
+                prepared_file.discard()
+            raise AccountDBError("Unable to write {}: {}".format(
+                db_file.path, exc))
+
+        installed = []
+        try:
+            for db_file in prepared:
+                db_file.install()
+                installed.append(db_file)
+        except OSError as exc:
+            for prepared_file in prepared:
+                prepared_file.discard()
+            for installed_file in reversed(installed):
+                try:
+                    installed_file.restore()
+                except OSError as restore_exc:
+                    logger.error("Unable to restore {}: {}".format(
+                        installed_file.path, restore_exc))
+            raise AccountDBError("Unable to replace {}: {}".format(
+                db_file.path, exc))
+
+        for db_file in prepared:
+            db_file.dirty = False
+
+        if prepared:
+            _fsync_dir(os.path.dirname(self.passwd.path))
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+
+    def _lock_pwdf(self):
+        """
+            The equivalent of lckpwdf(3), an exclusive lock on /etc/.pwd.lock
+        """
+
+        try:
+            fd = os.open(self._pwd_lock_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        except OSError as exc:
+            raise AccountDBError("Unable to open {}: {}".format(
+                self._pwd_lock_path, exc))
+
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._pwd_lock_fd = fd
+                return
+            except IOError as exc:
+                if exc.errno not in (errno.EACCES, errno.EAGAIN):
+                    os.close(fd)
+                    raise AccountDBError("Unable to lock {}: {}".format(
+                        self._pwd_lock_path, exc))
+
+            if time.time() > deadline:
+                os.close(fd)
+                raise AccountDBError("Timed out waiting for {}".format(
+                    self._pwd_lock_path))
+
+            time.sleep(LOCK_RETRY_INTERVAL)
+
+    # -- queries
+    def user_exists(self, name):
+        return self.passwd.get(name) is not None
+
+    def group_exists(self, name):
+        return self.group.get(name) is not None
+
+    def get_uid(self, name):
+        return int(self.passwd.get(name)[2])
+
+    def get_gid(self, name):
+        return int(self.group.get(name)[2])
+
+    def get_home(self, name):
+        return self.passwd.get(name)[5]
+
+    def used_uids(self):
+        return set(int(entry[2]) for entry in self.passwd.entries()
+                   if entry[2].isdigit())
+
+    def used_gids(self):
+        return set(int(entry[2]) for entry in self.group.entries()
+                   if entry[2].isdigit())
+
+    def get_user_groups(self, name):
+        return [entry[0] for entry in self.group.entries()
+                if name in entry[3].split(',')]
+
+    def _next_gid(self, preferred=None):
+        used = self.used_gids()
+        if preferred is not None and preferred not in used:
+            return preferred
+
+        gid = GID_MIN
+        while gid in used:
+            gid += 1
+
+        if gid > GID_MAX:
+            raise AccountDBError("No free gids left")
+
+        return gid
+
+    # -- groups
+    def add_group(self, name, gid=None):
+        """
+            Creates a group, like `groupadd -f`: nothing happens if it
+            exists already.
+
+            :return: The gid of the group.
+            :rtype: int
+        """
+
+        if self.group_exists(name):
+            return self.get_gid(name)
+
+        gid = self._next_gid(gid)
+        self.group.add([name, 'x', str(gid), ''])
+        self.gshadow.add([name, '!', '', ''])
+
+        return gid
+
+    def add_group_member(self, group, user):
+        for db_file in (self.group, self.gshadow):
+            entry = db_file.get(group)
+            if entry is None:
+                continue
+
+            members = [m for m in entry[3].split(',') if m]
+            if user not in members:
+                members.append(user)
+                entry[3] = ','.join(members)
+                db_file.touch()
+
+    def remove_group_member(self, group, user):
+        for db_file in (self.group, self.gshadow):
+            entry = db_file.get(group)
+            if entry is None:
+                continue
+
+            members = [m for m in entry[3].split(',') if m]
+            if user in members:
+                members.remove(user)
+                entry[3] = ','.join(members)
+                db_file.touch()
+
+    def set_user_groups(self, user, groups):
+        """
+            Sets the supplementary groups of the user, like `usermod -G`.
+            Groups that don't exist are skipped.
+        """
+
+        groups = set(groups)
+        for name in self.group.names():
+            if name in groups:
+                self.add_group_member(name, user)
+            else:
+                self.remove_group_member(name, user)
+
+        missing = groups.difference(self.group.names())
+        if missing:
+            logger.warn("Skipping missing groups for {}: {}".format(
+                user, ', '.join(sorted(missing))))
+
+    # -- users
+    def add_user(self, name, uid, home, shell='/bin/bash', gecos='',
+                 password_hash='!', groups=()):
+        """
+            Creates a user along with its private group, like `useradd`.
+            The home directory isn't touched.
+
+            :param password_hash: The crypt(3) hash for the shadow entry.
+            :type password_hash: str
+
+            :param groups: Supplementary groups of the new user.
+            :type groups: iterable
+
+            :return: The gid of the user's private group.
+            :rtype: int
+        """
+
+        if self.user_exists(name):
+            raise AccountDBError("The user '{}' already exists".format(name))
+
+        if uid in self.used_uids():
+            raise AccountDBError("The uid {} is in use".format(uid))
+
+        if self.group_exists(name):
+            raise AccountDBError("The group '{}' already exists".format(name))
+
+        gid = self.add_group(name, gid=uid)
+
+        self.shadow.add([name, password_hash, _days_since_epoch(),
+                         '0', '99999', '7', '', '', ''])
+        self.passwd.add([name, 'x' if self.shadow.exists else password_hash,
+                         str(uid), str(gid), gecos, home, shell])
+
+        if groups:
+            self.set_user_groups(name, groups)
+
+        return gid
+
+    def set_password_hash(self, name, password_hash):
+        if self.shadow.exists:
+            entry = self.shadow.get(name)
+            if entry is not None:
+                entry[1] = password_hash
+                entry[2] = _days_since_epoch()
+                self.shadow.touch()
+        else:
+            entry = self.passwd.get(name)
+            if entry is not None:
+                entry[1] = password_hash
+                self.passwd.touch()
+
+    def set_expiry(self, name, expire_day):
+        """
+            Sets the day the account expires on, like `chage -E`.
+
+            :param expire_day: Days since the epoch, None to never expire.
+            :type expire_day: int
+        """
+
+        if not self.shadow.exists:
+            raise AccountDBError("Expiry dates need a shadow database")
+
+        entry = self.shadow.get(name)
+        if entry is None:
+            raise AccountDBError("The user '{}' doesn't exist".format(name))
+
+        entry[7] = '' if expire_day is None else str(expire_day)
+        self.shadow.touch()
+
+    def rename_user(self, name, new_name, home):
+        """
+            Renames the user, its private group and its memberships, like
+            `usermod --login --home --expiredate ''` followed by
+            `groupmod --new-name`. Any account expiry is cleared, as the
+            renamed user is a regular user. The home directory isn't moved.
+
+            :param home: The new home directory of the user.
+            :type home: str
+        """
+
+        entry = self.passwd.get(name)
+        if entry is None:
+            raise AccountDBError("The user '{}' doesn't exist".format(name))
+
+        if self.user_exists(new_name):
+            raise AccountDBError(
+                "The user '{}' already exists".format(new_name))
+
+        group = self.group.get(name)
+        rename_group = group is not None and group[2] == entry[3]
+        if rename_group and self.group_exists(new_name):
+            raise AccountDBError(
+                "The group '{}' already exists".format(new_name))
+
+        self.passwd.rename(name, new_name)
+        entry[5] = home
+        self.shadow.rename(name, new_name)
+
+        shadow_entry = self.shadow.get(new_name)
+        if shadow_entry is not None and shadow_entry[7]:
+            shadow_entry[7] = ''
+            self.shadow.touch()
+
+        if rename_group:
+            self.group.rename(name, new_name)
+            self.gshadow.rename(name, new_name)
+
+        # The members of group and gshadow, and the admins of gshadow
+        for db_file, columns in ((self.group, (3,)), (self.gshadow, (2, 3))):
+            for group_entry in db_file.entries():
+                for column in columns:
+                    users = group_entry[column].split(',')
+                    if name in users:
+                        group_entry[column] = ','.join(
+                            new_name if user == name else user
+                            for user in users)
+                        db_file.touch()
+
+    def remove_user(self, name):
+        """
+            Removes the user and its private group, like `userdel` without
+            `-r`. The home directory isn't touched.
+        """
+
+        entry = self.passwd.get(name)
+        if entry is None:
+            raise AccountDBError("The user '{}' doesn't exist".format(name))
+
+        for group in self.get_user_groups(name):
+            self.remove_group_member(group, name)
+
+        group = self.group.get(name)
+        if group is not None and group[2] == entry[3] and not group[3]:
+            self.group.remove(name)
+            self.gshadow.remove(name)
+
+        self.shadow.remove(name)
+        self.passwd.remove(name)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,183 @@
+#
+# command.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Running external commands without a shell, with timeouts and a report.
+#
+
+"""
+    Every external command kano-init runs goes through run(). Commands are
+    argv lists which are executed directly, so no /bin/sh is started in
+    between, and every call is recorded in a report for the current run
+    along with its exit code and wall time.
+
+    Usage:
+
+        result = run(['systemctl', 'start', 'lightdm'], timeout=30)
+        if result.returncode != 0:
+            ...
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+
+from kano.logging import logger
+
+from kano_init.paths import COMMAND_REPORT_DIR
+
+
+PIPE = subprocess.PIPE
+
+# The exit code of commands that couldn't be started, the same as the shell's
+RC_NOT_STARTED = 127
+
+CommandResult = namedtuple('CommandResult',
+                           ['argv', 'returncode', 'stdout', 'stderr',
+                            'duration', 'timed_out'])
+
+_report = []
+_report_lock = threading.Lock()
+
+
+def _record(result, started):
+    with _report_lock:
+        _report.append({
+            'argv': list(result.argv),
+            'returncode': result.returncode,
+            'started': started,
+            'duration': round(result.duration, 6),
+            'timed_out': result.timed_out
+        })
+
+    logger.debug("{} returned {} in {:.3f}s".format(
+        ' '.join(result.argv), result.returncode, result.duration))
+
+
+def run(argv, timeout=None, input_data=None, stdout=PIPE, stderr=PIPE,
+        log=False):
+    """
+        Runs a command and waits for it to finish.
+
+        :param argv: The program and its arguments.
+        :type argv: list
+
+        :param timeout: Seconds after which the command is killed, None to
+                        wait for as long as it takes.
+        :type timeout: float
+
+        :param input_data: Data written to the standard input of the
+                           command, which inherits ours if None.
+        :type input_data: str
+
+        :param stdout: PIPE to capture the output, None to inherit ours or
+                       an open file.
+        :param stderr: Like stdout.
+
+        :param log: Log the output of the command, like run_cmd_log.
+        :type log: bool
+
+        :rtype: CommandResult
+    """
+
+    argv = [str(arg) for arg in argv]
+    started = time.time()
+
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=PIPE if input_data is not None else None,
+            stdout=stdout,
+            stderr=stderr,
+            close_fds=True
+        )
+    except OSError as exc:
+        result = CommandResult(argv, RC_NOT_STARTED, '', str(exc),
+                               time.time() - started, False)
+        _record(result, started)
+        logger.error("Unable to run {}: {}".format(argv[0], exc))
+        return result
+
+    timed_out = threading.Event()
+    timer = None
+    if timeout is not None:
+        def kill():
+            timed_out.set()
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        out, err = process.communicate(input_data)
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    result = CommandResult(argv, process.returncode, out or '', err or '',
+                           time.time() - started, timed_out.is_set())
+    _record(result, started)
+
+    if result.timed_out:
+        logger.error("{} timed out after {}s".format(argv[0], timeout))
+
+    if log:
+        if result.stdout:
+            logger.info(result.stdout)
+        if result.stderr:
+            logger.info(result.stderr)
+
+    return result
+
+
+def get_report():
+    """
+        Returns the commands run so far, oldest first.
+
+        :rtype: list
+    """
+
+    with _report_lock:
+        return list(_report)
+
+
+def write_report(name, report_dir=COMMAND_REPORT_DIR):
+    """
+        Saves the report of this run as `<name>.json`, replacing the report
+        of the previous run with the same name.
+
+        :param name: The name of the run, e.g. the kano-init command.
+        :type name: str
+    """
+
+    report = get_report()
+    if not report:
+        return
+
+    total = sum(entry['duration'] for entry in report)
+    logger.info("Ran {} commands in {:.3f}s".format(len(report), total))
+
+    try:
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+
+        fd, tmp_path = tempfile.mkstemp(dir=report_dir, prefix='.report')
+        with os.fdopen(fd, 'w') as report_file:
+            json.dump({
+                'pid': os.getpid(),
+                'total_duration': round(total, 6),
+                'commands': report
+            }, report_file, indent=2)
+        os.rename(tmp_path, os.path.join(report_dir, '{}.json'.format(name)))
+    except (IOError, OSError) as exc:
+        logger.warn("Unable to save the command report: {}".format(exc))
@@ -0,0 +1,441 @@
+#
+# dbus_client.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# A minimal D-Bus client for calling methods over a unix socket.
+#
+
+"""
+    kano-init doesn't depend on python-dbus, so this speaks just enough of
+    the D-Bus wire protocol to call methods on a peer, e.g. the systemd
+    manager on its private socket, and read the replies: EXTERNAL
+    authentication and the basic, array, struct, dict entry and variant
+    types. Signals and other messages which aren't replies are ignored.
+
+    Variants are written as (signature, value) tuples and read as their
+    value.
+
+    Usage:
+
+        with DBusConnection('unix:path=/run/systemd/private') as bus:
+            bus.call('/org/freedesktop/systemd1',
+                     'org.freedesktop.systemd1.Manager', 'Reload')
+"""
+
+import os
+import socket
+import struct
+import binascii
+from collections import namedtuple
+
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+NO_REPLY_EXPECTED = 0x1
+
+FIELD_PATH = 1
+FIELD_INTERFACE = 2
+FIELD_MEMBER = 3
+FIELD_ERROR_NAME = 4
+FIELD_REPLY_SERIAL = 5
+FIELD_DESTINATION = 6
+FIELD_SENDER = 7
+FIELD_SIGNATURE = 8
+
+# The same as the default timeout of libdbus, in seconds
+DBUS_TIMEOUT = 25
+
+# The fixed part of the header, up to and including the length of the
+# header fields array
+HEADER_SIZE = 16
+
+_ALIGNMENT = {
+    'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8,
+    'd': 8, 'h': 4, 's': 4, 'o': 4, 'g': 1, 'v': 1, 'a': 4, '(': 8, '{': 8
+}
+_FIXED_FORMATS = {
+    'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q',
+    't': 'Q', 'd': 'd', 'h': 'I'
+}
+_ENDIANNESS = {'l': '<', 'B': '>'}
+
+Message = namedtuple('Message', ['type', 'flags', 'serial', 'fields', 'body'])
+
+
+class DBusError(Exception):
+    pass
+
+
+class DBusConnectionError(DBusError):
+    """
+        The peer couldn't be reached, or a call couldn't be sent to it, as
+        opposed to a method which failed.
+    """
+    pass
+
+
+def split_signature(signature):
+    """
+        Splits a signature into its complete types, e.g. 'sa{sv}(ii)' into
+        ['s', 'a{sv}', '(ii)'].
+
+        :rtype: list
+    """
+
+    types = []
+    pos = 0
+    while pos < len(signature):
+        end = _type_end(signature, pos)
+        types.append(signature[pos:end])
+        pos = end
+
+    return types
+
+
+def _type_end(signature, pos):
+    try:
+        char = signature[pos]
+        if char == 'a':
+            return _type_end(signature, pos + 1)
+
+        if char in '({':
+            close = ')' if char == '(' else '}'
+            pos += 1
+            while signature[pos] != close:
+                pos = _type_end(signature, pos)
+            return pos + 1
+    except IndexError:
+        raise DBusError("Invalid signature {!r}".format(signature))
+
+    if char not in _ALIGNMENT:
+        raise DBusError("Unsupported type {!r} in {!r}".format(char,
+                                                               signature))
+    return pos + 1
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+class _Writer(object):
+    def __init__(self):
+        self.data = bytearray()
+
+    def align(self, alignment):
+        self.data.extend('\0' * (-len(self.data) % alignment))
+
+    def write(self, sig, value):
+        char = sig[0]
+        self.align(_ALIGNMENT[char])
+
+        if char in _FIXED_FORMATS:
+            if char == 'b':
+                value = 1 if value else 0
+            self.data.extend(struct.pack('<' + _FIXED_FORMATS[char], value))
+        elif char in 'so':
+            value = _encode(value)
+            self.data.extend(struct.pack('<I', len(value)) + value + '\0')
+        elif char == 'g':
+            value = _encode(value)
+            self.data.extend(struct.pack('<B', len(value)) + value + '\0')
+        elif char == 'v':
+            value_sig, value = value
+            self.write('g', value_sig)
+            self.write(value_sig, value)
+        elif char == 'a':
+            item_sig = sig[1:]
+            length_pos = len(self.data)
+            self.data.extend('\0' * 4)
+            self.align(_ALIGNMENT[item_sig[0]])
+            start = len(self.data)
+
+            items = value.iteritems() if item_sig[0] == '{' else value
+            for item in items:
+                self.write(item_sig, item)
+
+            struct.pack_into('<I', self.data, length_pos,
+                             len(self.data) - start)
+        else:
+            for member_sig, member in zip(split_signature(sig[1:-1]), value):
+                self.write(member_sig, member)
+
+
+class _Reader(object):
+    def __init__(self, data, endianness, pos=0):
+        self.data = data
+        self.endianness = endianness
+        self.pos = pos
+
+    def align(self, alignment):
+        self.pos += -self.pos % alignment
+
+    def read(self, sig):
+        char = sig[0]
+        self.align(_ALIGNMENT[char])
+
+        if char in _FIXED_FORMATS:
+            fmt = self.endianness + _FIXED_FORMATS[char]
+            value, = struct.unpack_from(fmt, self.data, self.pos)
+            self.pos += struct.calcsize(fmt)
+            return bool(value) if char == 'b' else value
+        elif char in 'sog':
+            length = self.read('y' if char == 'g' else 'u')
+            value = str(self.data[self.pos:self.pos + length])
+            self.pos += length + 1
+            return value
+        elif char == 'v':
+            return self.read(self.read('g'))
+        elif char == 'a':
+            item_sig = sig[1:]
+            length = self.read('u')
+            self.align(_ALIGNMENT[item_sig[0]])
+            end = self.pos + length
+
+            items = []
+            while self.pos < end:
+                items.append(self.read(item_sig))
+
+            return dict(items) if item_sig[0] == '{' else items
+
+        return tuple(self.read(member_sig)
+                     for member_sig in split_signature(sig[1:-1]))
+
+
+def encode_message(msg_type, serial, fields, signature='', args=(), flags=0):
+    """
+        Builds a little-endian message.
+
+        :param fields: The header fields, a dictionary of FIELD_* codes to
+                       their values. The signature field is set from the
+                       signature.
+        :type fields: dict
+
+        :param signature: The signature of the body.
+        :type signature: str
+
+        :param args: The values of the body, one per type in the signature.
+        :type args: tuple
+
+        :rtype: str
+    """
+
+    body = _Writer()
+    for arg_sig, arg in zip(split_signature(signature), args):
+        body.write(arg_sig, arg)
+
+    field_sigs = {
+        FIELD_PATH: 'o', FIELD_INTERFACE: 's', FIELD_MEMBER: 's',
+        FIELD_ERROR_NAME: 's', FIELD_REPLY_SERIAL: 'u',
+        FIELD_DESTINATION: 's', FIELD_SENDER: 's', FIELD_SIGNATURE: 'g'
+    }
+    fields = dict(fields)
+    if signature:
+        fields[FIELD_SIGNATURE] = signature
+
+    header = _Writer()
+    for char, value in (('y', ord('l')), ('y', msg_type), ('y', flags),
+                        ('y', 1), ('u', len(body.data)), ('u', serial)):
+        header.write(char, value)
+    header.write('a(yv)', [(code, (field_sigs[code], value))
+                           for code, value in sorted(fields.iteritems())])
+    header.align(8)
+
+    return str(header.data + body.data)
+
+
+def get_message_length(header):
+    """
+        Returns the length of a whole message from its first HEADER_SIZE
+        bytes.
+
+        :rtype: int
+    """
+
+    endianness = _ENDIANNESS.get(header[0])
+    if endianness is None:
+        raise DBusError("Invalid message endianness {!r}".format(header[0]))
+
+    body_length, fields_length = struct.unpack_from(endianness + 'I4xI',
+                                                    header, 4)
+    fields_end = HEADER_SIZE + fields_length
+
+    return fields_end + (-fields_end % 8) + body_length
+
+
+def decode_message(data):
+    """
+        Parses a whole message.
+
+        :rtype: Message
+    """
+
+    endianness = _ENDIANNESS.get(data[0])
+    if endianness is None:
+        raise DBusError("Invalid message endianness {!r}".format(data[0]))
+
+    reader = _Reader(data, endianness, 1)
+    msg_type = reader.read('y')
+    flags = reader.read('y')
+    reader.read('y')
+    reader.read('u')
+    serial = reader.read('u')
+    fields = dict(reader.read('a(yv)'))
+    reader.align(8)
+
+    body = tuple(reader.read(arg_sig) for arg_sig in
+                 split_signature(fields.get(FIELD_SIGNATURE, '')))
+
+    return Message(msg_type, flags, serial, fields, body)
+
+
+def _parse_address(address):
+    for entry in address.split(';'):
+        transport, _, params = entry.partition(':')
+        if transport != 'unix':
+            continue
+
+        params = dict(param.split('=', 1)
+                      for param in params.split(',') if '=' in param)
+        if 'path' in params:
+            return params['path']
+        elif 'abstract' in params:
+            return '\0' + params['abstract']
+
+    raise DBusError("Unsupported D-Bus address {}".format(address))
+
+
+class DBusConnection(object):
+    """
+        A connection to a D-Bus peer. Calls can be sent one after the other
+        and their replies collected later, so several of them are handled
+        by the peer in a single round trip.
+    """
+
+    def __init__(self, address, timeout=DBUS_TIMEOUT):
+        self.address = address
+        self._serial = 0
+        self._buffer = ''
+        self._replies = {}
+
+        path = _parse_address(address)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(path)
+            self._authenticate()
+        except (socket.error, DBusError) as exc:
+            self._sock.close()
+            raise DBusConnectionError("Unable to connect to {}: {}".format(
+                address, exc))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._sock.close()
+
+    def _authenticate(self):
+        uid = binascii.hexlify(str(os.geteuid()))
+        self._sock.sendall('\0AUTH EXTERNAL {}\r\n'.format(uid))
+
+        while '\r\n' not in self._buffer:
+            self._fill()
+        line, self._buffer = self._buffer.split('\r\n', 1)
+        if not line.startswith('OK '):
+            raise DBusError("Authentication refused: {}".format(line))
+
+        self._sock.sendall('BEGIN\r\n')
+
+    def _fill(self):
+        data = self._sock.recv(4096)
+        if not data:
+            raise DBusError("Connection closed by {}".format(self.address))
+        self._buffer += data
+
+    def _recv(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_message(self):
+        header = self._recv(HEADER_SIZE)
+        rest = self._recv(get_message_length(header) - HEADER_SIZE)
+
+        return decode_message(header + rest)
+
+    def send(self, path, interface, member, signature='', args=(),
+             destination=None):
+        """
+            Sends a method call without waiting for its reply.
+
+            :return: The serial to pass to wait_reply().
+            :rtype: int
+        """
+
+        self._serial += 1
+        fields = {
+            FIELD_PATH: path,
+            FIELD_INTERFACE: interface,
+            FIELD_MEMBER: member
+        }
+        if destination:
+            fields[FIELD_DESTINATION] = destination
+
+        message = encode_message(METHOD_CALL, self._serial, fields,
+                                 signature, args)
+        try:
+            self._sock.sendall(message)
+        except socket.error as exc:
+            raise DBusConnectionError("Unable to call {}: {}".format(member,
+                                                                     exc))
+
+        return self._serial
+
+    def wait_reply(self, serial):
+        """
+            Waits for the reply to a call sent earlier.
+
+            :return: The values returned by the method.
+            :rtype: tuple
+        """
+
+        try:
+            while serial not in self._replies:
+                message = self._read_message()
+                if message.type in (METHOD_RETURN, ERROR):
+                    reply_serial = message.fields.get(FIELD_REPLY_SERIAL)
+                    self._replies[reply_serial] = message
+        except socket.error as exc:
+            raise DBusError("No reply from {}: {}".format(self.address, exc))
+
+        reply = self._replies.pop(serial)
+        if reply.type == ERROR:
+            raise DBusError("{}: {}".format(
+                reply.fields.get(FIELD_ERROR_NAME),
+                reply.body[0] if reply.body else ''))
+
+        return reply.body
+
+    def call(self, path, interface, member, signature='', args=(),
+             destination=None):
+        """
+            Calls a method and waits for its reply.
+
+            :rtype: tuple
+        """
+
+        return self.wait_reply(self.send(path, interface, member, signature,
+                                         args, destination))
@@ -0,0 +1,72 @@
+#
+# home_mounts.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Home directories kept in RAM, e.g. for temporary kiosk users.
+#
+
+"""
+    A tmpfs home is a mount on top of an empty /home/<user> directory. The
+    skeleton is unpacked into it like into any other home, and deleting it
+    is a lazy unmount which releases all of its pages at once, rather than
+    unlinking the tree file by file. Nothing in it ever reaches the SD card.
+
+    The contents don't survive a reboot, the mountpoint is left behind as
+    an empty directory.
+"""
+
+import os
+
+from kano.logging import logger
+
+from kano_init.command import run
+
+
+# The upper limit of the memory a tmpfs home can use
+TMPFS_HOME_SIZE = '256m'
+
+
+class HomeMountError(Exception):
+    pass
+
+
+def mount_tmpfs_home(home_path, uid, gid, mode, size=TMPFS_HOME_SIZE):
+    """
+        Mounts an empty tmpfs owned by the user at home_path.
+
+        :param mode: The mode of the home directory.
+        :type mode: int
+
+        :param size: The size limit of the tmpfs, e.g. '256m'.
+        :type size: str
+    """
+
+    if not os.path.isdir(home_path):
+        os.mkdir(home_path, 0o700)
+
+    options = 'size={},mode={:04o},uid={},gid={},nodev,nosuid'.format(
+        size, mode, uid, gid)
+    result = run(['mount', '-t', 'tmpfs', '-o', options, 'tmpfs', home_path],
+                 log=True)
+    if result.returncode != 0:
+        raise HomeMountError("Unable to mount a tmpfs at {}".format(home_path))
+
+
+def is_home_mount(home_path):
+    return os.path.ismount(home_path)
+
+
+def unmount_home(home_path):
+    """
+        Detaches a tmpfs home and removes its mountpoint.
+    """
+
+    if run(['umount', '--lazy', home_path], log=True).returncode != 0:
+        raise HomeMountError("Unable to unmount {}".format(home_path))
+
+    try:
+        os.rmdir(home_path)
+    except OSError as exc:
+        logger.warn("Unable to remove {}: {}".format(home_path, exc))
@@ -0,0 +1,132 @@
+#
+# home_trash.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Deferred removal of the home directories of deleted users.
+#
+
+"""
+    Deleting a user only needs its account to be gone right away, its home
+    directory can be unlinked later. Homes are renamed into a trash area on
+    the same filesystem, which is atomic and instant, and a low priority
+    garbage collector removes them in the background.
+
+    The collector simply removes whatever is left in the trash, so it
+    carries on after a reboot where the previous run stopped. It runs at
+    boot through kano-init-gc.service and can be started by hand with
+    `kano-init gc`.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+
+from kano.logging import logger
+
+from kano_init.paths import HOME_TRASH_PATH, get_root_path
+from kano_init.command import run
+
+
+GC_SERVICE = 'kano-init-gc.service'
+
+
+def move_to_trash(home_path, root='/'):
+    """
+        Atomically moves a home directory into the trash.
+
+        :param home_path: The home directory to be removed.
+        :type home_path: str
+
+        :return: False when it couldn't be moved, e.g. because it lives on
+                 a different filesystem, in which case it has to be removed
+                 synchronously.
+        :rtype: bool
+    """
+
+    if not os.path.lexists(home_path):
+        return True
+
+    trash_path = get_root_path(root, HOME_TRASH_PATH)
+    if not os.path.isdir(trash_path):
+        os.makedirs(trash_path, 0o700)
+
+    target = os.path.join(trash_path, '{}.{:x}'.format(
+        os.path.basename(home_path.rstrip('/')), int(time.time() * 1000)))
+
+    try:
+        os.rename(home_path, target)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EBUSY):
+            raise
+        logger.warn("Unable to move {} to the trash: {}".format(home_path,
+                                                                  exc))
+        return False
+
+    logger.info("Moved {} to {}".format(home_path, target))
+    return True
+
+
+def schedule_gc():
+    """
+        Empties the trash in the background through its systemd service.
+    """
+
+    run(['systemctl', 'start', '--no-block', GC_SERVICE])
+
+
+def lower_priority():
+    """
+        Makes the current process use the idle CPU and I/O scheduling
+        classes, so the collector never competes with the boot.
+    """
+
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+    pid = os.getpid()
+    run(['chrt', '--idle', '-p', 0, pid])
+    run(['ionice', '-c', 3, '-p', pid])
+
+
+def empty_trash(root='/'):
+    """
+        Removes everything from the trash. Only one collector runs at a
+        time, other invocations return straight away.
+
+        :return: The number of entries removed.
+        :rtype: int
+    """
+
+    trash_path = get_root_path(root, HOME_TRASH_PATH)
+    if not os.path.isdir(trash_path):
+        return 0
+
+    trash_fd = os.open(trash_path, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(trash_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.info("The trash is being emptied already")
+            return 0
+
+        removed = 0
+        for name in os.listdir(trash_path):
+            path = os.path.join(trash_path, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                removed += 1
+            except OSError as exc:
+                logger.error("Unable to remove {}: {}".format(path, exc))
+
+        return removed
+    finally:
+        os.close(trash_fd)
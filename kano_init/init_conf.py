@@ -0,0 +1,193 @@
+#
+# init_conf.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Loading the init configuration from the boot partition.
+#
+
+"""
+    The init configuration is a JSON file on the FAT boot partition with
+    the kano-init options under a `kano-init` key, or `kano_init` with the
+    old convention.
+
+    Reading it from the boot partition is slow, so once it has been parsed
+    and validated, the result is kept under /var/cache/kano-init along with
+    the size and mtime of the file. Later runs only stat the file and use
+    the cached copy while those haven't changed.
+
+    Usage:
+
+        init_conf = load_init_conf()
+        if init_conf.skip:
+            username = init_conf.user
+"""
+
+import os
+import json
+
+from kano.logging import logger
+
+from kano_init.paths import INIT_CONF_PATH, INIT_CONF_CACHE_PATH
+
+
+# Bump when the schema or the cached format changes to drop old caches
+CACHE_VERSION = 1
+
+# The options kano-init knows about, with the types they can have and the
+# value used when they are missing or invalid. Other options are kept as
+# they are.
+SCHEMA = {
+    'skip': ((bool,), False),
+    'user': ((basestring,), None),
+    # Accounts to be created in bulk with `kano-init create-users`
+    'users': ((list, basestring, dict), []),
+    'temp_user_pool': ((int, long), None),
+}
+
+
+class InitConfError(Exception):
+    pass
+
+
+def _option(key):
+    return property(lambda self: self.get(key, SCHEMA[key][1]))
+
+
+class InitConf(object):
+    """
+        The validated options, readable through the typed properties or
+        like a dictionary.
+    """
+
+    skip = _option('skip')
+    user = _option('user')
+    users = _option('users')
+    temp_user_pool = _option('temp_user_pool')
+
+    def __init__(self, options=None):
+        self._options = options or {}
+
+    def __contains__(self, key):
+        return key in self._options
+
+    def __getitem__(self, key):
+        return self._options[key]
+
+    def get(self, key, default=None):
+        return self._options.get(key, default)
+
+    def to_dict(self):
+        return dict(self._options)
+
+
+def validate(conf_data):
+    """
+        Picks the kano-init options from the parsed file and checks them
+        against the schema. Invalid options are dropped with a warning, so
+        a typo in the file doesn't stop the kit from booting.
+
+        :param conf_data: The parsed init configuration file.
+        :type conf_data: dict
+
+        :return: The kano-init options.
+        :rtype: dict
+    """
+
+    if not isinstance(conf_data, dict):
+        raise InitConfError("The init configuration isn't a JSON object")
+
+    options = {}
+
+    # The old convention with an underscore
+    if 'kano_init' in conf_data:
+        options = conf_data['kano_init']
+
+    # A hyphen with a bigger priority
+    if 'kano-init' in conf_data:
+        options = conf_data['kano-init']
+
+    if not isinstance(options, dict):
+        raise InitConfError("The kano-init options aren't a JSON object")
+
+    options = dict(options)
+    for key, (types, default) in SCHEMA.iteritems():
+        if key not in options:
+            continue
+
+        value = options[key]
+        if not isinstance(value, types) or \
+                (isinstance(value, bool) and bool not in types):
+            logger.warn("Ignoring the invalid init option {}={!r}".format(
+                key, value))
+            del options[key]
+
+    users = options.get('users', SCHEMA['users'][1])
+    options['users'] = users if isinstance(users, list) else [users]
+
+    return options
+
+
+def _read_cache(cache_path, stat):
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or \
+            cache.get('version') != CACHE_VERSION or \
+            cache.get('size') != stat.st_size or \
+            cache.get('mtime') != stat.st_mtime:
+        return None
+
+    return cache.get('options')
+
+
+def _write_cache(cache_path, stat, options):
+    tmp_path = cache_path + '.tmp'
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({
+                'version': CACHE_VERSION,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'options': options
+            }, cache_file)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as exc:
+        logger.debug("Unable to cache the init configuration: {}".format(exc))
+
+
+def load_init_conf(path=INIT_CONF_PATH, cache_path=INIT_CONF_CACHE_PATH):
+    """
+        Load the init configuration from the boot partition, or from its
+        cached copy if the file hasn't changed since it was cached.
+
+        :rtype: InitConf
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return InitConf(validate({}))
+
+    options = _read_cache(cache_path, stat)
+    if options is not None:
+        return InitConf(options)
+
+    try:
+        with open(path, 'r') as conf_file:
+            options = validate(json.load(conf_file))
+    except (IOError, ValueError, InitConfError) as exc:
+        logger.error("Unable to load {}: {}".format(path, exc))
+        return InitConf(validate({}))
+
+    _write_cache(cache_path, stat, options)
+
+    return InitConf(options)
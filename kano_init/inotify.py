@@ -0,0 +1,141 @@
+#
+# inotify.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# A small ctypes binding of the Linux inotify API.
+#
+
+"""
+    Just enough of inotify(7) to block until files change, without any
+    extra dependencies.
+
+    Usage:
+
+        with Inotify() as inotify:
+            inotify.add_watch('/var/cache/kano-init', IN_MOVED_TO)
+            for event in inotify.read_events(timeout=10):
+                print event.name
+"""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import namedtuple
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+
+_libc = None
+
+
+class InotifyError(Exception):
+    pass
+
+
+def _get_libc():
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+
+    return _libc
+
+
+def _check(result, what):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise InotifyError("{} failed: {}".format(what, os.strerror(err)))
+
+    return result
+
+
+class Inotify(object):
+    """
+        An inotify instance, closed when leaving its context.
+    """
+
+    def __init__(self):
+        try:
+            self._libc = _get_libc()
+        except OSError as exc:
+            raise InotifyError("Unable to load libc: {}".format(exc))
+
+        self._fd = _check(self._libc.inotify_init1(IN_CLOEXEC),
+                          'inotify_init1')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def add_watch(self, path, mask):
+        """
+            :return: The watch descriptor, which events carry in their wd.
+            :rtype: int
+        """
+
+        return _check(self._libc.inotify_add_watch(self._fd, path, mask),
+                      'inotify_add_watch {}'.format(path))
+
+    def read_events(self, timeout=None):
+        """
+            Waits for events and returns all the ones queued.
+
+            :param timeout: Seconds to wait, None to wait for as long as it
+                            takes.
+            :type timeout: float
+
+            :return: The events, empty if the timeout expired.
+            :rtype: list
+        """
+
+        while True:
+            try:
+                ready, _, _ = select.select([self._fd], [], [], timeout)
+                break
+            except select.error as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+
+        if not ready:
+            return []
+
+        data = os.read(self._fd, 64 * 1024)
+
+        events = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append(Event(wd, mask, cookie, name))
+
+        return events
@@ -0,0 +1,238 @@
+#
+# lightdm.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# An in-memory editor for the LightDM configuration file.
+#
+
+"""
+    The configuration is parsed once into a list of lines, so comments,
+    blank lines and the order of the keys are kept exactly as they are.
+    Keys can be read and changed like in a dictionary and all the changes
+    are written at once, atomically, and only if the file has changed.
+
+    A key is either active, `key=value`, or commented out, `#key=value`.
+    Setting a key activates its lines, deleting it comments them out, the
+    same as the sed expressions that used to edit the file.
+
+    Usage:
+
+        with edit_lightdm_conf() as conf:
+            conf['autologin-user'] = 'kano'
+            conf['autologin-user-timeout'] = '0'
+"""
+
+import os
+import re
+from contextlib import contextmanager
+
+from kano.logging import logger
+
+
+LIGHTDM_CONF_FILE = '/etc/lightdm/lightdm.conf'
+
+# The section new keys are added to when the file doesn't mention them
+DEFAULT_SECTION = 'SeatDefaults'
+
+_KEY_LINE_RE = re.compile(r'^(#?)([A-Za-z0-9_.-]+)=(.*)$')
+_SECTION_RE = re.compile(r'^\[(.+)\]\s*$')
+
+
+class LightDMConfError(Exception):
+    pass
+
+
+class _KeyLine(object):
+    __slots__ = ('key', 'value', 'active')
+
+    def __init__(self, key, value, active):
+        self.key = key
+        self.value = value
+        self.active = active
+
+    def __str__(self):
+        return '{}{}={}'.format('' if self.active else '#', self.key,
+                                self.value)
+
+
+class LightDMConf(object):
+    """
+        The contents of lightdm.conf, editable like a dictionary of the
+        active keys.
+    """
+
+    def __init__(self, path=LIGHTDM_CONF_FILE, contents=''):
+        self.path = path
+        self.changed = False
+
+        # Each line is either a string kept verbatim or a _KeyLine
+        self._lines = []
+        self._sections = {}
+        self._trailing_newline = contents.endswith('\n') or not contents
+        self._parse(contents)
+
+    @staticmethod
+    def load(path=LIGHTDM_CONF_FILE):
+        """
+            Parses the configuration file.
+
+            :rtype: LightDMConf
+        """
+
+        try:
+            with open(path, 'r') as conf_file:
+                contents = conf_file.read()
+        except IOError as exc:
+            raise LightDMConfError("Unable to read {}: {}".format(path, exc))
+
+        return LightDMConf(path, contents)
+
+    def _parse(self, contents):
+        section = None
+        for line in contents.splitlines():
+            match = _SECTION_RE.match(line)
+            if match:
+                section = match.group(1)
+                self._lines.append(line)
+                self._sections[section] = len(self._lines)
+                continue
+
+            match = _KEY_LINE_RE.match(line)
+            if match:
+                self._lines.append(_KeyLine(match.group(2), match.group(3),
+                                            not match.group(1)))
+                if section is not None:
+                    self._sections[section] = len(self._lines)
+            else:
+                self._lines.append(line)
+
+    def _key_lines(self, key):
+        return [line for line in self._lines
+                if isinstance(line, _KeyLine) and line.key == key]
+
+    def __contains__(self, key):
+        return any(line.active for line in self._key_lines(key))
+
+    def __getitem__(self, key):
+        values = [line.value for line in self._key_lines(key) if line.active]
+        if not values:
+            raise KeyError(key)
+
+        return values[-1]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.comment_out(key)
+
+    def set(self, key, value, section=DEFAULT_SECTION):
+        """
+            Activates every line of the key with the value. The key is
+            added at the end of the section when the file doesn't have it.
+        """
+
+        value = str(value)
+        lines = self._key_lines(key)
+        if not lines:
+            self._add(_KeyLine(key, value, True), section)
+            return
+
+        for line in lines:
+            if not line.active or line.value != value:
+                line.active = True
+                line.value = value
+                self.changed = True
+
+    def comment_out(self, key, placeholder=None):
+        """
+            Comments out the active lines of the key.
+
+            :param placeholder: The value left in the commented out lines,
+                                the current value is kept if None.
+            :type placeholder: str
+        """
+
+        for line in self._key_lines(key):
+            if line.active:
+                line.active = False
+                if placeholder is not None:
+                    line.value = str(placeholder)
+                self.changed = True
+
+    def _add(self, key_line, section):
+        if section not in self._sections:
+            self._lines.append('[{}]'.format(section))
+            self._sections[section] = len(self._lines)
+
+        pos = self._sections[section]
+        self._lines.insert(pos, key_line)
+
+        for name, end in self._sections.iteritems():
+            if end >= pos:
+                self._sections[name] = end + 1
+        self._sections[section] = pos + 1
+
+        self.changed = True
+
+    def dumps(self):
+        contents = '\n'.join(str(line) for line in self._lines)
+        if self._trailing_newline and contents:
+            contents += '\n'
+
+        return contents
+
+    def save(self):
+        """
+            Replaces the file atomically when anything has changed.
+
+            :return: Whether the file was written.
+            :rtype: bool
+        """
+
+        if not self.changed:
+            return False
+
+        tmp_path = self.path + '.kano-init'
+        try:
+            mode = os.stat(self.path).st_mode & 0o7777
+        except OSError:
+            mode = 0o644
+
+        try:
+            with open(tmp_path, 'w') as tmp_file:
+                tmp_file.write(self.dumps())
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as exc:
+            raise LightDMConfError("Unable to write {}: {}".format(self.path,
+                                                                   exc))
+
+        logger.debug("Updated {}".format(self.path))
+        self.changed = False
+
+        return True
+
+
+@contextmanager
+def edit_lightdm_conf(path=LIGHTDM_CONF_FILE):
+    """
+        Yields the parsed configuration and saves it once the block
+        succeeds, if anything has changed.
+
+        :rtype: LightDMConf
+    """
+
+    conf = LightDMConf.load(path)
+    yield conf
+    conf.save()
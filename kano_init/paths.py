@@ -8,6 +8,15 @@
 import os
 
 STATUS_FILE_PATH = '/var/cache/kano-init/status.json'
+STATUS_STAGE_FILE_PATH = '/var/cache/kano-init/stage'
+SKEL_ARCHIVE_PATH = '/var/cache/kano-init/skel.tar'
+PASSWORD_HASH_CACHE_PATH = '/var/cache/kano-init/password-hashes.json'
+TEMP_USER_POOL_PATH = '/var/cache/kano-init/temp-user-pool.json'
+TEMP_USER_RESERVATIONS_PATH = '/var/cache/kano-init/temp-user-reservations.json'
+TEMP_USER_EXPIRY_PATH = '/var/cache/kano-init/temp-user-expiry.json'
+COMMAND_REPORT_DIR = '/var/cache/kano-init/command-reports'
+INIT_CONF_CACHE_PATH = '/var/cache/kano-init/init-conf.json'
+RESET_JOURNAL_PATH = '/var/cache/kano-init/reset-journal.json'
 
 PACKAGE_PATH = os.path.dirname(__file__)
 DATA_PATH = os.path.join(PACKAGE_PATH, 'data')
@@ -18,4 +27,20 @@ ASCII_RES_PATH = os.path.join(PACKAGE_PATH, 'ascii_art/resources')
 
 INIT_CONF_PATH = '/boot/init.conf'
 
+PASSWD_FILE_PATH = '/etc/passwd'
+SHADOW_FILE_PATH = '/etc/shadow'
+GROUP_FILE_PATH = '/etc/group'
+GSHADOW_FILE_PATH = '/etc/gshadow'
+PWD_LOCK_FILE_PATH = '/etc/.pwd.lock'
+SKEL_PATH = '/etc/skel'
+
+HOME_TRASH_PATH = '/home/.kano-trash'
+
 DEFAULT_LIGHTDM_CONF_FILE = os.path.join(DATA_PATH, 'lightdm.conf')
+
+
+def get_root_path(root, path):
+    """
+    Returns where an absolute system path lives for the system under root.
+    """
+    return os.path.join(root, path.lstrip('/'))
@@ -0,0 +1,331 @@
+#
+# skeleton.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Populating new home directories from the skeleton in /etc/skel.
+#
+
+"""
+    Creating a home directory on an SD card is dominated by small-file I/O.
+    Every entry is created with its final owner and mode straight away, so
+    the tree is walked once instead of copying it and then chown-ing it.
+
+    The skeleton is cached as a single tar archive, keyed by the mtimes of
+    its directories, which is unpacked as a stream. When the archive can't
+    be used, the skeleton is cloned file by file, through a reflink or
+    copy_file_range(2) when the filesystem supports them.
+"""
+
+import os
+import stat
+import errno
+import fcntl
+import ctypes
+import tarfile
+import tempfile
+import threading
+import ctypes.util
+
+from kano.logging import logger
+
+from kano_init.paths import SKEL_PATH, SKEL_ARCHIVE_PATH, get_root_path
+
+
+# Unpack the cached archive rather than cloning /etc/skel file by file
+USE_SKEL_ARCHIVE = True
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 64 * 1024
+
+# copy_file_range(2) fails with these when it can't be used for a file
+_UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP)
+
+_archive_lock = threading.Lock()
+
+
+def _load_copy_file_range():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        copy_file_range = libc.copy_file_range
+    except (OSError, AttributeError):
+        return None
+
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint
+    ]
+    return copy_file_range
+
+
+_copy_file_range = _load_copy_file_range()
+
+
+def _copy_stream(read, dst_fd):
+    while True:
+        data = read(CHUNK_SIZE)
+        if not data:
+            break
+        while data:
+            data = data[os.write(dst_fd, data):]
+
+
+def clone_file(src_fd, dst_fd, size):
+    """
+        Copies the contents of a file, sharing the data blocks with a
+        reflink or copying them in the kernel when possible.
+    """
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except IOError:
+        pass
+
+    if _copy_file_range is not None:
+        offset = 0
+        while offset < size:
+            copied = _copy_file_range(src_fd, None, dst_fd, None,
+                                      size - offset, 0)
+            if copied < 0:
+                err = ctypes.get_errno()
+                if offset == 0 and err in _UNSUPPORTED_ERRNOS:
+                    break
+                raise OSError(err, os.strerror(err))
+            if copied == 0:
+                return
+            offset += copied
+        else:
+            return
+
+    _copy_stream(lambda n: os.read(src_fd, n), dst_fd)
+
+
+def _create_file(path, mode, uid, gid):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    os.fchown(fd, uid, gid)
+    os.fchmod(fd, mode)
+    return fd
+
+
+def _create_dir(path, mode, uid, gid):
+    os.mkdir(path, 0o700)
+    os.lchown(path, uid, gid)
+    os.chmod(path, mode)
+
+
+def _create_symlink(target, path, uid, gid):
+    os.symlink(target, path)
+    os.lchown(path, uid, gid)
+
+
+def _prepare_top_dir(path, mode, uid, gid, existing):
+    if existing:
+        os.chown(path, uid, gid)
+        os.chmod(path, mode)
+    else:
+        _create_dir(path, mode, uid, gid)
+
+
+def clone_tree(src_path, dst_path, uid, gid, mode, existing=False):
+    """
+        Clones the skeleton to dst_path in a single walk, creating every
+        entry with its owner already set.
+
+        :param mode: The mode of the top directory.
+        :type mode: int
+
+        :param existing: Whether dst_path exists already, e.g. a mountpoint.
+        :type existing: bool
+    """
+
+    _prepare_top_dir(dst_path, mode, uid, gid, existing)
+
+    for dirpath, dirnames, filenames in os.walk(src_path):
+        dst_dir = os.path.join(dst_path, os.path.relpath(dirpath, src_path))
+
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+            info = os.lstat(src)
+
+            if os.path.islink(src):
+                _create_symlink(os.readlink(src), dst, uid, gid)
+            elif os.path.isdir(src):
+                _create_dir(dst, info.st_mode & 0o7777, uid, gid)
+            elif os.path.isfile(src):
+                src_fd = os.open(src, os.O_RDONLY)
+                try:
+                    dst_fd = _create_file(dst, info.st_mode & 0o7777, uid, gid)
+                    try:
+                        clone_file(src_fd, dst_fd, info.st_size)
+                    finally:
+                        os.close(dst_fd)
+                finally:
+                    os.close(src_fd)
+
+
+def _skeleton_stamp(skel_path):
+    """
+        The mtimes of the skeleton directories show files being added,
+        removed or renamed into place, and the mtime and size of each file
+        show the ones edited in place.
+    """
+
+    stamp = []
+    for dirpath, dummy_dirnames, filenames in os.walk(skel_path):
+        stamp.append('{} {}'.format(os.path.relpath(dirpath, skel_path),
+                                    os.stat(dirpath).st_mtime))
+
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            info = os.lstat(path)
+            if stat.S_ISREG(info.st_mode):
+                stamp.append('{} {} {}'.format(
+                    os.path.relpath(path, skel_path), info.st_mtime,
+                    info.st_size))
+
+    return '\n'.join(sorted(stamp))
+
+
+def _stamp_path(archive_path):
+    return archive_path + '.stamp'
+
+
+def _read_stamp(archive_path):
+    try:
+        with open(_stamp_path(archive_path), 'r') as stamp_file:
+            return stamp_file.read()
+    except IOError:
+        return None
+
+
+def build_archive(skel_path, archive_path):
+    """
+        Caches the skeleton as a single tar archive. The archive is replaced
+        atomically, so concurrent readers see either version.
+    """
+
+    archive_dir = os.path.dirname(archive_path)
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    stamp = _skeleton_stamp(skel_path)
+
+    def reset_owner(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+
+    fd, tmp_path = tempfile.mkstemp(dir=archive_dir, prefix='.skel')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            archive = tarfile.open(fileobj=tmp_file, mode='w')
+            for name in sorted(os.listdir(skel_path)):
+                archive.add(os.path.join(skel_path, name), arcname=name,
+                            filter=reset_owner)
+            archive.close()
+
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, archive_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=archive_dir, prefix='.skel')
+    with os.fdopen(fd, 'w') as stamp_file:
+        stamp_file.write(stamp)
+    os.rename(tmp_path, _stamp_path(archive_path))
+
+
+def get_archive(root='/'):
+    """
+        Returns the path to an up-to-date archive of the skeleton, building
+        it when needed, or None when it can't be cached.
+    """
+
+    skel_path = get_root_path(root, SKEL_PATH)
+    archive_path = get_root_path(root, SKEL_ARCHIVE_PATH)
+
+    with _archive_lock:
+        try:
+            if not os.path.isfile(archive_path) or \
+                    _read_stamp(archive_path) != _skeleton_stamp(skel_path):
+                build_archive(skel_path, archive_path)
+        except (IOError, OSError, tarfile.TarError) as exc:
+            logger.warn("Unable to cache the skeleton: {}".format(exc))
+            return None
+
+    return archive_path
+
+
+def unpack_archive(archive_path, dst_path, uid, gid, mode, existing=False):
+    """
+        Unpacks the cached skeleton as a stream, creating every entry with
+        its owner already set.
+
+        :param mode: The mode of the top directory.
+        :type mode: int
+
+        :param existing: Whether dst_path exists already, e.g. a mountpoint.
+        :type existing: bool
+    """
+
+    _prepare_top_dir(dst_path, mode, uid, gid, existing)
+
+    archive = tarfile.open(archive_path, 'r|')
+    try:
+        for member in archive:
+            name = os.path.normpath(member.name)
+            if name.startswith(('/', '..')):
+                logger.warn("Skipping {} in {}".format(member.name,
+                                                       archive_path))
+                continue
+
+            path = os.path.join(dst_path, name)
+            if member.isdir():
+                _create_dir(path, member.mode, uid, gid)
+            elif member.issym():
+                _create_symlink(member.linkname, path, uid, gid)
+            elif member.isreg():
+                dst_fd = _create_file(path, member.mode, uid, gid)
+                try:
+                    _copy_stream(archive.extractfile(member).read, dst_fd)
+                finally:
+                    os.close(dst_fd)
+    finally:
+        archive.close()
+
+
+def populate_home(home_path, uid, gid, mode, root='/', existing=False):
+    """
+        Creates a home directory from the skeleton in /etc/skel, owned by
+        the user, the way `useradd -m` does.
+
+        :param home_path: Where the home directory should be created.
+        :type home_path: str
+
+        :param mode: The mode of the home directory.
+        :type mode: int
+
+        :param existing: Populate the empty directory at home_path instead
+                         of creating it, e.g. a freshly mounted tmpfs.
+        :type existing: bool
+    """
+
+    skel_path = get_root_path(root, SKEL_PATH)
+    if not os.path.isdir(skel_path):
+        _prepare_top_dir(home_path, mode, uid, gid, existing)
+        return
+
+    archive_path = get_archive(root) if USE_SKEL_ARCHIVE else None
+    if archive_path:
+        unpack_archive(archive_path, home_path, uid, gid, mode, existing)
+    else:
+        clone_tree(skel_path, home_path, uid, gid, mode, existing)
@@ -7,12 +7,17 @@
 
 import os
 import json
+import time
+import tempfile
+from contextlib import contextmanager
 
 from kano.utils import ensure_dir
 from kano.utils.file_operations import open_locked
 from kano.logging import logger
 
-from kano_init.paths import STATUS_FILE_PATH
+from kano_init.paths import STATUS_FILE_PATH, STATUS_STAGE_FILE_PATH
+from kano_init.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, \
+    IN_DELETE_SELF, IN_MOVE_SELF
 
 
 class StatusError(Exception):
@@ -50,6 +55,9 @@ class Status(object):
 
     _status_file = STATUS_FILE_PATH
 
+    # A plain text copy of the stage, for shell scripts to `read`
+    _stage_file = STATUS_STAGE_FILE_PATH
+
     _singleton_instance = None
 
     @staticmethod
@@ -72,6 +80,9 @@ class Status(object):
         self._stage = self.DISABLED_STAGE
         self._username = None
 
+        # The depth of the open transactions
+        self._transactions = 0
+
     def _initialise_status_file(self):
         ensure_dir(os.path.dirname(self._status_file))
         if not os.path.exists(self._status_file):
@@ -92,15 +103,66 @@ class Status(object):
                 return
 
     def save(self):
-        data = {
+        """
+            Writes the status to the file. Inside a transaction, the status
+            is only written when the transaction ends.
+
+            The file is replaced atomically, so after a crash or a power cut
+            it holds either the old or the new status, never a partial one.
+            The plain text stage mirror is replaced along with it.
+        """
+
+        if self._transactions:
+            return
+
+        data = json.dumps({
             'stage': self._stage,
             'username': self._username
-        }
+        })
+
+        # The stage mirror never reads disabled before the status does: a
+        # crash in between only makes the shell run kano-init needlessly.
+        if self._stage == self.DISABLED_STAGE:
+            _replace_file(self._status_file, data, '.status')
+            _replace_file(self._stage_file, self._stage + '\n', '.stage')
+        else:
+            _replace_file(self._stage_file, self._stage + '\n', '.stage')
+            _replace_file(self._status_file, data, '.status')
 
-        with open_locked(self._status_file, 'w', timeout=1.0) as status_file:
-            json.dump(data, status_file)
-            status_file.flush()
-            os.fsync(status_file.fileno())
+        # Make the renames themselves durable
+        dir_fd = os.open(os.path.dirname(self._status_file), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    @contextmanager
+    def transaction(self):
+        """
+            Groups several changes of the status into a single save, which
+            happens when the outermost transaction ends. If the block raises,
+            the changes are dropped and nothing is written.
+
+            Usage:
+
+                with status.transaction():
+                    status.stage = Status.DELETE_USER_STAGE
+                    status.username = name
+        """
+
+        state = (self._stage, self._username)
+        self._transactions += 1
+        try:
+            yield self
+        except:
+            self._transactions -= 1
+            if not self._transactions:
+                self._stage, self._username = state
+            raise
+
+        self._transactions -= 1
+        if not self._transactions:
+            self.save()
 
     # -- stage
     @property
@@ -124,3 +186,78 @@ class Status(object):
     @username.setter
     def username(self, value):
         self._username = str(value)
+
+
+def _replace_file(path, contents, prefix):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=prefix)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(contents)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_stage(status_file):
+    try:
+        with open(status_file, 'r') as status_f:
+            return json.load(status_f)['stage']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def watch_stage(timeout=None, status_file=None):
+    """
+        Yields the current stage, then the new one every time it changes.
+        The status file is watched with inotify, so this blocks until
+        kano-init saves a different stage, rather than polling. Changes
+        saved in quick succession may be seen as one, with the latest stage.
+
+        :param timeout: Seconds without a change after which to stop, None
+                        to watch for as long as the caller keeps iterating.
+        :type timeout: float
+
+        :rtype: generator
+    """
+
+    status_file = status_file or Status._status_file
+    status_dir = os.path.dirname(status_file)
+    status_name = os.path.basename(status_file)
+
+    with Inotify() as inotify:
+        # The status is saved by renaming a new file over the old one, so
+        # the directory is watched rather than the file
+        inotify.add_watch(status_dir, IN_CLOSE_WRITE | IN_MOVED_TO |
+                          IN_DELETE_SELF | IN_MOVE_SELF)
+
+        stage = _read_stage(status_file)
+        yield stage
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+
+            changed = False
+            for event in inotify.read_events(remaining):
+                if event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    return
+                changed = changed or event.name == status_name
+
+            if not changed:
+                continue
+
+            new_stage = _read_stage(status_file)
+            if new_stage is not None and new_stage != stage:
+                stage = new_stage
+                if deadline is not None:
+                    deadline = time.time() + timeout
+                yield stage
@@ -9,11 +9,11 @@
 import os
 import time
 
-from kano.utils.shell import run_cmd
 from kano.utils.hardware import is_model_a, is_model_a_plus, is_model_b_beta, \
     is_model_b, is_model_b_plus, is_model_zero, is_model_zero_w, is_model_2_b
 
 from kano_init.return_codes import RC
+from kano_init.command import run
 
 
 def is_unsupported_rpi():
@@ -36,8 +36,8 @@ def sysrq_power_off():
 
     # Safety check: Do not trigger a reboot if the filesystem has been
     # mounted as read/write to avoid potentially corrupting the SD card.
-    out, err, rc = run_cmd('/bin/mount | /bin/grep "on / " | /bin/grep "ro"')
-    if rc != 0:
+    mounts = run(['/bin/mount']).stdout.splitlines()
+    if not any('on / ' in line and 'ro' in line for line in mounts):
         return
 
     with open('/proc/sys/kernel/sysrq', 'a') as sysrq:
@@ -74,9 +74,9 @@ def main(args):
         return RC.SUCCESS
 
     # Prepare the console and screen to show a console message.
-    run_cmd('/bin/setupcon')
+    run(['/bin/setupcon'])
     # TODO: Change this to `systemctl stop kano-boot-splash` when ready.
-    run_cmd('kano-stop-splash boot')
+    run(['kano-stop-splash', 'boot'])
     # Clear the console screen.
     print_tty('\033\0143')
 
@@ -94,9 +94,9 @@ def main(args):
     # how early during boot this script is executed, the filesystem needs to
     # be temporarily mounted to enable writes.
     if args['--no-detect']:
-        run_cmd('sudo mount -o remount,rw /dev/mmcblk0p2 /')
-        run_cmd('sudo systemctl disable stop-unsupported-rpi-boot.service')
-        run_cmd('sudo mount -o remount,ro /dev/mmcblk0p2 /')
+        run(['mount', '-o', 'remount,rw', '/dev/mmcblk0p2', '/'])
+        run(['systemctl', 'disable', 'stop-unsupported-rpi-boot.service'])
+        run(['mount', '-o', 'remount,ro', '/dev/mmcblk0p2', '/'])
 
     if not args['--dry-run']:
         sysrq_power_off()
@@ -0,0 +1,306 @@
+#
+# systemd_manager.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Changing the systemd setup without a systemctl process per change.
+#
+
+"""
+    The default target is just a symlink, so it is read and swapped here
+    directly rather than through `systemctl set-default`.
+
+    Requests which need the running manager, like daemon reloads and unit
+    jobs, are queued on a SystemdManager and sent together over a single
+    D-Bus connection to the manager's private socket. If the manager can't
+    be reached, e.g. in a chroot, they are run with systemctl instead. Jobs
+    which systemd refused are logged and not retried.
+
+    Usage:
+
+        with SystemdManager() as systemd:
+            systemd.reload()
+            systemd.restart_unit('getty@tty1.service')
+"""
+
+import os
+import time
+
+from kano.logging import logger
+
+from kano_init.paths import get_root_path
+from kano_init.command import run
+from kano_init.dbus_client import DBusConnection, DBusError, \
+    DBusConnectionError, DBUS_TIMEOUT
+
+
+SYSTEMD_BUS_ADDRESS = 'unix:path=/run/systemd/private'
+USER_SYSTEMD_BUS_ADDRESS = 'unix:path=/run/user/{uid}/systemd/private'
+SYSTEMD_UNIT_DIR = '/lib/systemd/system'
+DEFAULT_TARGET_LINK = '/etc/systemd/system/default.target'
+
+MANAGER_PATH = '/org/freedesktop/systemd1'
+MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+UNIT_INTERFACE = 'org.freedesktop.systemd1.Unit'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+# How often units are checked while waiting for them to become active
+ACTIVE_POLL_INTERVAL = 0.05
+
+_SYSTEMCTL_VERBS = {
+    'StartUnit': 'start',
+    'StopUnit': 'stop',
+    'RestartUnit': 'restart'
+}
+
+
+class SystemdError(Exception):
+    pass
+
+
+def swap_symlink(target, link_path):
+    """
+        Points link_path at target, replacing whatever was there with a
+        single rename, so the link is never missing.
+
+        :return: Whether the link was changed.
+        :rtype: bool
+    """
+
+    try:
+        if os.readlink(link_path) == target:
+            return False
+    except OSError:
+        pass
+
+    tmp_path = link_path + '.kano-init'
+    try:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.symlink(target, tmp_path)
+        os.rename(tmp_path, link_path)
+    except OSError as exc:
+        raise SystemdError("Unable to link {} to {}: {}".format(
+            link_path, target, exc))
+
+    return True
+
+
+def get_default_target(root='/'):
+    """
+        Returns the unit default.target points to, e.g. 'graphical.target',
+        or None if it isn't set.
+
+        :rtype: str
+    """
+
+    try:
+        return os.path.basename(
+            os.readlink(get_root_path(root, DEFAULT_TARGET_LINK)))
+    except OSError:
+        return None
+
+
+def set_default_target(target, root='/'):
+    """
+        Points default.target at the target, the same as
+        `systemctl set-default`, replacing the link with a single rename.
+        The default target is only used at boot, so the running manager
+        doesn't need a reload.
+
+        :param target: The name of the target, e.g. 'graphical.target'.
+        :type target: str
+
+        :return: Whether the link was changed.
+        :rtype: bool
+    """
+
+    link_path = get_root_path(root, DEFAULT_TARGET_LINK)
+    unit_path = os.path.join(SYSTEMD_UNIT_DIR, target)
+
+    if get_default_target(root) == target:
+        return False
+
+    if not os.path.exists(get_root_path(root, unit_path)):
+        raise SystemdError("Unit {} not found".format(target))
+
+    swap_symlink(unit_path, link_path)
+    logger.info("Default target set to {}".format(target))
+
+    return True
+
+
+class SystemdManager(object):
+    """
+        Requests for the systemd manager, sent all at once by flush(). The
+        daemon is reloaded at most once, before any of the unit jobs. Jobs
+        are queued without waiting for them to finish, like
+        `systemctl --no-block`, unless flush() is asked to wait.
+    """
+
+    def __init__(self, address=SYSTEMD_BUS_ADDRESS, timeout=DBUS_TIMEOUT,
+                 systemctl=None):
+        """
+            :param address: The D-Bus address of the manager.
+            :type address: str
+
+            :param systemctl: The systemctl command used when falling back,
+                              e.g. with --user for a user manager.
+            :type systemctl: list
+        """
+
+        self.address = address
+        self.timeout = timeout
+        self.systemctl = systemctl or ['systemctl']
+
+        # How long each unit took to become active in the last flush() which
+        # waited for them, None for the units which didn't
+        self.latencies = {}
+
+        # Why systemd refused the requests of the last flush(), by unit, or
+        # 'daemon-reload' for the reload
+        self.errors = {}
+
+        self._reload = False
+        self._jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def reload(self):
+        self._reload = True
+
+    def start_unit(self, unit, mode='replace'):
+        self._jobs.append(('StartUnit', unit, mode))
+
+    def stop_unit(self, unit, mode='replace'):
+        self._jobs.append(('StopUnit', unit, mode))
+
+    def restart_unit(self, unit, mode='replace'):
+        self._jobs.append(('RestartUnit', unit, mode))
+
+    def flush(self, wait_timeout=None):
+        """
+            Sends the queued requests.
+
+            :param wait_timeout: Seconds to wait for the started units to
+                                 become active, None not to wait. Their
+                                 latencies are then set in self.latencies.
+            :type wait_timeout: float
+
+            :return: The number of requests sent.
+            :rtype: int
+        """
+
+        count = len(self._jobs) + int(self._reload)
+        if not count:
+            return 0
+
+        self.latencies = {}
+        self.errors = {}
+        try:
+            self._flush_dbus(wait_timeout)
+        except DBusConnectionError as exc:
+            # Only the requests which weren't sent are left
+            logger.warn("Unable to reach systemd over D-Bus, falling back to "
+                        "systemctl: {}".format(exc))
+            self._flush_systemctl()
+
+        return count
+
+    def _flush_dbus(self, wait_timeout):
+        with DBusConnection(self.address, self.timeout) as bus:
+            if self._reload:
+                serial = bus.send(MANAGER_PATH, MANAGER_INTERFACE, 'Reload')
+                self._reload = False
+                try:
+                    bus.wait_reply(serial)
+                except DBusError as exc:
+                    logger.error("Unable to reload systemd: {}".format(exc))
+                    self.errors['daemon-reload'] = str(exc)
+
+            # Jobs are dropped from the queue as soon as they are sent, so
+            # they are never run a second time by the fallback
+            sent = []
+            while self._jobs:
+                method, unit, mode = self._jobs[0]
+                serial = bus.send(MANAGER_PATH, MANAGER_INTERFACE, method,
+                                  'ss', (unit, mode))
+                self._jobs.pop(0)
+                sent.append((method, unit, time.time(), serial))
+
+            for method, unit, _, serial in sent:
+                try:
+                    bus.wait_reply(serial)
+                except DBusError as exc:
+                    logger.error("Unable to {} {}: {}".format(
+                        _SYSTEMCTL_VERBS[method], unit, exc))
+                    self.errors[unit] = str(exc)
+
+            if wait_timeout is None:
+                return
+
+            units = []
+            for method, unit, started, _ in sent:
+                if unit in self.errors:
+                    self.latencies[unit] = None
+                elif method != 'StopUnit':
+                    units.append((unit, started))
+
+            try:
+                self._wait_active(bus, units, wait_timeout)
+            except DBusError as exc:
+                logger.warn("Unable to track the units: {}".format(exc))
+                for unit, _ in units:
+                    self.latencies.setdefault(unit, None)
+
+    def _wait_active(self, bus, units, timeout):
+        deadline = time.time() + timeout
+
+        paths = {}
+        for unit, started in units:
+            paths[unit] = bus.call(MANAGER_PATH, MANAGER_INTERFACE, 'GetUnit',
+                                   's', (unit,))[0]
+
+        pending = dict(units)
+        while pending:
+            serials = [
+                (unit, bus.send(paths[unit], PROPERTIES_INTERFACE, 'Get', 'ss',
+                                (UNIT_INTERFACE, 'ActiveState')))
+                for unit in pending
+            ]
+            for unit, serial in serials:
+                state = bus.wait_reply(serial)[0]
+                if state == 'active':
+                    self.latencies[unit] = time.time() - pending.pop(unit)
+                elif state == 'failed':
+                    logger.warn("{} failed to start".format(unit))
+                    self.latencies[unit] = None
+                    del pending[unit]
+
+            if pending and time.time() >= deadline:
+                logger.warn("{} not active after {}s".format(
+                    ', '.join(sorted(pending)), timeout))
+                for unit in pending:
+                    self.latencies[unit] = None
+                break
+
+            if pending:
+                time.sleep(ACTIVE_POLL_INTERVAL)
+
+    def _flush_systemctl(self):
+        systemctl = self.systemctl
+
+        if self._reload:
+            run(systemctl + ['daemon-reload'], log=True)
+            self._reload = False
+
+        for method, unit, mode in self._jobs:
+            run(systemctl + ['--no-block', '--job-mode={}'.format(mode),
+                             _SYSTEMCTL_VERBS[method], unit], log=True)
+        self._jobs = []
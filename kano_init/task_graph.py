@@ -0,0 +1,193 @@
+#
+# task_graph.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Running steps with dependencies concurrently, resumable after a crash.
+#
+
+"""
+    A task graph is a set of named steps, each with the steps it depends
+    on. Every step starts in a pool of worker threads as soon as all of
+    its dependencies have finished, so independent steps run side by side.
+
+    With a journal, every finished step is recorded on disk. When the
+    graph is run again after a crash or a power cut, the steps from the
+    journal are skipped and only the rest are run. The journal is removed
+    once the whole graph has finished.
+
+    Usage:
+
+        graph = TaskGraph(journal_path)
+        graph.add('delete-users', delete_users)
+        graph.add('autostart', reconfigure, deps=['delete-users'])
+        graph.run()
+"""
+
+import os
+import json
+import time
+import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from kano.logging import logger
+
+
+TASK_WORKERS = 4
+
+
+class TaskError(Exception):
+    pass
+
+
+class TaskGraph(object):
+    """
+        Steps added with their dependencies, which have to be added first.
+    """
+
+    def __init__(self, journal_path=None, workers=TASK_WORKERS):
+        """
+            :param journal_path: Where the finished steps are recorded, None
+                                 not to keep a journal.
+            :type journal_path: str
+        """
+
+        self.journal_path = journal_path
+        self.workers = workers
+
+        # How long each step took, in seconds, including the ones recorded
+        # in the journal by a previous run
+        self.durations = {}
+
+        self._tasks = OrderedDict()
+
+    def add(self, name, func, deps=()):
+        """
+            :param func: Called without arguments to run the step.
+            :param deps: The names of the steps to finish before this one.
+            :type deps: list
+        """
+
+        if name in self._tasks:
+            raise TaskError("The task {} was added already".format(name))
+
+        for dep in deps:
+            if dep not in self._tasks:
+                raise TaskError("{} depends on the unknown task {}".format(
+                    name, dep))
+
+        self._tasks[name] = (func, tuple(deps))
+
+    def _load_journal(self):
+        if not self.journal_path:
+            return {}
+
+        try:
+            with open(self.journal_path, 'r') as journal_file:
+                finished = json.load(journal_file)['finished']
+        except (IOError, ValueError, KeyError, TypeError):
+            return {}
+
+        return dict((name, duration)
+                    for name, duration in finished.iteritems()
+                    if name in self._tasks)
+
+    def _save_journal(self, finished):
+        if not self.journal_path:
+            return
+
+        tmp_path = self.journal_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as journal_file:
+                json.dump({'finished': finished}, journal_file)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.rename(tmp_path, self.journal_path)
+        except (IOError, OSError) as exc:
+            logger.warn("Unable to update the journal {}: {}".format(
+                self.journal_path, exc))
+
+    def clear_journal(self):
+        if not self.journal_path:
+            return
+
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+
+    def _run_task(self, name, func, results):
+        started = time.time()
+        error = None
+        try:
+            func()
+        except Exception as exc:
+            logger.error("The task {} failed: {}".format(name, exc))
+            error = exc
+
+        results.put((name, time.time() - started, error))
+
+    def run(self):
+        """
+            Runs the steps which haven't finished yet. When a step fails,
+            the steps that depend on it are skipped, the others still run.
+
+            :return: How long each step took, in seconds.
+            :rtype: dict
+        """
+
+        finished = self._load_journal()
+        if finished:
+            logger.info("Resuming after {}".format(', '.join(sorted(finished))))
+
+        self.durations = dict(finished)
+        pending = OrderedDict((name, task)
+                              for name, task in self._tasks.iteritems()
+                              if name not in finished)
+        failed = set()
+        running = set()
+        results = Queue.Queue()
+
+        pool = ThreadPool(max(1, min(self.workers, len(pending))))
+        try:
+            while pending or running:
+                for name, (func, deps) in pending.items():
+                    if any(dep in failed for dep in deps):
+                        logger.warn("Skipping the task {}".format(name))
+                        failed.add(name)
+                        del pending[name]
+                    elif all(dep in finished for dep in deps):
+                        pool.apply_async(self._run_task,
+                                         (name, func, results))
+                        running.add(name)
+                        del pending[name]
+
+                if not running:
+                    break
+
+                name, duration, error = results.get()
+                running.discard(name)
+                self.durations[name] = duration
+
+                if error is None:
+                    finished[name] = duration
+                    self._save_journal(finished)
+                else:
+                    failed.add(name)
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info("Tasks finished: {}".format(', '.join(
+            '{} {:.3f}s'.format(name, self.durations[name])
+            for name in self._tasks if name in self.durations)))
+
+        if failed:
+            raise TaskError("Unable to finish {}".format(
+                ', '.join(name for name in self._tasks if name in failed)))
+
+        self.clear_journal()
+
+        return self.durations
@@ -7,7 +7,6 @@
 # The task of removing a user at boot.
 #
 
-import os
 from kano.logging import logger
 from kano.utils import get_user_unsudoed
 
@@ -15,6 +14,7 @@ from kano_init.status import Status, StatusError
 from kano_init.utils import disable_ldm_autostart, \
     unset_ldm_autologin, reconfigure_autostart_policy, start_lightdm
 from kano_init.user import delete_user, user_exists, get_group_members
+from kano_init.command import run
 
 
 def schedule_delete_user(name=None):
@@ -30,8 +30,7 @@ def schedule_delete_user(name=None):
 
     # Remove the user from the kano users
     # so it is not considered when reconfiguring the login
-    cmd='usermod {} -G {}'.format(name, name)
-    os.system(cmd)
+    run(['usermod', '-G', name, name])
 
     reconfigure_autostart_policy()
 
@@ -49,7 +48,8 @@ def do_delete_user(flow_param):
 
     user = status.username
     if user_exists(user):
-        delete_user(user)
+        # Don't hold the boot up while the home directory is unlinked
+        delete_user(user, defer_home=True)
     else:
         logger.warn("Attempt to delete nonexisting user ({})".format(user))
 
@@ -15,11 +15,14 @@
 
 import re
 import os
+from collections import OrderedDict
 
 from kano.colours import decorate_with_preset
-from kano.utils import run_cmd, ensure_dir, delete_dir
+from kano.utils import ensure_dir, delete_dir
+from kano.logging import logger
 
 from kano_init.paths import SUBSHELLRC_PATH
+from kano_init.command import run
 from kano_init.terminal import typewriter_echo, clear_screen, user_input, \
     write_flush, LEFT_PADDING, set_overscan, reset_overscan
 from kano_init.status import Status
@@ -27,7 +30,8 @@ from kano_init.ascii_art.matrix import matrix
 from kano_init.ascii_art.matrix_binary import matrix_binary
 from kano_init.ascii_art.rabbit import rabbit
 from kano_init.ascii_art.binary import binary
-from kano_init.user import user_exists, create_user, make_username_unique
+from kano_init.user import user_exists, create_user, make_username_unique, \
+    get_username_suggestions
 from kano_init.utils import reconfigure_autostart_policy, set_ldm_autologin, \
     set_dashboard_onboarding, start_lightdm
 
@@ -39,12 +43,9 @@ def do_username_stage(flow_params):
     Prompt for a username and create it as a new Kano system user
     """
 
-    if flow_params.get('skip'):
+    if flow_params.skip:
         # Skip the interactive flow and create the user automatically
-        if 'user' in flow_params:
-            username = flow_params['user']
-        else:
-            username = 'kano'
+        username = flow_params.user or 'kano'
 
         username = make_username_unique(username)
     else:
@@ -77,7 +78,7 @@ def do_username_stage(flow_params):
 def do_lightup_stage(flow_params):
     init_status = Status.get_instance()
 
-    if not flow_params.get('skip', False):
+    if not flow_params.skip:
         clear_screen()
 
         # TODO: username is raw str, encode?
@@ -100,7 +101,7 @@ def do_lightup_stage(flow_params):
 def do_switch_stage(flow_params):
     init_status = Status.get_instance()
 
-    if not flow_params.get('skip', False):
+    if not flow_params.skip:
         clear_screen()
 
         try:
@@ -115,7 +116,7 @@ def do_switch_stage(flow_params):
 def do_letters_stage(flow_params):
     init_status = Status.get_instance()
 
-    if not flow_params.get('skip', False):
+    if not flow_params.skip:
 
         # Initially we will jump to this step on completion
         init_status.stage = Status.WHITE_RABBIT_STAGE
@@ -157,11 +158,11 @@ def do_letters_stage(flow_params):
                 set_dashboard_onboarding(init_status.username, run_it=False)
 
                 # Skip Story Mode onboarding
-                run_cmd(
-                    'su {} -c "/usr/bin/luajit '
-                    '/usr/share/kano-overworld/bin/skip-onboarding.lua"'
-                    .format(init_status.username)
-                )
+                run([
+                    'su', init_status.username, '-c',
+                    '/usr/bin/luajit '
+                    '/usr/share/kano-overworld/bin/skip-onboarding.lua'
+                ])
 
                 # Take kano-init to the final step
                 init_status.stage = Status.FINAL_STAGE
@@ -190,7 +191,7 @@ def do_letters_stage(flow_params):
 def do_white_rabbit_stage(flow_params):
     init_status = Status.get_instance()
 
-    if not flow_params.get('skip', False):
+    if not flow_params.skip:
         clear_screen()
         try:
             rabbit(1, 'left-to-right')
@@ -208,9 +209,8 @@ def do_white_rabbit_stage(flow_params):
         # TODO: open shell
         rabbithole = "/home/{}/rabbithole".format(init_status.username)
         ensure_dir(rabbithole)
-        cmd = "sudo -u {} -H bash --init-file {}".format(init_status.username,
-                                                         SUBSHELLRC_PATH)
-        os.system(cmd)
+        run(['sudo', '-u', init_status.username, '-H', 'bash', '--init-file',
+             SUBSHELLRC_PATH], stdout=None, stderr=None)
         delete_dir(rabbithole)
 
         reset_overscan()
@@ -226,14 +226,16 @@ def do_white_rabbit_stage(flow_params):
 def do_love_stage(flow_params):
     init_status = Status.get_instance()
 
-    if not flow_params.get('skip', False):
+    if not flow_params.skip:
         clear_screen()
         # kanoOverworld needs to run as the user
         # to access the savefile correctly.
-        cmd = 'su {} -c "/usr/bin/love /usr/bin/kanoOverworld.love" >>/var/log/kanoOverworld.log 2>&1'.format(init_status.username)
+        cmd = ['su', init_status.username, '-c',
+               '/usr/bin/love /usr/bin/kanoOverworld.love']
 
         reset_overscan()
-        os.system(cmd)
+        with open('/var/log/kanoOverworld.log', 'a') as log_file:
+            run(cmd, stdout=log_file, stderr=log_file)
         set_overscan()
 
     init_status.stage = Status.FINAL_STAGE
@@ -258,11 +260,60 @@ def do_final_stage(flow_params):
     # Start Lightdm with a splash screen if available,
     # Or do it the classy way otherwise (soft dependency).
     if os.path.isfile('/usr/bin/kano-dashboard-lightdm'):
-        run_cmd('/usr/bin/kano-dashboard-lightdm')
+        run(['/usr/bin/kano-dashboard-lightdm'])
     else:
         start_lightdm()
 
 
+# The stages of the flow, in the order they run
+FLOW_STAGES = OrderedDict([
+    (Status.USERNAME_STAGE, do_username_stage),
+    (Status.LIGHTUP_STAGE, do_lightup_stage),
+    (Status.SWITCH_STAGE, do_switch_stage),
+    (Status.LETTERS_STAGE, do_letters_stage),
+    (Status.WHITE_RABBIT_STAGE, do_white_rabbit_stage),
+    (Status.LOVE_STAGE, do_love_stage),
+    (Status.FINAL_STAGE, do_final_stage)
+])
+
+# The stages which only move the flow on when it is skipped
+_SKIPPABLE_STAGES = [
+    Status.LIGHTUP_STAGE,
+    Status.SWITCH_STAGE,
+    Status.LETTERS_STAGE,
+    Status.WHITE_RABBIT_STAGE,
+    Status.LOVE_STAGE
+]
+
+
+def do_flow(flow_params, stop_stage=None):
+    """
+    Runs the stages of the flow from the current one until the flow ends or
+    stop_stage is reached. When the flow is skipped, the stages in between
+    the user creation and the final stage are saved in a single transaction,
+    they are safe to run again if it is lost.
+    """
+
+    init_status = Status.get_instance()
+
+    def run_stage():
+        stage = init_status.stage
+        logger.info("Running the {} stage".format(stage))
+        FLOW_STAGES[stage](flow_params)
+        return init_status.stage != stage
+
+    while init_status.stage in FLOW_STAGES and \
+            init_status.stage != stop_stage:
+        if flow_params.skip and init_status.stage in _SKIPPABLE_STAGES:
+            with init_status.transaction():
+                while init_status.stage in _SKIPPABLE_STAGES and \
+                        init_status.stage != stop_stage:
+                    if not run_stage():
+                        return
+        elif not run_stage():
+            return
+
+
 def _validate_username(username):
     '''
     Validates a username for special characters and uniqueness.
@@ -279,6 +330,15 @@ def _validate_username(username):
         errormsg=_("Just one word, letters or numbers! Try again.")
     elif user_exists(username):
         errormsg=_("This one is already taken! Try again.")
+
+        suggestions = [
+            name for name in get_username_suggestions(username, 3)
+            if len(name) <= 25
+        ]
+        if suggestions:
+            errormsg += ' ' + _("How about {string_usernames}?").format(
+                string_usernames=', '.join(suggestions)
+            )
     elif len(username) > 25:
         errormsg=_("This one is too long by {number} characters! Try again.").format(
             number=len(username) - 25
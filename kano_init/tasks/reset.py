@@ -7,12 +7,14 @@
 # The task of reseting the kit to it's original state.
 #
 
-import os
-
+from kano_init.paths import RESET_JOURNAL_PATH
 from kano_init.status import Status, StatusError
-from kano_init.utils import disable_ldm_autostart, \
-    unset_ldm_autologin, restore_factory_settings, reconfigure_autostart_policy
+from kano_init.utils import disable_ldm_autostart, unset_ldm_autologin, \
+    remove_wifi_cache, restore_default_settings, reconfigure_autostart_policy
 from kano_init.user import delete_all_users
+from kano_init.home_trash import schedule_gc
+from kano_init.task_graph import TaskGraph
+from kano_init.command import run
 
 
 def schedule_reset():
@@ -26,21 +28,60 @@ def schedule_reset():
     disable_ldm_autostart()
     unset_ldm_autologin()
 
+    # Start the new reset from scratch
+    TaskGraph(RESET_JOURNAL_PATH).clear_journal()
+
     init_status.stage = Status.RESET_STAGE
     init_status.save()
 
     print _("kano-init RESET scheduled for the next system reboot").encode('utf8')
 
 
-def do_reset(flow_param):
-    restore_factory_settings()
-    delete_all_users()
-    reconfigure_autostart_policy()
+def get_reset_graph(journal_path=RESET_JOURNAL_PATH):
+    '''
+    Returns the steps of the reset. The settings and the users are reset
+    concurrently. The stage only moves on once everything else is done,
+    so a reset interrupted by a crash carries on from the journal on the
+    next boot.
+    '''
+    home_removals = []
+
+    def delete_users():
+        # The home directories are moved to the trash straight away and
+        # removed in the background while the kit is reconfigured.
+        home_removals.append(delete_all_users(wait=False, defer_homes=True))
+
+    def remove_homes():
+        # Only the homes which couldn't be moved to the trash
+        if home_removals:
+            home_removals[0].wait()
+
+        # Leftovers from a reset which was interrupted are left to the
+        # garbage collector too
+        schedule_gc()
 
-    status = Status.get_instance()
-    status.stage = Status.ADD_USER_STAGE
-    status.save()
+    def set_add_user_stage():
+        status = Status.get_instance()
+        status.stage = Status.ADD_USER_STAGE
+        status.save()
+
+    graph = TaskGraph(journal_path)
+    graph.add('wifi-cache', remove_wifi_cache)
+    graph.add('default-settings', restore_default_settings)
+    graph.add('delete-users', delete_users)
+    graph.add('remove-homes', remove_homes, deps=['delete-users'])
+    graph.add('autostart', reconfigure_autostart_policy,
+              deps=['delete-users'])
+    graph.add('add-user-stage', set_add_user_stage,
+              deps=['wifi-cache', 'default-settings', 'remove-homes',
+                    'autostart'])
+
+    return graph
+
+
+def do_reset(flow_param):
+    get_reset_graph().run()
 
     # Reboot before initiating the next stage to make sure the
     # settings are correct.
-    os.system('kano-checked-reboot kano-init systemctl reboot')
+    run(['kano-checked-reboot', 'kano-init', 'systemctl', 'reboot'])
@@ -0,0 +1,575 @@
+#
+# temp_users.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Temporary Kano users, e.g. for the Onboarding or demo and kiosk kits.
+#
+
+"""
+    Temporary users are named "kano" followed by a random hex number.
+
+    A warm pool of them can be kept ready, so `kano-init create-temp-user`
+    only has to claim one instead of creating it while the caller waits.
+    Pooled users are complete accounts which are not yet members of the
+    kanousers group, so the rest of kano-init ignores them until they are
+    claimed. The pool is topped up in the background after every claim.
+
+    Claimed users expire after TEMP_USER_TTL days. The expiry is kept in a
+    ledger of kano-init rather than in the shadow database, where PAM would
+    lock the account out even after it was renamed into a regular user.
+    `kano-init reap-temp-users` finds the expired accounts in one pass over
+    the ledger and deletes them in bulk.
+"""
+
+import os
+import re
+import json
+import time
+import errno
+import fcntl
+import random
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+from kano.logging import logger
+
+from kano_init.paths import TEMP_USER_POOL_PATH, \
+    TEMP_USER_RESERVATIONS_PATH, TEMP_USER_EXPIRY_PATH, get_root_path
+from kano_init.account_db import AccountDB, AccountDBError
+from kano_init.uid_allocator import UidAllocator, UidAllocationError
+from kano_init import user
+from kano_init.command import run
+from kano_init.user import AccountIndex, HomeRemoval, user_exists, \
+    create_user, create_users, get_process_uids, get_root_args, \
+    DEFAULT_USER_GROUPS
+
+
+# Reservations older than this are considered abandoned, in seconds
+RESERVATION_TIMEOUT = 10 * 60
+
+# How many days a temporary user lives, None to keep them forever
+TEMP_USER_TTL = 1
+
+# Keep the homes of temporary users on tmpfs rather than on the SD card
+TEMP_USER_HOME_TMPFS = False
+
+TEMP_USERNAME_RE = re.compile(r'^kano[0-9a-f]{8,9}$')
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+@contextmanager
+def locked_ledger(ledger_path):
+    """
+        Yields the contents of a JSON ledger while holding an exclusive lock
+        on it, and replaces the ledger atomically with the modified data
+        when the block succeeds.
+
+        :param ledger_path: Path to the ledger file.
+        :type ledger_path: str
+
+        :rtype: dict
+    """
+
+    ledger_dir = os.path.dirname(ledger_path)
+    if not os.path.isdir(ledger_dir):
+        os.makedirs(ledger_dir)
+
+    lock_fd = os.open(ledger_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+        try:
+            with open(ledger_path, 'r') as ledger_file:
+                data = json.load(ledger_file)
+        except (IOError, ValueError):
+            data = {}
+
+        original = json.dumps(data, sort_keys=True)
+        yield data
+
+        if json.dumps(data, sort_keys=True) != original:
+            fd, tmp_path = tempfile.mkstemp(dir=ledger_dir, prefix='.ledger')
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+            os.rename(tmp_path, ledger_path)
+    finally:
+        os.close(lock_fd)
+
+
+def random_temp_username():
+    """
+        Returns a random name for a temporary user, e.g. "kano3faf5dcd".
+    """
+
+    return 'kano%08x' % random.randrange(10**10)
+
+
+def _get_pool_groups():
+    return [group for group in DEFAULT_USER_GROUPS.split(',')
+            if group != 'kanousers']
+
+
+def _get_deadline():
+    if TEMP_USER_TTL is None:
+        return None
+
+    return time.time() + TEMP_USER_TTL * SECONDS_PER_DAY
+
+
+def _label_claimed_user(username, root='/'):
+    """
+        Turns a pooled user into a regular kano user and starts its TTL.
+    """
+
+    if user.USE_NATIVE_ACCOUNT_DB:
+        try:
+            with AccountDB(root) as account_db:
+                account_db.add_group('kanousers')
+                account_db.add_group_member('kanousers', username)
+            set_expiry(username, _get_deadline(), root=root)
+            return
+        except AccountDBError as exc:
+            logger.warn("Falling back to shadow-utils: {}".format(exc))
+
+    root_args = get_root_args(root)
+    run(['groupadd'] + root_args + ['-f', 'kanousers'], log=True)
+    result = run(['usermod'] + root_args + ['-a', '-G', 'kanousers', username],
+                 log=True)
+    if result.returncode != 0:
+        raise user.UserError("Unable to add {} to kanousers".format(username))
+
+    set_expiry(username, _get_deadline(), root=root)
+
+
+def set_expiry(username, deadline, root='/'):
+    """
+        Sets when a temporary user is reaped. The account itself
+        never expires, so it keeps working once it is renamed.
+
+        :param deadline: Seconds since the epoch, None to never expire.
+        :type deadline: float
+    """
+
+    ledger_path = get_root_path(root, TEMP_USER_EXPIRY_PATH)
+
+    with locked_ledger(ledger_path) as ledger:
+        users = ledger.setdefault('users', {})
+        if deadline is None:
+            users.pop(username, None)
+            return
+
+        entry = AccountIndex.get_instance(root).users.get(username)
+        if entry is None:
+            raise user.UserError(
+                "The user '{}' doesn't exist".format(username))
+
+        users[username] = {'uid': entry.uid, 'deadline': deadline}
+
+
+def forget_temp_user(username, root='/'):
+    """
+        Drops the expiry of a user, e.g. once it is renamed into a regular
+        user or deleted.
+    """
+
+    ledger_path = get_root_path(root, TEMP_USER_EXPIRY_PATH)
+    if not os.path.exists(ledger_path):
+        return
+
+    with locked_ledger(ledger_path) as ledger:
+        ledger.get('users', {}).pop(username, None)
+
+
+def claim_pooled_user(root='/'):
+    """
+        Takes a user out of the warm pool.
+
+        :return: The username, None if the pool is empty.
+        :rtype: str
+    """
+
+    pool_path = get_root_path(root, TEMP_USER_POOL_PATH)
+    if not os.path.exists(pool_path):
+        return None
+
+    username = None
+    with locked_ledger(pool_path) as pool:
+        users = pool.get('users', [])
+        while users:
+            candidate = users.pop()
+            if user_exists(candidate, root=root):
+                username = candidate
+                break
+        pool['users'] = users
+
+    if username:
+        try:
+            _label_claimed_user(username, root)
+        except user.UserError as exc:
+            logger.error("Unable to claim {}: {}".format(username, exc))
+            _discard_pooled_user(username, root)
+            return None
+
+        logger.info("Claimed the pooled temporary user {}".format(username))
+
+    return username
+
+
+def _discard_pooled_user(username, root):
+    """
+        Deletes a pooled user which couldn't be claimed, or puts it back in
+        the pool if even that fails, so the account is never left behind
+        outside of both the pool and the expiry ledger.
+    """
+
+    try:
+        user.delete_user(username, defer_home=True, root=root)
+        forget_temp_user(username, root=root)
+        return
+    except (user.UserError, AccountDBError, IOError, OSError) as exc:
+        logger.error("Unable to delete {}: {}".format(username, exc))
+
+    pool_path = get_root_path(root, TEMP_USER_POOL_PATH)
+    with locked_ledger(pool_path) as pool:
+        pool['users'] = pool.get('users', []) + [username]
+
+
+def drain_pool(root='/'):
+    """
+        Takes every user out of the warm pool, e.g. to delete them when the
+        kit is reset. The size of the pool is kept.
+
+        :return: The usernames which were in the pool.
+        :rtype: list
+    """
+
+    pool_path = get_root_path(root, TEMP_USER_POOL_PATH)
+    if not os.path.exists(pool_path):
+        return []
+
+    with locked_ledger(pool_path) as pool:
+        usernames = pool.get('users', [])
+        pool['users'] = []
+
+    return usernames
+
+
+def get_pool_size(root='/'):
+    """
+        Returns how many temporary users the pool should hold.
+    """
+
+    pool_path = get_root_path(root, TEMP_USER_POOL_PATH)
+    try:
+        with open(pool_path, 'r') as pool_file:
+            return int(json.load(pool_file).get('size', 0))
+    except (IOError, ValueError, TypeError, AttributeError):
+        return 0
+
+
+def refill_pool(size=None, root='/'):
+    """
+        Tops up the warm pool of temporary users. Only one refill runs at a
+        time, concurrent calls return straight away.
+
+        :param size: How many users the pool should hold, the size stored
+                     with the pool is used if None.
+        :type size: int
+
+        :return: The number of users created.
+        :rtype: int
+    """
+
+    pool_path = get_root_path(root, TEMP_USER_POOL_PATH)
+    pool_dir = os.path.dirname(pool_path)
+    if not os.path.isdir(pool_dir):
+        os.makedirs(pool_dir)
+
+    refill_fd = os.open(pool_path + '.refill', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(refill_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.info("The temporary user pool is being refilled already")
+            return 0
+
+        with locked_ledger(pool_path) as pool:
+            if size is not None:
+                pool['size'] = size
+            size = pool.get('size', 0)
+
+            pool['users'] = [name for name in pool.get('users', [])
+                             if user_exists(name, root=root)]
+            missing = size - len(pool['users'])
+
+        if missing <= 0:
+            return 0
+
+        usernames = set()
+        while len(usernames) < missing:
+            username = random_temp_username()
+            if not user_exists(username, root=root):
+                usernames.add(username)
+
+        results = create_users(sorted(usernames), groups=_get_pool_groups(),
+                               root=root)
+        created = [name for name, error in results.iteritems() if not error]
+
+        with locked_ledger(pool_path) as pool:
+            pool['users'] = pool.get('users', []) + created
+
+        return len(created)
+    finally:
+        os.close(refill_fd)
+
+
+def spawn_pool_refill(size=None):
+    """
+        Refills the pool from a detached, low priority kano-init process.
+    """
+
+    cmd = ['kano-init', 'refill-temp-pool']
+    if size is not None:
+        cmd.append(str(size))
+
+    def detach():
+        os.setsid()
+        os.nice(10)
+
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=detach)
+
+
+def _is_live_reservation(reservation):
+    if time.time() - reservation.get('time', 0) > RESERVATION_TIMEOUT:
+        return False
+
+    try:
+        os.kill(reservation['pid'], 0)
+    except OSError as exc:
+        return exc.errno != errno.ESRCH
+    except (KeyError, TypeError):
+        return False
+
+    return True
+
+
+def get_reserved_uids(root='/'):
+    """
+        Returns the uids reserved for temporary users which are still being
+        created, so no other account takes them. The ledger is replaced
+        atomically, so it is read without taking its lock.
+
+        :rtype: set
+    """
+
+    ledger_path = get_root_path(root, TEMP_USER_RESERVATIONS_PATH)
+    try:
+        with open(ledger_path, 'r') as ledger_file:
+            reservations = json.load(ledger_file).get('reservations', {})
+    except (IOError, ValueError, AttributeError):
+        return set()
+
+    return set(reservation['uid']
+               for reservation in reservations.itervalues()
+               if _is_live_reservation(reservation) and 'uid' in reservation)
+
+
+@contextmanager
+def _locked_accounts(root):
+    """
+        Holds the lock of the account databases, so no other process hands
+        out uids in the meantime.
+    """
+
+    account_db = None
+    if user.USE_NATIVE_ACCOUNT_DB:
+        try:
+            account_db = AccountDB(root).open()
+        except AccountDBError as exc:
+            logger.warn("Unable to lock the accounts: {}".format(exc))
+
+    try:
+        yield
+    finally:
+        if account_db is not None:
+            account_db.close()
+
+
+def reserve_temp_user(root='/'):
+    """
+        Atomically hands out a free name and uid for a new temporary user.
+
+        The reservations are kept in a ledger guarded by a file lock, so
+        concurrent callers never get the same name or uid and can create
+        their accounts in parallel. Reservations of processes that died
+        are dropped.
+
+        The uid is picked and recorded while holding the lock of the account
+        databases too, and the uid allocators of kano_init.user skip the
+        reserved uids, so other accounts created meanwhile, e.g. by a pool
+        refill, don't take it either.
+
+        :return: The username and the uid.
+        :rtype: tuple
+    """
+
+    ledger_path = get_root_path(root, TEMP_USER_RESERVATIONS_PATH)
+
+    with _locked_accounts(root), locked_ledger(ledger_path) as ledger:
+        reservations = dict(
+            (name, reservation)
+            for name, reservation in ledger.get('reservations', {}).iteritems()
+            if _is_live_reservation(reservation)
+        )
+
+        index = AccountIndex.get_instance(root)
+        allocator = UidAllocator(
+            index.uids.union(r['uid'] for r in reservations.itervalues()),
+            reserved_ranges=user.RESERVED_UID_RANGES
+        )
+
+        try:
+            uid = allocator.next_uid()
+        except UidAllocationError as exc:
+            raise user.UserError(str(exc))
+
+        username = random_temp_username()
+        while username in index.users or username in reservations or \
+                username in index.groups:
+            username = random_temp_username()
+
+        reservations[username] = {
+            'uid': uid,
+            'pid': os.getpid(),
+            'time': time.time()
+        }
+        ledger['reservations'] = reservations
+
+    return username, uid
+
+
+def release_temp_user(username, root='/'):
+    """
+        Drops the reservation of a temporary user, once it is created or
+        when its creation failed.
+    """
+
+    ledger_path = get_root_path(root, TEMP_USER_RESERVATIONS_PATH)
+
+    with locked_ledger(ledger_path) as ledger:
+        ledger.get('reservations', {}).pop(username, None)
+
+
+def create_temporary_user(tmpfs_home=None, root='/'):
+    '''
+    Creates a temporary Kano user on the system, or claims one from the
+    warm pool when it isn't empty.
+    The home is kept on tmpfs when tmpfs_home is set, TEMP_USER_HOME_TMPFS
+    is used if it is None. The pool is bypassed for those users.
+    Returns the newly created username, raises UserError on error.
+    '''
+    if tmpfs_home is None:
+        tmpfs_home = TEMP_USER_HOME_TMPFS
+
+    username = None if tmpfs_home else claim_pooled_user(root=root)
+    if username:
+        if root == '/':
+            spawn_pool_refill()
+        return username
+
+    # Creates a new temporary username in the form "kano3faf5dcd".
+    username, uid = reserve_temp_user(root=root)
+    try:
+        create_user(username, uid=uid, tmpfs_home=tmpfs_home, root=root)
+    finally:
+        release_temp_user(username, root=root)
+
+    set_expiry(username, _get_deadline(), root=root)
+
+    if root == '/' and get_pool_size(root) > 0:
+        spawn_pool_refill()
+
+    return username
+
+
+def find_expired_temp_users(root='/'):
+    """
+        Finds the temporary users whose TTL ran out, with a single pass over
+        the expiry ledger. Users that still have processes running are left
+        alone.
+
+        :return: The expired users and the ones skipped because they are
+                 busy.
+        :rtype: tuple
+    """
+
+    index = AccountIndex.get_instance(root)
+    now = time.time()
+
+    ledger_path = get_root_path(root, TEMP_USER_EXPIRY_PATH)
+    try:
+        with open(ledger_path, 'r') as ledger_file:
+            users = json.load(ledger_file).get('users', {})
+    except (IOError, ValueError, AttributeError):
+        users = {}
+
+    expired = []
+    for name, expiry in sorted(users.iteritems()):
+        # Entries left behind by renamed or recreated accounts don't count
+        if not TEMP_USERNAME_RE.match(name) or name not in index.users or \
+                index.users[name].uid != expiry.get('uid'):
+            continue
+
+        deadline = expiry.get('deadline')
+        if isinstance(deadline, (int, long, float)) and deadline <= now:
+            expired.append(name)
+
+    # The processes on this system don't belong to a scratch root
+    if not expired or root != '/':
+        return expired, []
+
+    running = get_process_uids()
+    busy = [name for name in expired if index.users[name].uid in running]
+
+    return [name for name in expired if name not in busy], busy
+
+
+def reap_temp_users(dry_run=False, root='/'):
+    """
+        Deletes all the expired temporary users in one transaction and
+        leaves their home directories to the garbage collector.
+
+        :param dry_run: Only report which users would be deleted.
+        :type dry_run: bool
+
+        :return: The expired users, deleted unless `dry_run` is set.
+        :rtype: list
+    """
+
+    expired, busy = find_expired_temp_users(root)
+
+    for name in busy:
+        logger.info("Not reaping {}, it has processes running".format(name))
+
+    if dry_run or not expired:
+        return expired
+
+    home_paths = user._delete_users(expired, root)
+
+    ledger_path = get_root_path(root, TEMP_USER_EXPIRY_PATH)
+    with locked_ledger(ledger_path) as ledger:
+        users = ledger.get('users', {})
+        for name in expired:
+            users.pop(name, None)
+
+    HomeRemoval(user._trash_homes(home_paths, root)).wait()
+
+    logger.info("Reaped {} expired temporary users".format(len(expired)))
+
+    return expired
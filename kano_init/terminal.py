@@ -14,7 +14,8 @@ import sys
 import time
 import termios
 import atexit
-import subprocess
+
+from kano_init.command import run
 
 original_state = None
 SPEED_FACTOR = 1
@@ -25,7 +26,7 @@ LEFT_PADDING = 0
 
 def set_overscan():
     try:
-        otxt = subprocess.check_output('fbset')
+        otxt = run(['fbset']).stdout
         h = None
         v = None
         for line in otxt.split('\n'):
@@ -34,16 +35,13 @@ def set_overscan():
                 h = str(int(parts[1])/8)
                 v = str(int(parts[2])/8)
         if h and v:
-            subprocess.check_call(['overscan', h, h, v, v])
+            run(['overscan', h, h, v, v])
     except:
         pass
 
 
 def reset_overscan():
-    try:
-        subprocess.check_call(['overscan', '0', '0', '0', '0'])
-    except:
-        pass
+    run(['overscan', '0', '0', '0', '0'])
 
 
 def restore_original_state():
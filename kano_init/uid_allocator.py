@@ -0,0 +1,196 @@
+#
+# uid_allocator.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Hands out free user ids from a sorted list of free intervals.
+#
+
+from bisect import bisect_right
+
+
+FIRST_UID = 1001
+LAST_UID = 59999
+
+
+class UidAllocationError(Exception):
+    pass
+
+
+class UidAllocator(object):
+    """
+        Keeps the free uids between `first_uid` and `last_uid` as sorted,
+        disjoint and inclusive [start, end] intervals.
+
+        The next free uid is always the start of the first interval and
+        taking or releasing a uid only needs a bisection, so the cost no
+        longer depends on how many accounts exist on the system.
+    """
+
+    def __init__(self, used_uids=(), first_uid=FIRST_UID, last_uid=LAST_UID,
+                 reserved_ranges=()):
+        """
+            :param used_uids: The uids already assigned to accounts.
+            :type used_uids: iterable
+
+            :param reserved_ranges: Inclusive (start, end) uid ranges that
+                                    must never be handed out.
+            :type reserved_ranges: iterable
+        """
+
+        self.first_uid = first_uid
+        self.last_uid = last_uid
+
+        blocked = [(uid, uid) for uid in used_uids]
+        blocked.extend((start, end) for start, end in reserved_ranges)
+        blocked.sort()
+
+        self._starts = []
+        self._ends = []
+
+        cursor = first_uid
+        for start, end in blocked:
+            if end < cursor:
+                continue
+            if start > last_uid:
+                break
+            if start > cursor:
+                self._add_interval(cursor, start - 1)
+            cursor = end + 1
+
+        if cursor <= last_uid:
+            self._add_interval(cursor, last_uid)
+
+    def _add_interval(self, start, end):
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def _find(self, uid):
+        """
+            Returns the position of the free interval containing uid,
+            or None when the uid isn't free.
+        """
+
+        pos = bisect_right(self._starts, uid) - 1
+        if pos >= 0 and uid <= self._ends[pos]:
+            return pos
+
+        return None
+
+    def __len__(self):
+        return sum(end - start + 1
+                   for start, end in zip(self._starts, self._ends))
+
+    def is_free(self, uid):
+        return self._find(uid) is not None
+
+    def next_uid(self):
+        """
+            Returns the lowest free uid without allocating it.
+
+            :rtype: int
+        """
+
+        if not self._starts:
+            raise UidAllocationError(
+                "No free uids left between {} and {}".format(
+                    self.first_uid, self.last_uid))
+
+        return self._starts[0]
+
+    def take(self, uid):
+        """
+            Marks a single uid as used.
+
+            :param uid: A currently free uid.
+            :type uid: int
+        """
+
+        pos = self._find(uid)
+        if pos is None:
+            raise UidAllocationError("The uid {} isn't free".format(uid))
+
+        start, end = self._starts[pos], self._ends[pos]
+        if start == end:
+            del self._starts[pos]
+            del self._ends[pos]
+        elif uid == start:
+            self._starts[pos] = uid + 1
+        elif uid == end:
+            self._ends[pos] = uid - 1
+        else:
+            self._ends[pos] = uid - 1
+            self._starts.insert(pos + 1, uid + 1)
+            self._ends.insert(pos + 1, end)
+
+    def release(self, uid):
+        """
+            Returns a uid to the free pool, e.g. after a failed creation.
+
+            :param uid: A currently used uid within the allocator's range.
+            :type uid: int
+        """
+
+        if uid < self.first_uid or uid > self.last_uid or self.is_free(uid):
+            return
+
+        pos = bisect_right(self._starts, uid)
+        joins_prev = pos > 0 and self._ends[pos - 1] == uid - 1
+        joins_next = pos < len(self._starts) and self._starts[pos] == uid + 1
+
+        if joins_prev and joins_next:
+            self._ends[pos - 1] = self._ends[pos]
+            del self._starts[pos]
+            del self._ends[pos]
+        elif joins_prev:
+            self._ends[pos - 1] = uid
+        elif joins_next:
+            self._starts[pos] = uid
+        else:
+            self._starts.insert(pos, uid)
+            self._ends.insert(pos, uid)
+
+    def allocate(self):
+        """
+            Allocates the lowest free uid.
+
+            :rtype: int
+        """
+
+        uid = self.next_uid()
+        self.take(uid)
+        return uid
+
+    def reserve_block(self, count):
+        """
+            Allocates `count` uids at once, e.g. for bulk user creation.
+            The lowest free uids are used, so the block may have gaps.
+
+            Nothing is allocated when there aren't enough free uids.
+
+            :param count: The number of uids to reserve.
+            :type count: int
+
+            :return: The reserved uids in ascending order.
+            :rtype: list
+        """
+
+        if count > len(self):
+            raise UidAllocationError(
+                "Unable to reserve {} uids, only {} are free".format(
+                    count, len(self)))
+
+        uids = []
+        while len(uids) < count:
+            start, end = self._starts[0], self._ends[0]
+            last = min(end, start + count - len(uids) - 1)
+            uids.extend(xrange(start, last + 1))
+
+            if last == end:
+                del self._starts[0]
+                del self._ends[0]
+            else:
+                self._starts[0] = last + 1
+
+        return uids
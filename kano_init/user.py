@@ -1,7 +1,7 @@
 #
 # user.py
 #
-# Copyright (C) 2015-2016 Kano Computing Ltd.
+# Copyright (C) 2015-2018 Kano Computing Ltd.
 # License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
 #
 
@@ -10,24 +10,212 @@
 """
 
 import os
-import grp
-import pwd
+import re
+import stat
+import errno
+import json
+import crypt
+import hashlib
+import tempfile
 import shutil
+import signal
 import random
+import string
+import threading
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
-from kano.utils import run_cmd_log, run_cmd
 from kano.logging import logger
 
+from kano_init.paths import PASSWD_FILE_PATH, GROUP_FILE_PATH, \
+    PASSWORD_HASH_CACHE_PATH, get_root_path
+from kano_init.uid_allocator import UidAllocator, UidAllocationError
+from kano_init.account_db import AccountDB, AccountDBError
+from kano_init.home_trash import move_to_trash, schedule_gc
+from kano_init.home_mounts import mount_tmpfs_home, is_home_mount, \
+    unmount_home, HomeMountError
+from kano_init import skeleton
+from kano_init.command import run
+
 DEFAULT_USER_PASSWORD = "kano"
 DEFAULT_USER_GROUPS = "tty,adm,dialout,cdrom,audio,users,sudo,video,games," + \
                       "plugdev,input,kanousers,i2c,gpio,spi"
 
+# Inclusive (start, end) uid ranges that are never given to new users
+RESERVED_UID_RANGES = []
+
+# Edit the account databases in-process rather than forking the
+# shadow-utils tools, which are still used when that isn't possible.
+USE_NATIVE_ACCOUNT_DB = True
+
+# The umask force is used to blind the actual /home/username
+# folder from other users
+HOME_UMASK = 0o077
+
+# How many home directories are populated or removed at once by bulk operations
+HOME_POPULATE_WORKERS = 4
+HOME_REMOVE_WORKERS = 4
+
+MAIL_SPOOL_PATH = '/var/mail'
+
+# How move_home() moved a home directory
+HOME_RENAMED = 'renamed'
+HOME_COPIED = 'copied'
+HOME_REMOUNTED = 'remounted'
+
 
 class UserError(Exception):
     pass
 
 
-def user_exists(name):
+class HomeMoveError(Exception):
+    pass
+
+
+PasswdEntry = namedtuple('PasswdEntry',
+                         ['name', 'passwd', 'uid', 'gid', 'gecos', 'home',
+                          'shell'])
+GroupEntry = namedtuple('GroupEntry', ['name', 'passwd', 'gid', 'members'])
+
+
+class AccountIndex(object):
+    """
+        An in-memory index of the local passwd and group databases.
+
+        Both files are parsed once into dictionaries keyed by name and the
+        index is only rebuilt when the inode, size or mtime of either of
+        them changes, e.g. after useradd has replaced /etc/passwd.
+
+        Only the local files are indexed, the kit doesn't use any remote
+        NSS backends for its accounts.
+    """
+
+    _instances = {}
+
+    @staticmethod
+    def get_instance(root='/'):
+        """
+            Returns an up-to-date index for the system under `root`.
+
+            :param root: The root directory of the system to index.
+            :type root: str
+
+            :rtype: AccountIndex
+        """
+
+        if root not in AccountIndex._instances:
+            AccountIndex._instances[root] = AccountIndex(root)
+
+        index = AccountIndex._instances[root]
+        index.refresh()
+        return index
+
+    def __init__(self, root='/'):
+        self.root = root
+        self.passwd_path = get_root_path(root, PASSWD_FILE_PATH)
+        self.group_path = get_root_path(root, GROUP_FILE_PATH)
+
+        self._stamp = None
+        self.users = {}
+        self.uids = set()
+        self.groups = {}
+        self.gids = set()
+        self._uid_allocator = None
+
+    def _get_stamp(self):
+        stamp = []
+        for path in (self.passwd_path, self.group_path):
+            try:
+                info = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((info.st_ino, info.st_size, info.st_mtime))
+
+        return tuple(stamp)
+
+    def refresh(self):
+        """
+            Reparse the databases if they changed since the last load.
+        """
+
+        # The stamp is taken before parsing, so a concurrent modification
+        # will be picked up by the next refresh.
+        stamp = self._get_stamp()
+        if stamp == self._stamp:
+            return
+
+        self.users = {}
+        for fields in _read_db_file(self.passwd_path, 7):
+            try:
+                entry = PasswdEntry(fields[0], fields[1], int(fields[2]),
+                                    int(fields[3]), *fields[4:])
+            except ValueError:
+                continue
+            self.users.setdefault(entry.name, entry)
+
+        self.groups = {}
+        for fields in _read_db_file(self.group_path, 4):
+            try:
+                members = [m for m in fields[3].split(',') if m]
+                entry = GroupEntry(fields[0], fields[1], int(fields[2]),
+                                   members)
+            except ValueError:
+                continue
+            self.groups.setdefault(entry.name, entry)
+
+        self.uids = set(u.uid for u in self.users.itervalues())
+        self.gids = set(g.gid for g in self.groups.itervalues())
+        self._uid_allocator = None
+        self._stamp = stamp
+
+    def get_uid_allocator(self):
+        """
+            Returns the uid allocator for the indexed accounts. It is shared
+            until the index is rebuilt, so uids taken from it stay reserved
+            within this process. The uids reserved for temporary users being
+            created by other processes are taken as well.
+
+            :rtype: kano_init.uid_allocator.UidAllocator
+        """
+
+        # Imported here because kano_init.temp_users builds on this module
+        from kano_init.temp_users import get_reserved_uids
+
+        if self._uid_allocator is None:
+            self._uid_allocator = UidAllocator(
+                self.uids, reserved_ranges=RESERVED_UID_RANGES)
+
+        for uid in get_reserved_uids(self.root):
+            if self._uid_allocator.is_free(uid):
+                self._uid_allocator.take(uid)
+
+        return self._uid_allocator
+
+
+def _read_db_file(path, n_fields):
+    """
+        Yields the colon separated fields of each valid line of a
+        passwd-style database file.
+    """
+
+    try:
+        db_file = open(path, 'r')
+    except IOError:
+        return
+
+    with db_file:
+        for line in db_file:
+            line = line.rstrip('\n')
+            if not line or line.startswith(('#', '+', '-')):
+                continue
+
+            fields = line.split(':')
+            if len(fields) == n_fields:
+                yield fields
+
+
+def user_exists(name, root='/'):
     """
         A predicate to test whether an user of certain name exists.
 
@@ -38,15 +226,10 @@ def user_exists(name):
         :rtype: bool
     """
 
-    try:
-        user = pwd.getpwnam(name)
-    except KeyError:
-        return False
-
-    return user is not None
+    return name in AccountIndex.get_instance(root).users
 
 
-def group_exists(name):
+def group_exists(name, root='/'):
     """
         A predicate to test whether a group of certain name exists.
 
@@ -57,15 +240,10 @@ def group_exists(name):
         :rtype: bool
     """
 
-    try:
-        group = grp.getgrnam(name)
-    except KeyError:
-        return False
-
-    return group.gr_name == name
+    return name in AccountIndex.get_instance(root).groups
 
 
-def get_group_members(name):
+def get_group_members(name, root='/'):
     """
         Returns a list of all the members of the group.
 
@@ -76,14 +254,78 @@ def get_group_members(name):
         :rtype: list
     """
 
-    if not group_exists(name):
+    group = AccountIndex.get_instance(root).groups.get(name)
+    if group is None:
         return list()
 
-    group = grp.getgrnam(name)
-    return group.gr_mem
+    return list(group.members)
+
+
+def hash_password(password):
+    """
+        Returns a salted SHA-512 crypt(3) hash of the password, as stored
+        in /etc/shadow.
 
+        :param password: The plain text password.
+        :type password: str
 
-def create_user(username):
+        :rtype: str
+    """
+
+    salt_chars = string.ascii_letters + string.digits + './'
+    rand = random.SystemRandom()
+    salt = ''.join(rand.choice(salt_chars) for dummy in xrange(16))
+
+    return crypt.crypt(password, '$6${}$'.format(salt))
+
+
+def get_default_password_hash(root='/'):
+    """
+        Returns a shadow hash of DEFAULT_USER_PASSWORD. It is computed once
+        and kept in a root-only cache file, so the expensive crypt round
+        isn't repeated identically for every new account.
+
+        Only the well known default password is ever cached.
+
+        :rtype: str
+    """
+
+    cache_path = get_root_path(root, PASSWORD_HASH_CACHE_PATH)
+    key = hashlib.sha256(DEFAULT_USER_PASSWORD).hexdigest()
+
+    try:
+        with open(cache_path, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        cache = {}
+
+    if _is_valid_password_hash(cache.get(key)):
+        return str(cache[key])
+
+    cache[key] = password_hash = hash_password(DEFAULT_USER_PASSWORD)
+
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # mkstemp creates the file readable by its owner only
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.passwd')
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(cache, tmp_file)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as exc:
+        logger.warn("Unable to cache the password hash: {}".format(exc))
+
+    return password_hash
+
+
+def _is_valid_password_hash(password_hash):
+    return isinstance(password_hash, basestring) and \
+        bool(re.match(r'^\$[0-9a-z]+\$[^:\s]+$', password_hash))
+
+
+def create_user(username, groups=None, uid=None, tmpfs_home=False, root='/'):
     """
         Create and initialise an account for a new user. The user will be
         added to several default groups, including kanousers.
@@ -94,122 +336,573 @@ def create_user(username):
 
         :param username: The name of the new user
         :type name: str
+
+        :param groups: Supplementary groups, DEFAULT_USER_GROUPS if None.
+        :type groups: list
+
+        :param uid: The uid of the user, the next free one if None.
+        :type uid: int
+
+        :param tmpfs_home: Keep the home directory in RAM, it is lost when
+                           the user is deleted or the kit reboots.
+        :type tmpfs_home: bool
+
+        :param root: The root directory of the system to create it on.
+        :type root: str
     """
 
-    if user_exists(username):
+    if groups is None:
+        groups = DEFAULT_USER_GROUPS.split(',')
+
+    if user_exists(username, root=root):
         raise UserError(_("The user '{string_username}' already exists")
                         .format(string_username=username))
 
     home = "/home/{}".format(username)
-    home_old = '/home/' + username + '-old'
 
-    if os.path.exists(home):
-        msg = ("The home directory for the new user '{}' was there already, " +
+    if USE_NATIVE_ACCOUNT_DB:
+        try:
+            account_db = AccountDB(root).open()
+        except AccountDBError as exc:
+            logger.warn("Falling back to shadow-utils: {}".format(exc))
+        else:
+            _create_user_native(account_db, username, home, groups, uid,
+                                root, tmpfs_home)
+            return
+
+    # useradd only populates a home which isn't there yet
+    home_path = get_root_path(root, home)
+    home_old = _move_old_home(username, home_path)
+    try:
+        _create_user_shadow_utils(username, groups, root, uid=uid,
+                                  tmpfs_home=tmpfs_home)
+    except UserError:
+        _restore_old_home(home_path, home_old)
+        raise
+
+
+def get_root_args(root):
+    """
+        Returns the shadow-utils options to work on the system under root.
+
+        :rtype: list
+    """
+
+    return [] if root == '/' else ['-R', root]
+
+
+def _move_old_home(username, home_path):
+    """
+        Moves a home directory left behind by an earlier user out of the
+        way of the new one.
+
+        :return: Where it was moved to, None if there wasn't any.
+        :rtype: str
+    """
+
+    home_old = home_path + '-old'
+
+    if os.path.exists(home_path):
+        msg = ("The home directory for the new user '{}' was there already, "
                "moving it to {}".format(username, home_old))
         logger.warn(msg)
-        shutil.move(home, home_old)
-
-    # The umask force is used to blind the actual /home/username
-    # folder from other users
-    umask_override = '0077'
-
-    cmd = "useradd -u {} -m -K UMASK={} -s /bin/bash {}".format(
-        get_next_uid(),
-        umask_override,
-        username
-    )
-    _, _, rv = run_cmd_log(cmd)
-    if rv != 0:
+        shutil.move(home_path, home_old)
+        return home_old
+
+    return None
+
+
+def _restore_old_home(home_path, home_old):
+    """
+        Puts back a home directory moved by _move_old_home() when the new
+        user couldn't be created.
+    """
+
+    if home_old and not os.path.lexists(home_path):
+        shutil.move(home_old, home_path)
+
+
+def create_users(usernames, password_hashes=None, groups=None, root='/'):
+    """
+        Creates several users in one batch, e.g. for a classroom kit.
+
+        The uids are reserved as a block, every account database is
+        written once for the whole batch and the home directories are
+        populated in parallel. Users that can't be created are reported
+        without affecting the others. If the batch can't be committed
+        nothing is created and no existing home directory is moved.
+
+        This function requires root permissions to run properly.
+
+        :param usernames: The names of the new users.
+        :type usernames: list
+
+        :param password_hashes: Precomputed shadow hashes of the passwords
+                                of some users. The others get the default
+                                password.
+        :type password_hashes: dict
+
+        :param groups: Supplementary groups, DEFAULT_USER_GROUPS if None.
+        :type groups: list
+
+        :return: The error message for each username, None on success.
+        :rtype: OrderedDict
+    """
+
+    password_hashes = password_hashes or {}
+    if groups is None:
+        groups = DEFAULT_USER_GROUPS.split(',')
+
+    results = OrderedDict()
+    for username in usernames:
+        if username in results:
+            results[username] = _("Listed more than once.")
+        elif not _is_valid_username(username):
+            results[username] = _("Not a valid username.")
+        elif username in password_hashes and \
+                not _is_valid_password_hash(password_hashes[username]):
+            results[username] = _("Not a valid password hash.")
+        elif user_exists(username, root=root):
+            results[username] = _("The user already exists.")
+        else:
+            results[username] = None
+
+    new_users = [name for name, error in results.iteritems() if not error]
+    if not new_users:
+        return results
+
+    account_db = None
+    if USE_NATIVE_ACCOUNT_DB:
+        try:
+            account_db = AccountDB(root).open()
+        except AccountDBError as exc:
+            logger.warn("Falling back to shadow-utils: {}".format(exc))
+
+    if account_db is None:
+        for username in new_users:
+            home_path = get_root_path(root, '/home/' + username)
+            home_old = _move_old_home(username, home_path)
+            try:
+                _create_user_shadow_utils(username, groups, root,
+                                          password_hashes.get(username))
+            except UserError as exc:
+                _restore_old_home(home_path, home_old)
+                results[username] = unicode(exc)
+        return results
+
+    index = AccountIndex.get_instance(root)
+    homes = OrderedDict()
+    try:
+        with account_db:
+            uids = index.get_uid_allocator().reserve_block(len(new_users))
+            account_db.add_group('kanousers')
+            default_hash = get_default_password_hash(root)
+
+            for username, uid in zip(new_users, uids):
+                home = "/home/{}".format(username)
+                gid = account_db.add_user(
+                    username, uid, home,
+                    password_hash=password_hashes.get(username, default_hash),
+                    groups=groups
+                )
+                homes[username] = (get_root_path(root, home), uid, gid)
+    except (AccountDBError, UidAllocationError) as exc:
+        msg = N_("Unable to create the users, updating the accounts failed.")
+        logger.error("{} {}".format(msg, exc))
+        raise UserError(_(msg))
+
+    # Only once the batch is committed, so a failed one leaves them alone
+    old_homes = {}
+    for username, (home_path, dummy_uid, dummy_gid) in homes.iteritems():
+        old_homes[username] = _move_old_home(username, home_path)
+
+    def populate(username):
+        try:
+            populate_home(*homes[username], root=root)
+        except (IOError, OSError) as exc:
+            logger.error("Unable to populate the home of {}: {}".format(
+                username, exc))
+            return False
+        return True
+
+    pool = ThreadPool(min(HOME_POPULATE_WORKERS, len(homes)))
+    try:
+        populated = pool.map(populate, homes.keys())
+    except Exception:
+        # Don't leave half of the batch behind
+        _remove_new_users(homes, old_homes, root)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [name for name, ok in zip(homes.keys(), populated) if not ok]
+    if failed:
+        _remove_new_users(dict((name, homes[name]) for name in failed),
+                          old_homes, root)
+        for username in failed:
+            results[username] = _("Unable to create the home directory.")
+
+    return results
+
+
+def _remove_new_users(homes, old_homes, root):
+    """
+        Rolls back freshly created users along with their home directories,
+        and puts back the old homes moved out of their way.
+    """
+
+    with AccountDB(root) as account_db:
+        for username in homes:
+            account_db.remove_user(username)
+
+    for username, (home_path, dummy_uid, dummy_gid) in homes.iteritems():
+        shutil.rmtree(home_path, ignore_errors=True)
+        _restore_old_home(home_path, old_homes.get(username))
+
+
+def _is_valid_username(username):
+    return isinstance(username, basestring) and \
+        bool(re.match(r'^[a-zA-Z0-9_][a-zA-Z0-9_.-]{0,31}$', username))
+
+
+def _create_user_native(account_db, username, home, groups, uid, root,
+                        tmpfs_home=False):
+    """
+        Creates the user with a single transaction on the already opened
+        account databases and populates its home directory.
+    """
+
+    index = AccountIndex.get_instance(root)
+
+    try:
+        with account_db:
+            if uid is None:
+                uid = index.get_uid_allocator().allocate()
+            account_db.add_group('kanousers')
+            gid = account_db.add_user(
+                username, uid, home,
+                password_hash=get_default_password_hash(root),
+                groups=groups
+            )
+    except (AccountDBError, UidAllocationError) as exc:
+        msg = N_("Unable to create new user, updating the accounts failed.")
+        logger.error("{} {}".format(msg, exc))
+        raise UserError(_(msg))
+
+    home_path = get_root_path(root, home)
+    home_old = _move_old_home(username, home_path)
+    try:
+        populate_home(home_path, uid, gid, root, tmpfs=tmpfs_home)
+    except (IOError, OSError, HomeMountError) as exc:
+        logger.error("Unable to populate {}: {}".format(home_path, exc))
+
+        with AccountDB(root) as account_db:
+            account_db.remove_user(username)
+        _discard_home(home_path)
+        _restore_old_home(home_path, home_old)
+
+        msg = N_("Unable to create the home directory of the new user.")
+        raise UserError(_(msg))
+
+
+def _create_user_shadow_utils(username, groups, root, password_hash=None,
+                              uid=None, tmpfs_home=False):
+    """
+        Creates the user by running the shadow-utils tools.
+    """
+
+    root_args = get_root_args(root)
+
+    uid = uid if uid is not None else get_next_uid(root)
+    cmd = ['useradd'] + root_args + [
+        '-u', uid, '-M' if tmpfs_home else '-m',
+        '-K', 'UMASK={:04o}'.format(HOME_UMASK), '-s', '/bin/bash', username
+    ]
+    if run(cmd, log=True).returncode != 0:
         msg = N_("Unable to create new user, useradd failed.")
         logger.error(msg)
         raise UserError(_(msg))
 
-    cmd = "echo '{}:{}' | chpasswd".format(username, DEFAULT_USER_PASSWORD)
-    _, _, rv = run_cmd_log(cmd)
-    if rv != 0:
-        delete_user(username)
+    # chpasswd is given a precomputed hash, so it doesn't run crypt itself
+    password_hash = password_hash or get_default_password_hash(root)
+    result = run(['chpasswd', '-e'] + root_args,
+                 input_data='{}:{}\n'.format(username, password_hash),
+                 log=True)
+    if result.returncode != 0:
+        delete_user(username, root=root)
         msg = N_("Unable to change the new user's password, chpasswd failed.")
         logger.error(msg)
         raise UserError(_(msg))
 
     # Make sure the kanousers group exists
-    if not group_exists('kanousers'):
-        _, _, rv = run_cmd_log('groupadd kanousers -f')
-        if rv != 0:
+    if not group_exists('kanousers', root=root):
+        result = run(['groupadd'] + root_args + ['-f', 'kanousers'], log=True)
+        if result.returncode != 0:
             msg = N_("Unable to create the kanousers group, groupadd failed.")
             raise UserError(_(msg))
 
     # Add the new user to all necessary groups
-    cmd = "usermod -G '{}' {}".format(DEFAULT_USER_GROUPS, username)
-    _, _, rv = run_cmd_log(cmd)
+    run(['usermod'] + root_args + ['-G', ','.join(groups), username],
+        log=True)
 
+    if tmpfs_home:
+        entry = AccountIndex.get_instance(root).users[username]
+        home_path = get_root_path(root, entry.home)
+        try:
+            populate_home(home_path, entry.uid, entry.gid, root, tmpfs=True)
+        except (IOError, OSError, HomeMountError) as exc:
+            logger.error("Unable to populate {}: {}".format(home_path, exc))
+            _discard_home(home_path)
+            delete_user(username, root=root)
+            msg = N_("Unable to create the home directory of the new user.")
+            raise UserError(_(msg))
+
+
+def populate_home(home_path, uid, gid, root='/', tmpfs=False):
+    """
+        Creates a home directory from the skeleton in /etc/skel, owned by
+        the user and hidden from the others, the way `useradd -m` does.
+
+        :param home_path: Where the home directory should be created.
+        :type home_path: str
+
+        :param tmpfs: Mount a tmpfs at home_path and populate that.
+        :type tmpfs: bool
+    """
 
-def create_temporary_user():
+    mode = 0o777 & ~HOME_UMASK
+    if tmpfs:
+        mount_tmpfs_home(home_path, uid, gid, mode)
+
+    skeleton.populate_home(home_path, uid, gid, mode, root=root,
+                           existing=tmpfs)
+
+
+def _discard_home(home_path):
+    if is_home_mount(home_path):
+        try:
+            unmount_home(home_path)
+        except HomeMountError as exc:
+            logger.error(str(exc))
+    else:
+        shutil.rmtree(home_path, ignore_errors=True)
+
+
+def create_temporary_user(tmpfs_home=None):
     '''
     Creates a temporary Kano user on the system.
-    Returns the newly created username, None on error.
+    Returns the newly created username, raises UserError on error.
+
+    See kano_init.temp_users.create_temporary_user()
     '''
-    username=None
-    created=False
+    # Imported here because kano_init.temp_users builds on this module
+    from kano_init.temp_users import create_temporary_user as create_temp_user
 
-    def random_kano_user():
-        suffix=random.randrange(10**10)
-        random_username='kano%08x' % suffix
-        return random_username
+    return create_temp_user(tmpfs_home=tmpfs_home)
 
-    # Try to create a new temporary username in the form "kano3faf5dcd".
-    try:
-        username=random_kano_user()
-        create_user(username)
-        created=True
-    except:
-        pass
 
-    # Do a cleanup if something went wrong
-    if not created and username:
-        try:
-            delete_user(username)
-        except:
-            pass
-        username=None
+def rename_user(current, new, root='/'):
+    """
+        Renames current username to new, by changing its login name, its
+        private group and its home folder.
 
-    return username
+        The accounts are updated in a single transaction and the home is
+        renamed in place when it stays on the same filesystem, so either
+        both are renamed or neither is.
 
+        :param current: The name of the user.
+        :type current: str
 
-def rename_user(current, new):
-    '''
-    Renames current username to new, by changing its login name and home folder.
-    '''
+        :param new: The new name of the user.
+        :type new: str
+    """
 
     # Sanity checks
-    if not user_exists(current) or user_exists(new):
+    if not user_exists(current, root=root) or user_exists(new, root=root):
         msg = N_("cannot rename user {} to {} due to conflicting names".format(current, new))
         logger.error(msg)
         raise UserError(msg)
 
+    entry = AccountIndex.get_instance(root).users[current]
+    if root == '/' and entry.uid in get_process_uids():
+        msg = N_("Unable to rename user, the user has processes running.")
+        logger.error(msg)
+        raise UserError(msg)
+
+    new_home = '/home/{}'.format(new)
+
+    renamed = False
+    if USE_NATIVE_ACCOUNT_DB:
+        try:
+            account_db = AccountDB(root).open()
+        except AccountDBError as exc:
+            logger.warn("Falling back to shadow-utils: {}".format(exc))
+        else:
+            _rename_user_native(account_db, current, new, entry.home,
+                                new_home, root)
+            renamed = True
+
+    if not renamed:
+        _rename_user_shadow_utils(current, new, root)
+
+    # A renamed temporary user is a regular user from now on
+    from kano_init.temp_users import forget_temp_user
+    forget_temp_user(current, root=root)
+
+
+def _rename_user_native(account_db, current, new, home, new_home, root):
+    """
+        Renames the user in one transaction on the already opened account
+        databases. The home is moved before the databases are written and
+        moved back if writing them fails.
+    """
+
+    home_path = get_root_path(root, home)
+    new_home_path = get_root_path(root, new_home)
+    moved = None
+
+    try:
+        with account_db:
+            account_db.rename_user(current, new, new_home)
+
+            if os.path.lexists(home_path) and home_path != new_home_path:
+                moved = move_home(home_path, new_home_path)
+    except (AccountDBError, HomeMoveError) as exc:
+        # The original of a copied home is still in place
+        if moved == HOME_COPIED:
+            shutil.rmtree(new_home_path, ignore_errors=True)
+        elif moved:
+            try:
+                move_home(new_home_path, home_path)
+            except HomeMoveError as move_exc:
+                logger.error("Unable to move {} back: {}".format(
+                    new_home_path, move_exc))
+
+        msg = N_("Unable to rename user {} to {}: {}".format(current, new,
+                                                             exc))
+        logger.error(msg)
+        raise UserError(msg)
+
+    # A copied home is only removed once the new one is in use
+    if moved == HOME_COPIED:
+        shutil.rmtree(home_path, ignore_errors=True)
+
+
+def move_home(home_path, new_home_path):
+    """
+        Moves a home directory, with a single rename on the same filesystem.
+        A tmpfs home is moved to the new mountpoint. Only when the homes are
+        on different filesystems is the tree copied, and the original is
+        left for the caller to remove.
+
+        :return: How the home was moved.
+        :rtype: str
+    """
+
+    if os.path.lexists(new_home_path):
+        raise HomeMoveError("{} exists already".format(new_home_path))
+
+    if is_home_mount(home_path):
+        os.mkdir(new_home_path, 0o700)
+        result = run(['mount', '--move', home_path, new_home_path], log=True)
+        if result.returncode != 0:
+            os.rmdir(new_home_path)
+            raise HomeMoveError("Unable to move the mount {}".format(
+                home_path))
+        os.rmdir(home_path)
+        return HOME_REMOUNTED
+
+    try:
+        os.rename(home_path, new_home_path)
+        return HOME_RENAMED
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise HomeMoveError("Unable to move {}: {}".format(home_path,
+                                                               exc))
+
+    try:
+        _copy_tree(home_path, new_home_path)
+    except (IOError, OSError) as exc:
+        shutil.rmtree(new_home_path, ignore_errors=True)
+        raise HomeMoveError("Unable to copy {}: {}".format(home_path, exc))
+
+    return HOME_COPIED
+
+
+def _copy_tree(src_path, dst_path):
+    """
+        Copies a directory tree with a single walk, streaming the contents
+        of every file and keeping owners and modes.
+    """
+
+    def copy_entry(src, dst):
+        info = os.lstat(src)
+        if stat.S_ISLNK(info.st_mode):
+            os.symlink(os.readlink(src), dst)
+        elif stat.S_ISDIR(info.st_mode):
+            os.mkdir(dst, 0o700)
+            os.chmod(dst, stat.S_IMODE(info.st_mode))
+        elif stat.S_ISREG(info.st_mode):
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                 0o600)
+                try:
+                    skeleton.clone_file(src_fd, dst_fd, info.st_size)
+                    os.fchmod(dst_fd, stat.S_IMODE(info.st_mode))
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        else:
+            # Sockets, fifos and devices are meaningless in a copy
+            return
+
+        os.lchown(dst, info.st_uid, info.st_gid)
+
+    copy_entry(src_path, dst_path)
+
+    for dirpath, dirnames, filenames in os.walk(src_path):
+        dst_dir = os.path.join(dst_path, os.path.relpath(dirpath, src_path))
+        for name in dirnames + filenames:
+            copy_entry(os.path.join(dirpath, name),
+                       os.path.join(dst_dir, name))
+
+
+def _rename_user_shadow_utils(current, new, root):
+    """
+        Renames the user by running the shadow-utils tools.
+    """
+
+    root_args = get_root_args(root)
+
     # Rename the username and move his home directory.
-    cmd='usermod --login {} --home /home/{} --move-home {}'.format(new, new, current)
-    _, _, rv = run_cmd_log(cmd)
+    cmd = ['usermod'] + root_args + ['--login', new, '--home',
+                                     '/home/{}'.format(new), '--move-home',
+                                     '--expiredate', '', current]
+    rv = run(cmd, log=True).returncode
     if rv != 0:
         msg = N_("Unable to rename user, perhaps user has processes running? usermod rc={}".format(rv))
         logger.error(msg)
         raise UserError(msg)
 
     # Do the same with his initial user group
-    cmd='groupmod --new-name {} {}'.format(new, current)
-    _, _, rv = run_cmd_log(cmd)
-    if rv != 0:
+    cmd = ['groupmod'] + root_args + ['--new-name', new, current]
+    if run(cmd, log=True).returncode != 0:
         msg = N_("Unable to rename user group, rename_user failed.")
         logger.error(msg)
 
         # Try to rollback the first step
-        cmd='usermod --login {} --home /home/{} --move-home {}'.format(current, current, new)
-        _, _, rv = run_cmd_log(cmd)
+        cmd = ['usermod'] + root_args + ['--login', current, '--home',
+                                         '/home/{}'.format(current),
+                                         '--move-home', new]
+        run(cmd, log=True)
 
         raise UserError(msg)
 
 
-def get_next_uid():
+def get_next_uid(root='/'):
     """
         Returns the next free user id.
 
@@ -217,26 +910,55 @@ def get_next_uid():
         :rtyp: int
     """
 
-    users = pwd.getpwall()
+    return AccountIndex.get_instance(root).get_uid_allocator().next_uid()
 
-    uids = []
-    for u in users:
-        uids.append(u.pw_uid)
 
-    i = 1001
-    while i in uids:
-        i += 1
+def get_username_suggestions(username_base, count=3):
+    """
+        Returns the `count` lowest free usernames derived from the base,
+        i.e. the base itself or the base followed by a number.
 
-    return i
+        The numeric suffixes in use are collected in a single pass over the
+        account index, so the cost doesn't depend on how many of them are
+        taken already.
+
+        :param username_base: The initial part of the username.
+        :type username_base: str
+
+        :param count: The number of usernames to return.
+        :type count: int
+
+        :returns: Free usernames, best first.
+        :rtype: list
+    """
+
+    used = set()
+    for name in AccountIndex.get_instance().users:
+        if not name.startswith(username_base):
+            continue
+
+        suffix = name[len(username_base):]
+        if not suffix:
+            used.add(0)
+        elif suffix.isdigit() and suffix[0] != '0':
+            used.add(int(suffix))
+
+    usernames = []
+    n = 0
+    while len(usernames) < count:
+        if n not in used:
+            usernames.append("{}{}".format(username_base, n or ''))
+        n += 1
+
+    return usernames
 
 
 def make_username_unique(username_base):
     """
         Returns an unique username derived from the base.
 
-        It appends an increasing number to the username until one that
-        doesn't exist has been found. It stops after 1,000,000 tries and
-        returns None in that case.
+        The base is returned if it is free, otherwise the lowest number
+        not yet used by another user is appended to it.
 
         :param username_base: The initial part of the username.
         :type username_base: str
@@ -245,46 +967,264 @@ def make_username_unique(username_base):
         :rtype: str
     """
 
-    n = 1
-    username = username_base
-    while user_exists(username) and n <= 1000000:
-        username = "{}{}".format(username_base, n)
-        n += 1
+    return get_username_suggestions(username_base, 1)[0]
 
-    return username
 
+class HomeRemoval(object):
+    """
+        Removes home directories in a bounded pool of worker threads, so
+        the caller can carry on while the trees are being unlinked.
+    """
 
-def delete_user(username):
+    def __init__(self, home_paths, workers=HOME_REMOVE_WORKERS):
+        self.total = len(home_paths)
+        self.removed = 0
+        self.failed = []
+
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(max(1, min(workers, self.total)))
+        self._pool.map_async(self._remove, home_paths)
+        self._pool.close()
+
+    def _remove(self, home_path):
+        try:
+            shutil.rmtree(home_path)
+        except OSError as exc:
+            if os.path.exists(home_path):
+                logger.error("Unable to remove {}: {}".format(home_path, exc))
+                with self._lock:
+                    self.failed.append(home_path)
+                return
+
+        with self._lock:
+            self.removed += 1
+            logger.info("Removed {} ({}/{})".format(
+                home_path, self.removed, self.total))
+
+    def wait(self):
+        """
+            Blocks until every home directory has been handled.
+
+            :return: The home directories that couldn't be removed.
+            :rtype: list
+        """
+
+        self._pool.join()
+        return self.failed
+
+
+def _read_process_uids(proc_path='/proc'):
+    """
+        Yields the pid of every running process with its real and effective
+        uids, read from the Uid line of its status file. The owner of the
+        /proc entry can't be used, it is root for non-dumpable processes.
+    """
+
+    for pid in os.listdir(proc_path):
+        if not pid.isdigit():
+            continue
+
+        try:
+            with open(os.path.join(proc_path, pid, 'status'), 'r') as status:
+                for line in status:
+                    if line.startswith('Uid:'):
+                        real, effective = line.split()[1:3]
+                        yield int(pid), set((int(real), int(effective)))
+                        break
+        except (IOError, OSError, ValueError):
+            # The process has finished in the meantime
+            pass
+
+
+def kill_user_processes(uids, proc_path='/proc'):
+    """
+        Terminates all processes run by any of the users using SIGKILL,
+        with a single pass over /proc.
+
+        :param uids: The uids of the users.
+        :type uids: iterable
+    """
+
+    uids = set(uids)
+    if not uids:
+        return
+
+    for pid, process_uids in _read_process_uids(proc_path):
+        if process_uids & uids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                # The process has finished in the meantime
+                pass
+
+
+def get_process_uids(proc_path='/proc'):
+    """
+        Returns the uids which run at least one process, as their real or
+        effective uid, with a single pass over /proc.
+
+        :rtype: set
+    """
+
+    uids = set()
+    for dummy_pid, process_uids in _read_process_uids(proc_path):
+        uids.update(process_uids)
+
+    return uids
+
+
+def _delete_users(usernames, root='/'):
+    """
+        Kills the processes of the users and removes their accounts in one
+        transaction. Their home directories are left in place.
+
+        :return: The home directories of the removed users.
+        :rtype: list
+    """
+
+    index = AccountIndex.get_instance(root)
+    users = [index.users[name] for name in usernames if name in index.users]
+    if not users:
+        return []
+
+    # The processes on this system don't belong to a scratch root
+    if root == '/':
+        kill_user_processes(user.uid for user in users)
+
+    account_db = None
+    if USE_NATIVE_ACCOUNT_DB:
+        try:
+            account_db = AccountDB(root).open()
+        except AccountDBError as exc:
+            logger.warn("Falling back to shadow-utils: {}".format(exc))
+
+    if account_db is None:
+        for user in users:
+            result = run(['userdel'] + get_root_args(root) + [user.name],
+                         log=True)
+            if result.returncode != 0:
+                raise UserError(_("Deleting the '{string_username}' failed."
+                                  .format(string_username=user.name)))
+    else:
+        try:
+            with account_db:
+                for user in users:
+                    account_db.remove_user(user.name)
+        except AccountDBError as exc:
+            logger.error("Unable to remove the accounts: {}".format(exc))
+            raise UserError(_("Deleting the users failed."))
+
+    home_paths = []
+    for user in users:
+        _remove_mail_spool(user.name, root)
+
+        # Never remove anything that isn't a regular home directory
+        if os.path.dirname(user.home.rstrip('/')) == '/home':
+            home_path = get_root_path(root, user.home)
+
+            # Homes kept in RAM are simply dropped
+            if is_home_mount(home_path):
+                try:
+                    unmount_home(home_path)
+                    continue
+                except HomeMountError as exc:
+                    logger.error(str(exc))
+
+            home_paths.append(home_path)
+        else:
+            logger.warn("Keeping the home of {} at {}".format(user.name,
+                                                             user.home))
+
+    return home_paths
+
+
+def _remove_mail_spool(username, root):
+    try:
+        os.remove(get_root_path(root, os.path.join(MAIL_SPOOL_PATH, username)))
+    except OSError:
+        pass
+
+
+def _trash_homes(home_paths, root):
+    """
+        Moves the home directories to the trash and schedules the garbage
+        collector.
+
+        :return: The home directories that have to be removed synchronously.
+        :rtype: list
+    """
+
+    remaining = [path for path in home_paths
+                 if not move_to_trash(path, root=root)]
+
+    if root == '/' and len(remaining) < len(home_paths):
+        schedule_gc()
+
+    return remaining
+
+
+def delete_user(username, defer_home=False, root='/'):
     """
         Terminates all processes of the user in question using SIGKILL
-        and removes the user.
+        and removes the user along with its home directory.
 
         Requires root permissions to run properly.
 
         :param username: The name of the user to be deleted.
         :type name: str
-    """
 
-    # kill all process from the user
-    run_cmd("killall -KILL -u {}".format(username))
+        :param defer_home: Move the home directory to the trash and leave
+                           it to the garbage collector instead of waiting
+                           for it to be removed.
+        :type defer_home: bool
+    """
 
-    _, _, rv = run_cmd_log("userdel -r {}".format(username))
-    if rv != 0:
+    if not user_exists(username, root=root):
         raise UserError(_("Deleting the '{string_username}' failed."
                           .format(string_username=username)))
 
+    home_paths = _delete_users([username], root)
+    if defer_home:
+        home_paths = _trash_homes(home_paths, root)
 
-def delete_all_users():
+    HomeRemoval(home_paths).wait()
+
+
+def delete_all_users(wait=True, defer_homes=False, root='/'):
     """
-        Terminates all processes of the user in question using SIGKILL
-        and removes the user.
+        Removes all the kano users, along with the temporary users waiting
+        in the warm pool.
+
+        The processes and the accounts of all of them are removed in one
+        go, then their home directories are removed concurrently.
 
         Requires root permissions to run properly.
 
-        :param username: The name of the user to be deleted.
-        :type name: str
+        :param wait: Whether to wait until all the home directories are gone.
+        :type wait: bool
+
+        :param defer_homes: Move the home directories to the trash and leave
+                            them to the garbage collector.
+        :type defer_homes: bool
+
+        :return: The removal of the home directories, call its wait() method
+                 before shutting down when `wait` is False.
+        :rtype: HomeRemoval
     """
 
-    if group_exists('kanousers'):
-        for user in get_group_members('kanousers'):
-            delete_user(user)
+    # Imported here because kano_init.temp_users builds on this module
+    from kano_init.temp_users import drain_pool
+
+    usernames = get_group_members('kanousers', root=root)
+    usernames += [name for name in drain_pool(root)
+                  if name not in usernames]
+
+    home_paths = _delete_users(usernames, root)
+    if defer_homes:
+        home_paths = _trash_homes(home_paths, root)
+
+    home_removal = HomeRemoval(home_paths)
+    if wait:
+        home_removal.wait()
+
+    return home_removal
@@ -9,96 +9,163 @@
 
 
 import os
+import re
 import json
 import shutil
+from collections import namedtuple
 
 import pwd
 import grp
 
-from kano.utils.shell import run_cmd
-from kano.utils.file_operations import ensure_dir, sed
+from kano.utils.file_operations import ensure_dir
+from kano.logging import logger
 
-from kano_init.paths import INIT_CONF_PATH, DEFAULT_LIGHTDM_CONF_FILE
+from kano_init.paths import DEFAULT_LIGHTDM_CONF_FILE
+from kano_init.command import run
+from kano_init.lightdm import LIGHTDM_CONF_FILE, LightDMConf, \
+    LightDMConfError, edit_lightdm_conf
 from kano_init.user import get_group_members
 from kano_init.status import Status
+from kano_init.init_conf import load_init_conf
+from kano_init.systemd_manager import USER_SYSTEMD_BUS_ADDRESS, \
+    SystemdManager, get_default_target, set_default_target, swap_symlink
 
 
-LIGHTDM_CONF_FILE = '/etc/lightdm/lightdm.conf'
+SYSTEMD_TTY1_LINK = '/etc/systemd/system/getty.target.wants/getty@tty1.service'
+SYSTEMD_GETTY_UNIT = '/lib/systemd/system/getty@.service'
+KANOAUTOLOGIN_UNIT = '/usr/share/kano-init/systemd_ttys/kanoautologin@.service'
+KANOINIT_UNIT = '/usr/share/kano-init/systemd_ttys/kanoinit@.service'
+
+# The kanoautologin unit logs in the user named in the environment file at
+# AUTOLOGIN_ENV_LINK, which points to one of the files generated per user in
+# AUTOLOGIN_ENV_DIR. The file is read when the unit starts, so switching the
+# user doesn't change any unit or need a daemon reload.
+AUTOLOGIN_ENV_DIR = '/etc/kano-init/autologin'
+AUTOLOGIN_ENV_LINK = '/etc/kano-init/autologin-user.conf'
+AUTOLOGIN_ENV_VAR = 'KANO_AUTOLOGIN_USER'
+
+GRAPHICAL_TARGET = 'graphical.target'
+MULTI_USER_TARGET = 'multi-user.target'
+
+# How the kit should start up, or how it is set up to start up:
+#   tty1_user: who is logged in on tty1, 'root' for the kano-init flow and
+#              None for a getty login prompt
+#   autologin_user: who LightDM logs in, None for the Greeter
+#   default_target: the systemd default target
+AutostartState = namedtuple('AutostartState',
+                            ['tty1_user', 'autologin_user', 'default_target'])
+
+# A part of the current state that couldn't be read, it is always reapplied
+UNKNOWN_STATE = object()
+
+
+def _ensure_autologin_env(username):
+    env_path = os.path.join(AUTOLOGIN_ENV_DIR, '{}.conf'.format(username))
+    contents = '{}={}\n'.format(AUTOLOGIN_ENV_VAR, username)
+
+    try:
+        with open(env_path, 'r') as env_file:
+            if env_file.read() == contents:
+                return env_path
+    except IOError:
+        pass
+
+    ensure_dir(AUTOLOGIN_ENV_DIR)
+    tmp_path = env_path + '.tmp'
+    with open(tmp_path, 'w') as env_file:
+        env_file.write(contents)
+    os.rename(tmp_path, env_path)
+
+    return env_path
 
 
 def enable_console_autologin(username, restart=False):
     '''
     Sets the system to automatically login username on tty1
     at boot time, or when you close the console session.
+
+    Nothing is changed, or restarted, if tty1 is already set up for username.
+
+    :return: Whether anything was changed.
+    :rtype: bool
     '''
 
     #
     # Change systemd symlink that points to what needs to happen on tty1
     # https://wiki.archlinux.org/index.php/Systemd_FAQ#How_do_I_change_the_default_number_of_gettys.3F
     #
-    systemd_tty1_linkfile = '/etc/systemd/system/getty.target.wants/getty@tty1.service'
-    kano_init_tty1_kanoautologin = '/usr/share/kano-init/systemd_ttys/kanoautologin@.service'
-    kano_init_tty1_kanoinit = '/usr/share/kano-init/systemd_ttys/kanoinit@.service'
-    if os.path.isfile(systemd_tty1_linkfile):
-        os.unlink(systemd_tty1_linkfile)
-
     if username == 'root':
-        os.symlink(kano_init_tty1_kanoinit, systemd_tty1_linkfile)
+        user_changed = False
+        unit_changed = swap_symlink(KANOINIT_UNIT, SYSTEMD_TTY1_LINK)
     else:
-        sed('^ExecStart.*', "ExecStart=/bin/su - {}".format(username), kano_init_tty1_kanoautologin)
-        os.symlink(kano_init_tty1_kanoautologin, systemd_tty1_linkfile)
+        user_changed = swap_symlink(_ensure_autologin_env(username),
+                                    AUTOLOGIN_ENV_LINK)
+        unit_changed = swap_symlink(KANOAUTOLOGIN_UNIT, SYSTEMD_TTY1_LINK)
 
-    if restart:
+    if restart and (user_changed or unit_changed):
         # replace the tty process immediately, otherwise on next boot
-        run_cmd('systemctl restart getty@tty1.service')
+        restart_tty1(reload_units=unit_changed)
+
+    return user_changed or unit_changed
 
 
 def disable_console_autologin(restart=False):
     '''
     Disable automatic login on tty1, default getty login prompt will be provided.
+
+    :return: Whether anything was changed.
+    :rtype: bool
     '''
 
     #
     # Change systemd symlink that points to what needs to happen on tty1
     # https://wiki.archlinux.org/index.php/Systemd_FAQ#How_do_I_change_the_default_number_of_gettys.3F
     #
-    systemd_tty1_linkfile = '/etc/systemd/system/getty.target.wants/getty@tty1.service'
-    systemd_tty1_getty = '/lib/systemd/system/getty@.service'
+    changed = swap_symlink(SYSTEMD_GETTY_UNIT, SYSTEMD_TTY1_LINK)
 
-    if os.path.isfile(systemd_tty1_linkfile):
-        os.unlink(systemd_tty1_linkfile)
+    if restart and changed:
+        restart_tty1()
 
-    os.symlink(systemd_tty1_getty, systemd_tty1_linkfile)
+    return changed
 
-    if restart:
-        run_cmd('systemctl restart getty@tty1.service')
+
+def restart_tty1(reload_units=True):
+    '''
+    Restarts the tty on tty1, reloading systemd first to pick up a new unit.
+    '''
+    with SystemdManager() as systemd:
+        if reload_units:
+            systemd.reload()
+        systemd.restart_unit('getty@tty1.service')
 
 
 def set_ldm_autologin(username):
     '''
     Tell lightdm to skip the greeter, login username, and go directly to the desktop.
     '''
-    sed('^#?(autologin-user)=.*$', 'autologin-user={}'.format(username), LIGHTDM_CONF_FILE)
+    with edit_lightdm_conf(LIGHTDM_CONF_FILE) as conf:
+        conf['autologin-user'] = username
 
-    # Make sure the autologin timeout is set to 0
-    sed('^#?(autologin-user-timeout)=.*$', '\\1=0', LIGHTDM_CONF_FILE)
+        # Make sure the autologin timeout is set to 0
+        conf['autologin-user-timeout'] = 0
 
 
 def unset_ldm_autologin():
     '''
     Disable lightdm automatic login, the greeter should provide a login window
     '''
-    sed('^autologin-user=.*$', '#autologin-user=none', LIGHTDM_CONF_FILE)
+    with edit_lightdm_conf(LIGHTDM_CONF_FILE) as conf:
+        conf.comment_out('autologin-user', placeholder='none')
 
-    # Comment out the autologin-user-timeout option
-    sed('^#?(autologin-user-timeout=.*)$', '#\\1', LIGHTDM_CONF_FILE)
+        # Comment out the autologin-user-timeout option
+        del conf['autologin-user-timeout']
 
 
 def enable_ldm_autostart():
     '''
     Set the system to graphical mode - start the default X server and go to Desktop
     '''
-    run_cmd('systemctl set-default graphical.target')
+    set_default_target(GRAPHICAL_TARGET)
 
 
 def disable_ldm_autostart():
@@ -106,23 +173,48 @@ def disable_ldm_autostart():
     Set the system to multi user mode - the X server will not be started,
     and the Overture onboarding will take control, through the systemd service.
     '''
-    run_cmd('systemctl set-default multi-user.target')
+    set_default_target(MULTI_USER_TARGET)
 
 
 def start_lightdm():
     '''
     Starts the X server immediately, it is safe to call while overture is running
     '''
-    run_cmd('systemctl start lightdm')
+    run(['systemctl', 'start', 'lightdm'])
 
 
-def start_dashboard_services(username):
+def start_dashboard_services(username, wait_timeout=None):
     '''
     Starts the Dashboard app and related user services on top of the XServer,
-    Using su to impersonate them as the specified "username".
+    through the systemd manager of the specified "username". Both are started
+    together over one connection, without a login shell for the user. A
+    service which systemd refuses isn't started again through systemctl, the
+    fallback is only used when the user manager can't be reached.
+
+    :param wait_timeout: Seconds to wait for the services to become active,
+                         None to return as soon as they are queued.
+    :type wait_timeout: float
+
+    :return: How long each service took to become active, in seconds, or None
+             for the ones which didn't. Empty when not waiting.
+    :rtype: dict
     '''
-    run_cmd('su - "{}" -c "systemctl --user start kano-dashboard.service"'.format(username))
-    run_cmd('su - "{}" -c "systemctl --user restart kano-common.target"'.format(username))
+    uid = pwd.getpwnam(username).pw_uid
+    systemd = SystemdManager(
+        address=USER_SYSTEMD_BUS_ADDRESS.format(uid=uid),
+        systemctl=['runuser', '-u', username, '--', 'env',
+                   'XDG_RUNTIME_DIR=/run/user/{}'.format(uid),
+                   'systemctl', '--user']
+    )
+    systemd.start_unit('kano-dashboard.service')
+    systemd.restart_unit('kano-common.target')
+    systemd.flush(wait_timeout)
+
+    for unit, latency in sorted(systemd.latencies.iteritems()):
+        if latency is not None:
+            logger.info("{} active after {:.3f}s".format(unit, latency))
+
+    return systemd.latencies
 
 
 def set_dashboard_onboarding(username, run_it=True):
@@ -148,26 +240,125 @@ def set_dashboard_onboarding(username, run_it=True):
         os.chown(onboarding_file, uid, gid)
 
 
-def reconfigure_autostart_policy():
+def get_desired_autostart_state(kanousers):
     '''
-    Set the system boot flow depending on which users are available on the system.
+    Returns how the kit should start up for the given kano users.
     With no kano users, set things ready to start the Onboarding on boot.
     With one kano users, set the system to go directly to the Dashboard.
     With more than once kano user, set the system to go to the login Greeter.
+
+    :rtype: AutostartState
     '''
-    kanousers = get_group_members('kanousers')
     if len(kanousers) == 0:
-        enable_console_autologin('root')
-        unset_ldm_autologin()
-        disable_ldm_autostart()
+        return AutostartState('root', None, MULTI_USER_TARGET)
     elif len(kanousers) == 1:
-        enable_console_autologin(kanousers[0])
-        set_ldm_autologin(kanousers[0])
-        enable_ldm_autostart()
+        return AutostartState(kanousers[0], kanousers[0], GRAPHICAL_TARGET)
     else:
-        disable_console_autologin()
-        unset_ldm_autologin()
-        enable_ldm_autostart()
+        return AutostartState(None, None, GRAPHICAL_TARGET)
+
+
+def _get_tty1_user():
+    try:
+        unit = os.readlink(SYSTEMD_TTY1_LINK)
+    except OSError:
+        return UNKNOWN_STATE
+
+    if unit == KANOINIT_UNIT:
+        return 'root'
+    elif unit == SYSTEMD_GETTY_UNIT:
+        return None
+    elif unit != KANOAUTOLOGIN_UNIT:
+        return UNKNOWN_STATE
+
+    try:
+        with open(AUTOLOGIN_ENV_LINK, 'r') as env_file:
+            match = re.search(r'^{}=(\S+)$'.format(AUTOLOGIN_ENV_VAR),
+                              env_file.read(), re.MULTILINE)
+    except IOError:
+        return UNKNOWN_STATE
+
+    return match.group(1) if match else UNKNOWN_STATE
+
+
+def _get_ldm_autologin_user():
+    try:
+        conf = LightDMConf.load(LIGHTDM_CONF_FILE)
+    except LightDMConfError:
+        return UNKNOWN_STATE
+
+    user = conf.get('autologin-user')
+    timeout = conf.get('autologin-user-timeout')
+    if user is None and timeout is None:
+        return None
+    elif user is not None and timeout == '0':
+        return user
+
+    return UNKNOWN_STATE
+
+
+def _get_default_target():
+    target = get_default_target()
+    return UNKNOWN_STATE if target is None else target
+
+
+def get_current_autostart_state():
+    '''
+    Reads how the kit is set up to start up, without changing anything.
+
+    :rtype: AutostartState
+    '''
+    return AutostartState(_get_tty1_user(), _get_ldm_autologin_user(),
+                          _get_default_target())
+
+
+def reconfigure_autostart_policy():
+    '''
+    Set the system boot flow depending on which users are available on the system.
+    See get_desired_autostart_state().
+
+    Only the parts of the current setup which differ from the desired one
+    are changed, so nothing is written or run when it is up to date.
+
+    :return: The actions which were applied.
+    :rtype: list
+    '''
+    desired = get_desired_autostart_state(get_group_members('kanousers'))
+    current = get_current_autostart_state()
+
+    applied = []
+    skipped = []
+
+    if current.tty1_user != desired.tty1_user:
+        if desired.tty1_user is None:
+            disable_console_autologin()
+        else:
+            enable_console_autologin(desired.tty1_user)
+        applied.append('console-autologin')
+    else:
+        skipped.append('console-autologin')
+
+    if current.autologin_user != desired.autologin_user:
+        if desired.autologin_user is None:
+            unset_ldm_autologin()
+        else:
+            set_ldm_autologin(desired.autologin_user)
+        applied.append('ldm-autologin')
+    else:
+        skipped.append('ldm-autologin')
+
+    if current.default_target != desired.default_target:
+        if desired.default_target == GRAPHICAL_TARGET:
+            enable_ldm_autostart()
+        else:
+            disable_ldm_autostart()
+        applied.append('default-target')
+    else:
+        skipped.append('default-target')
+
+    logger.info("Autostart policy: applied [{}], skipped [{}]".format(
+        ', '.join(applied), ', '.join(skipped)))
+
+    return applied
 
 
 def ensure_lightdm_conf():
@@ -185,20 +376,27 @@ def ensure_lightdm_conf():
     reconfigure_autostart_policy()
 
 
-def restore_factory_settings():
-    # FIXME: These imports are local because importing kano_settings.config_file
-    # has side effects that break peldins build
-    from kano_settings.default import set_default_config
-
+def remove_wifi_cache():
     # remove the wifi cache, effectively avoiding a wireless connection on boot
     try:
         os.remove('/etc/kwifiprompt-cache.conf')
     except Exception:
         pass
 
+
+def restore_default_settings():
+    # FIXME: These imports are local because importing kano_settings.config_file
+    # has side effects that break peldins build
+    from kano_settings.default import set_default_config
+
     set_default_config()
 
 
+def restore_factory_settings():
+    remove_wifi_cache()
+    restore_default_settings()
+
+
 def is_any_task_scheduled():
     '''
     Returns True if there is an uncompleted kano-init task
@@ -207,24 +405,44 @@ def is_any_task_scheduled():
     return status.stage != Status.DISABLED_STAGE
 
 
-def load_init_conf():
+def load_users_manifest(manifest_path=None):
     """
-    Load the init configuration from the boot partition.
+    Load the list of users to be created in bulk.
 
-    :return: The config in a dictionary.
-    :rtype: dict
+    The manifest is a JSON file with either a list of users, or an object
+    with a `users` list like the init configuration. The `users` list from
+    the init configuration is used when no path is given.
+
+    Each user is either a username or an object with a `user` and an
+    optional precomputed `password_hash` for the shadow file, e.g.
+
+        ["kano", {"user": "teacher", "password_hash": "$6$..."}]
+
+    :param manifest_path: Path to the manifest file.
+    :type manifest_path: str
+
+    :return: The usernames and the password hashes given for them.
+    :rtype: tuple
     """
-    flow_params = {}
-    if os.path.exists(INIT_CONF_PATH):
-        with open(INIT_CONF_PATH, 'r') as init_conf:
-            init_conf_data = json.load(init_conf)
+    if not manifest_path:
+        manifest = load_init_conf().users
+    else:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if isinstance(manifest, dict):
+            manifest = manifest.get('users', [])
 
-            # The old convention with an underscore
-            if 'kano_init' in init_conf_data:
-                flow_params = init_conf_data['kano_init']
+    usernames = []
+    password_hashes = {}
+    for entry in manifest:
+        if isinstance(entry, dict):
+            username = entry.get('user')
+            if 'password_hash' in entry:
+                password_hashes[username] = entry['password_hash']
+        else:
+            username = entry
 
-            # A hyphen with a bigger priority
-            if 'kano-init' in init_conf_data:
-                flow_params = init_conf_data['kano-init']
+        usernames.append(username)
 
-    return flow_params
+    return usernames, password_hashes
@@ -11,3 +11,6 @@
 
 
 from tests.fixtures.lightdm import *
+from tests.fixtures.accounts import *
+from tests.fixtures.dbus import *
+from tests.fixtures.status import *
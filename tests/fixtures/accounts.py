@@ -0,0 +1,82 @@
+#
+# accounts.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Definition of fixtures for the local account databases
+#
+
+
+import os
+
+import pytest
+
+
+PASSWD_CONTENTS = '''root:x:0:0:root:/root:/bin/bash
+daemon:x:1:1:daemon:/usr/sbin:/usr/sbin/nologin
+nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin
+kano:x:1001:1001:,,,:/home/kano:/bin/bash
+kano1:x:1002:1002:,,,:/home/kano1:/bin/bash
+'''
+
+GROUP_CONTENTS = '''root:x:0:
+daemon:x:1:
+sudo:x:27:kano,kano1
+nogroup:x:65534:
+kanousers:x:1000:kano,kano1
+kano:x:1001:
+kano1:x:1002:
+'''
+
+SHADOW_CONTENTS = '''root:*:17000:0:99999:7:::
+daemon:*:17000:0:99999:7:::
+nobody:*:17000:0:99999:7:::
+kano:$6$salt$hash:17000:0:99999:7:::
+kano1:$6$salt$hash:17000:0:99999:7:::
+'''
+
+
+@pytest.fixture(scope='function')
+def account_db(fs):
+    '''
+    Provides a pyfakefs system with a small passwd and group database and a
+    clean account index.
+    '''
+
+    import kano_init.user
+
+    kano_init.user.AccountIndex._instances.clear()
+
+    passwd = fs.CreateFile('/etc/passwd', contents=PASSWD_CONTENTS)
+    group = fs.CreateFile('/etc/group', contents=GROUP_CONTENTS)
+
+    yield {
+        'passwd': passwd,
+        'group': group,
+    }
+
+    kano_init.user.AccountIndex._instances.clear()
+
+
+@pytest.fixture(scope='function')
+def account_root(tmpdir):
+    '''
+    Provides a scratch root directory with a small set of account databases.
+    '''
+
+    etc = tmpdir.mkdir('etc')
+    etc.join('passwd').write(PASSWD_CONTENTS)
+    etc.join('group').write(GROUP_CONTENTS)
+    etc.join('shadow').write(SHADOW_CONTENTS)
+
+    return str(tmpdir)
+
+
+def read_db(root, name):
+    '''
+    Helper function to read one of the databases under the scratch root.
+    '''
+
+    with open(os.path.join(root, 'etc', name), 'r') as db_file:
+        return db_file.read()
@@ -0,0 +1,113 @@
+#
+# dbus.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Definition of fixtures for a stand-in D-Bus peer
+#
+
+
+import socket
+import threading
+
+import pytest
+
+
+class StandInBus(object):
+    '''
+    A local D-Bus peer which records every method call it receives and
+    replies with the values set in `replies`, or the errors set in `errors`,
+    for the method's name.
+    '''
+
+    def __init__(self, path):
+        self.address = 'unix:path={}'.format(path)
+        self.calls = []
+        self.replies = {}
+        self.errors = {}
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(1)
+
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+
+            try:
+                self._handle(conn)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def _handle(self, conn):
+        from kano_init.dbus_client import HEADER_SIZE, METHOD_RETURN, ERROR, \
+            FIELD_MEMBER, FIELD_REPLY_SERIAL, FIELD_ERROR_NAME, \
+            get_message_length, decode_message, encode_message
+
+        data = ['']
+
+        def fill():
+            chunk = conn.recv(4096)
+            if not chunk:
+                raise socket.error('Connection closed')
+            data[0] += chunk
+
+        def recv(size):
+            while len(data[0]) < size:
+                fill()
+            chunk, data[0] = data[0][:size], data[0][size:]
+            return chunk
+
+        def recv_line():
+            while '\r\n' not in data[0]:
+                fill()
+            line, data[0] = data[0].split('\r\n', 1)
+            return line
+
+        assert recv_line().startswith('\0AUTH EXTERNAL ')
+        conn.sendall('OK 0123456789abcdef0123456789abcdef\r\n')
+        assert recv_line() == 'BEGIN'
+
+        while True:
+            header = recv(HEADER_SIZE)
+            message = decode_message(
+                header + recv(get_message_length(header) - HEADER_SIZE))
+            member = message.fields[FIELD_MEMBER]
+            self.calls.append((member, message.body))
+
+            if member in self.errors:
+                reply = encode_message(
+                    ERROR, message.serial,
+                    {FIELD_REPLY_SERIAL: message.serial,
+                     FIELD_ERROR_NAME: self.errors[member]},
+                    's', ('Stand-in error',))
+            else:
+                signature, args = self.replies.get(member, ('', ()))
+                reply = encode_message(
+                    METHOD_RETURN, message.serial,
+                    {FIELD_REPLY_SERIAL: message.serial}, signature, args)
+            conn.sendall(reply)
+
+
+@pytest.fixture(scope='function')
+def stand_in_bus(tmpdir):
+    '''
+    Provides a StandInBus listening on a socket in a temporary directory.
+    '''
+
+    bus = StandInBus(str(tmpdir.join('bus')))
+    yield bus
+    bus.close()
@@ -0,0 +1,28 @@
+#
+# status.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Definition of fixtures for the kano-init status
+#
+
+
+import pytest
+
+
+@pytest.fixture(scope='function')
+def status_file(tmpdir, monkeypatch):
+    '''
+    Points the `kano_init.status.Status` singleton at a status file in a
+    temporary directory and provides its path.
+    '''
+
+    from kano_init.status import Status
+
+    path = str(tmpdir.join('status.json'))
+    monkeypatch.setattr(Status, '_status_file', path)
+    monkeypatch.setattr(Status, '_stage_file', str(tmpdir.join('stage')))
+    monkeypatch.setattr(Status, '_singleton_instance', None)
+
+    return path
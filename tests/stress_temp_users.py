@@ -0,0 +1,93 @@
+#
+# stress_temp_users.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Creates temporary users from many processes at once in a scratch root and
+# checks that no name or uid is handed out twice. Needs to run as root.
+#
+# Usage: python tests/stress_temp_users.py [<workers>] [<users per worker>]
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+from kano_init.user import AccountIndex, DEFAULT_USER_GROUPS
+from kano_init.temp_users import create_temporary_user
+
+
+PASSWD = 'root:x:0:0:root:/root:/bin/bash\n'
+GROUP = 'root:x:0:\n' + ''.join(
+    '{}:x:{}:\n'.format(name, 100 + gid)
+    for gid, name in enumerate(DEFAULT_USER_GROUPS.split(','))
+)
+SHADOW = 'root:*:17000:0:99999:7:::\n'
+
+
+def make_root():
+    root = tempfile.mkdtemp(prefix='kano-init-stress')
+    for path in ('etc', 'etc/skel', 'home', 'var/mail'):
+        os.makedirs(os.path.join(root, path))
+
+    for name, contents in (('passwd', PASSWD), ('group', GROUP),
+                           ('shadow', SHADOW), ('gshadow', '')):
+        with open(os.path.join(root, 'etc', name), 'w') as db_file:
+            db_file.write(contents)
+
+    with open(os.path.join(root, 'etc/skel/.bashrc'), 'w') as bashrc:
+        bashrc.write('# stress test\n')
+
+    return root
+
+
+def worker(args):
+    root, count = args
+    created = []
+    for dummy in xrange(count):
+        start = time.time()
+        username = create_temporary_user(root=root)
+        created.append((username, time.time() - start))
+
+    return created
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_worker = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    root = make_root()
+    try:
+        start = time.time()
+        pool = Pool(workers)
+        results = pool.map(worker, [(root, per_worker)] * workers)
+        pool.close()
+        pool.join()
+        elapsed = time.time() - start
+
+        created = [entry for result in results for entry in result]
+        names = [name for name, dummy in created]
+        latencies = sorted(latency for dummy, latency in created)
+
+        AccountIndex._instances.clear()
+        index = AccountIndex.get_instance(root)
+        uids = [index.users[name].uid for name in names]
+
+        print 'created {} users in {:.2f}s'.format(len(names), elapsed)
+        print 'latency p50 {:.3f}s, max {:.3f}s'.format(
+            latencies[len(latencies) // 2], latencies[-1])
+
+        assert len(names) == workers * per_worker
+        assert len(set(names)) == len(names), 'duplicate usernames'
+        assert len(set(uids)) == len(uids), 'duplicate uids'
+        print 'OK'
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#
+# test_account_db.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the transactional account database editor
+#
+
+
+import os
+
+import pytest
+
+from tests.fixtures.accounts import PASSWD_CONTENTS, GROUP_CONTENTS, \
+    SHADOW_CONTENTS, read_db
+
+
+def test_add_user(account_root):
+    '''
+    Checks that `kano_init.account_db.AccountDB` creates a user, its private
+    group and its memberships in a single commit.
+    '''
+
+    from kano_init.account_db import AccountDB
+
+    with AccountDB(account_root) as account_db:
+        assert account_db.add_group('kanousers') == 1000
+        gid = account_db.add_user(
+            'kano2', 1003, '/home/kano2', password_hash='$6$x$y',
+            groups=['sudo', 'kanousers', 'missing']
+        )
+
+    assert gid == 1003
+    assert 'kano2:x:1003:1003::/home/kano2:/bin/bash\n' in \
+        read_db(account_root, 'passwd')
+    assert read_db(account_root, 'shadow').splitlines()[-1].startswith(
+        'kano2:$6$x$y:'
+    )
+
+    group = read_db(account_root, 'group')
+    assert 'sudo:x:27:kano,kano1,kano2\n' in group
+    assert 'kanousers:x:1000:kano,kano1,kano2\n' in group
+    assert 'kano2:x:1003:\n' in group
+
+    # The locks are gone and the previous version is kept as a backup
+    assert not os.path.exists(os.path.join(account_root, 'etc/passwd.lock'))
+    assert read_db(account_root, 'passwd-') == PASSWD_CONTENTS
+
+
+def test_remove_user(account_root):
+    '''
+    Checks that `kano_init.account_db.AccountDB` removes a user from every
+    database.
+    '''
+
+    from kano_init.account_db import AccountDB
+
+    with AccountDB(account_root) as account_db:
+        account_db.remove_user('kano1')
+
+    assert 'kano1' not in read_db(account_root, 'passwd')
+    assert 'kano1' not in read_db(account_root, 'shadow')
+    assert 'kano1' not in read_db(account_root, 'group')
+
+
+def test_rollback_on_error(account_root):
+    '''
+    Checks that nothing is written when the transaction fails.
+    '''
+
+    from kano_init.account_db import AccountDB, AccountDBError
+
+    with pytest.raises(AccountDBError):
+        with AccountDB(account_root) as account_db:
+            account_db.add_user('kano3', 1004, '/home/kano3')
+            account_db.add_user('kano', 1005, '/home/kano')
+
+    assert read_db(account_root, 'passwd') == PASSWD_CONTENTS
+    assert read_db(account_root, 'group') == GROUP_CONTENTS
+
+
+def test_rollback_on_failed_commit(account_root, monkeypatch):
+    '''
+    Checks that the files already replaced are restored when a later one
+    can't be, so the databases never disagree with each other.
+    '''
+
+    import kano_init.account_db
+    from kano_init.account_db import AccountDB, AccountDBError
+
+    rename = os.rename
+    replaced = []
+
+    def failing_rename(src, dst):
+        # group and shadow go first, passwd is the third file replaced
+        if dst.endswith('/etc/passwd'):
+            raise OSError(28, 'No space left on device')
+        rename(src, dst)
+        replaced.append(os.path.basename(dst))
+
+    monkeypatch.setattr(kano_init.account_db.os, 'rename', failing_rename)
+
+    with pytest.raises(AccountDBError):
+        with AccountDB(account_root) as account_db:
+            account_db.add_user('kano3', 1004, '/home/kano3')
+
+    monkeypatch.undo()
+
+    assert replaced[:2] == ['group', 'shadow']
+    assert read_db(account_root, 'passwd') == PASSWD_CONTENTS
+    assert read_db(account_root, 'group') == GROUP_CONTENTS
+    assert read_db(account_root, 'shadow') == SHADOW_CONTENTS
+    assert not [name for name in os.listdir(os.path.join(account_root, 'etc'))
+                if name.endswith('+')]
+
+
+def test_set_expiry(account_root):
+    '''
+    Checks that `kano_init.account_db.AccountDB` sets and clears the expiry
+    date of an account.
+    '''
+
+    from kano_init.account_db import AccountDB
+
+    with AccountDB(account_root) as account_db:
+        account_db.set_expiry('kano1', 17001)
+
+    assert 'kano1:$6$salt$hash:17000:0:99999:7::17001:\n' in \
+        read_db(account_root, 'shadow')
+
+    with AccountDB(account_root) as account_db:
+        account_db.set_expiry('kano1', None)
+
+    assert read_db(account_root, 'shadow') == SHADOW_CONTENTS
+
+
+def test_rename_user(account_root):
+    '''
+    Checks that `kano_init.account_db.AccountDB` renames a user along with
+    its private group and its memberships.
+    '''
+
+    from kano_init.account_db import AccountDB
+
+    with AccountDB(account_root) as account_db:
+        account_db.rename_user('kano1', 'alice', '/home/alice')
+
+    assert 'alice:x:1002:1002:,,,:/home/alice:/bin/bash\n' in \
+        read_db(account_root, 'passwd')
+    assert 'alice:$6$salt$hash:' in read_db(account_root, 'shadow')
+
+    group = read_db(account_root, 'group')
+    assert 'sudo:x:27:kano,alice\n' in group
+    assert 'kanousers:x:1000:kano,alice\n' in group
+    assert 'alice:x:1002:\n' in group
+    assert 'kano1' not in group
@@ -0,0 +1,73 @@
+#
+# test_command.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the shell-free command runner
+#
+
+
+import json
+
+
+def test_run_without_shell():
+    '''
+    Checks that `kano_init.command.run` passes the arguments verbatim,
+    without a shell interpreting them, and feeds the input to the command.
+    '''
+
+    from kano_init.command import run
+
+    result = run(['echo', '$HOME', '|', 'cat'])
+    assert result.returncode == 0
+    assert result.stdout == '$HOME | cat\n'
+
+    result = run(['cat'], input_data='user:hash\n')
+    assert result.stdout == 'user:hash\n'
+
+
+def test_run_timeout():
+    '''
+    Checks that `kano_init.command.run` kills commands which time out.
+    '''
+
+    from kano_init.command import run
+
+    result = run(['sleep', '10'], timeout=0.2)
+    assert result.timed_out
+    assert result.returncode != 0
+    assert result.duration < 5
+
+
+def test_run_missing_command():
+    '''
+    Checks that `kano_init.command.run` reports commands which don't exist
+    instead of raising.
+    '''
+
+    from kano_init.command import run, RC_NOT_STARTED
+
+    result = run(['/nonexistent/command'])
+    assert result.returncode == RC_NOT_STARTED
+    assert not result.timed_out
+
+
+def test_write_report(tmpdir):
+    '''
+    Checks that `kano_init.command.write_report` saves every command run.
+    '''
+
+    from kano_init.command import run, write_report
+
+    run(['true'])
+    run(['false'])
+    write_report('test', report_dir=str(tmpdir))
+
+    with open(str(tmpdir.join('test.json')), 'r') as report_file:
+        report = json.load(report_file)
+
+    commands = report['commands'][-2:]
+    assert [c['argv'] for c in commands] == [['true'], ['false']]
+    assert [c['returncode'] for c in commands] == [0, 1]
+    assert all(c['duration'] >= 0 for c in commands)
@@ -0,0 +1,103 @@
+#
+# test_dbus_client.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the minimal D-Bus client
+#
+
+
+import pytest
+
+
+def test_message_round_trip():
+    '''
+    Checks that a message with nested types decodes to what was encoded.
+    '''
+
+    from kano_init.dbus_client import encode_message, decode_message, \
+        get_message_length, split_signature, METHOD_CALL, FIELD_PATH, \
+        FIELD_MEMBER, FIELD_SIGNATURE
+
+    signature = 'sa{sv}a(so)bt'
+    args = (
+        u'kano-dashboard.service',
+        {'ActiveState': ('s', 'active'), 'NRestarts': ('u', 3)},
+        [('a.service', '/job/1'), ('b.target', '/job/2')],
+        True,
+        2 ** 40
+    )
+    assert split_signature(signature) == ['s', 'a{sv}', 'a(so)', 'b', 't']
+
+    data = encode_message(METHOD_CALL, 7,
+                          {FIELD_PATH: '/org/test', FIELD_MEMBER: 'Test'},
+                          signature, args)
+    assert get_message_length(data[:16]) == len(data)
+
+    message = decode_message(data)
+    assert message.type == METHOD_CALL
+    assert message.serial == 7
+    assert message.fields[FIELD_PATH] == '/org/test'
+    assert message.fields[FIELD_SIGNATURE] == signature
+    assert message.body == (
+        'kano-dashboard.service',
+        {'ActiveState': 'active', 'NRestarts': 3},
+        [('a.service', '/job/1'), ('b.target', '/job/2')],
+        True,
+        2 ** 40
+    )
+
+
+def test_call(stand_in_bus):
+    '''
+    Checks calls and pipelined replies against a stand-in peer.
+    '''
+
+    from kano_init.dbus_client import DBusConnection
+
+    stand_in_bus.replies['StartUnit'] = ('o', ('/org/freedesktop/job/1',))
+
+    with DBusConnection(stand_in_bus.address) as bus:
+        assert bus.call('/org/test', 'org.test', 'Reload') == ()
+
+        first = bus.send('/org/test', 'org.test', 'StartUnit', 'ss',
+                         ('a.service', 'replace'))
+        second = bus.send('/org/test', 'org.test', 'StartUnit', 'ss',
+                          ('b.target', 'replace'))
+        assert bus.wait_reply(second) == ('/org/freedesktop/job/1',)
+        assert bus.wait_reply(first) == ('/org/freedesktop/job/1',)
+
+    assert stand_in_bus.calls == [
+        ('Reload', ()),
+        ('StartUnit', ('a.service', 'replace')),
+        ('StartUnit', ('b.target', 'replace'))
+    ]
+
+
+def test_call_error(stand_in_bus):
+    '''
+    Checks that error replies are raised.
+    '''
+
+    from kano_init.dbus_client import DBusConnection, DBusError
+
+    stand_in_bus.errors['StartUnit'] = 'org.freedesktop.systemd1.NoSuchUnit'
+
+    with DBusConnection(stand_in_bus.address) as bus:
+        with pytest.raises(DBusError) as exc:
+            bus.call('/org/test', 'org.test', 'StartUnit', 'ss',
+                     ('missing.service', 'replace'))
+
+    assert 'NoSuchUnit' in str(exc.value)
+
+
+def test_connect_error(tmpdir):
+    '''
+    Checks that failing to connect raises a DBusError.
+    '''
+
+    from kano_init.dbus_client import DBusConnection, DBusError
+
+    with pytest.raises(DBusError):
+        DBusConnection('unix:path={}'.format(tmpdir.join('missing')))
@@ -0,0 +1,97 @@
+#
+# test_init_conf.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the cached init configuration loader
+#
+
+
+import os
+import json
+
+
+def test_load_init_conf(tmpdir):
+    '''
+    Checks that the options are validated, with the hyphenated key taking
+    priority, and exposed through the typed properties.
+    '''
+
+    from kano_init.init_conf import load_init_conf
+
+    conf_path = tmpdir.join('init.conf')
+    conf_path.write(json.dumps({
+        'kano_init': {'skip': False},
+        'kano-init': {
+            'skip': True,
+            'user': 'kano',
+            'users': 'teacher',
+            'temp_user_pool': 'lots',
+            'future_option': [1, 2]
+        }
+    }))
+
+    init_conf = load_init_conf(str(conf_path), str(tmpdir.join('cache.json')))
+
+    assert init_conf.skip is True
+    assert init_conf.user == 'kano'
+    assert init_conf.users == ['teacher']
+    assert init_conf.temp_user_pool is None
+    assert 'temp_user_pool' not in init_conf
+    assert init_conf.get('future_option') == [1, 2]
+
+
+def test_load_init_conf_missing(tmpdir):
+    '''
+    Checks the defaults when there is no init configuration, or it is broken.
+    '''
+
+    from kano_init.init_conf import load_init_conf
+
+    cache_path = str(tmpdir.join('cache.json'))
+
+    init_conf = load_init_conf(str(tmpdir.join('missing')), cache_path)
+    assert init_conf.skip is False
+    assert init_conf.user is None
+    assert init_conf.users == []
+
+    conf_path = tmpdir.join('init.conf')
+    conf_path.write('{"kano-init": ')
+    assert load_init_conf(str(conf_path), cache_path).skip is False
+    assert not os.path.exists(cache_path)
+
+
+def test_load_init_conf_cache(tmpdir, monkeypatch):
+    '''
+    Checks that the cached copy is used while the size and mtime of the file
+    are the same, without opening the file, and dropped once they change.
+    '''
+
+    import __builtin__
+    from kano_init.init_conf import load_init_conf
+
+    conf_path = tmpdir.join('init.conf')
+    conf_path.write(json.dumps({'kano-init': {'user': 'kano'}}))
+    conf_path.setmtime(1500000000)
+    cache_path = str(tmpdir.join('cache', 'init-conf.json'))
+
+    assert load_init_conf(str(conf_path), cache_path).user == 'kano'
+    assert os.path.exists(cache_path)
+
+    real_open = open
+    opened = []
+
+    def tracking_open(path, *args, **kwargs):
+        opened.append(path)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(__builtin__, 'open', tracking_open)
+
+    assert load_init_conf(str(conf_path), cache_path).user == 'kano'
+    assert opened == [cache_path]
+
+    conf_path.write(json.dumps({'kano-init': {'user': 'kanoo'}}))
+    conf_path.setmtime(1500000001)
+    assert load_init_conf(str(conf_path), cache_path).user == 'kanoo'
+    assert str(conf_path) in opened
@@ -0,0 +1,109 @@
+#
+# test_lightdm.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the LightDM configuration editor
+#
+
+
+import os
+
+import pytest
+
+from tests.fixtures.lightdm import LIGHTDM_CONFS, NO_USER_LIGHTDM_CONF, \
+    SINGLE_USER_LIGHTDM_CONF, load_conf_file
+
+
+@pytest.mark.parametrize('conf', LIGHTDM_CONFS)
+def test_round_trip(conf):
+    '''
+    Checks that `kano_init.lightdm.LightDMConf` keeps a file untouched,
+    comments included, when nothing is changed.
+    '''
+
+    from kano_init.lightdm import LightDMConf
+
+    lightdm_conf = LightDMConf(contents=conf['conf'])
+
+    assert lightdm_conf.dumps() == conf['conf']
+    assert not lightdm_conf.changed
+
+
+def test_set_autologin():
+    '''
+    Checks that activating the autologin keys gives the single user
+    configuration.
+    '''
+
+    from kano_init.lightdm import LightDMConf
+
+    lightdm_conf = LightDMConf(contents=load_conf_file(NO_USER_LIGHTDM_CONF))
+    assert 'autologin-user' not in lightdm_conf
+
+    lightdm_conf['autologin-user'] = 'kano'
+    lightdm_conf['autologin-user-timeout'] = 0
+
+    assert lightdm_conf['autologin-user'] == 'kano'
+    assert lightdm_conf.dumps() == load_conf_file(SINGLE_USER_LIGHTDM_CONF)
+
+
+def test_unset_autologin():
+    '''
+    Checks that commenting out the autologin keys gives the configuration
+    without any users.
+    '''
+
+    from kano_init.lightdm import LightDMConf
+
+    lightdm_conf = LightDMConf(
+        contents=load_conf_file(SINGLE_USER_LIGHTDM_CONF))
+
+    lightdm_conf.comment_out('autologin-user', placeholder='none')
+    del lightdm_conf['autologin-user-timeout']
+
+    assert lightdm_conf.get('autologin-user') is None
+    assert lightdm_conf.dumps() == load_conf_file(NO_USER_LIGHTDM_CONF)
+
+
+def test_add_missing_key():
+    '''
+    Checks that a key the file doesn't mention is added to its section.
+    '''
+
+    from kano_init.lightdm import LightDMConf
+
+    lightdm_conf = LightDMConf(contents='[LightDM]\na=1\n\n[SeatDefaults]\n'
+                                        'b=2\n\n[VNCServer]\nc=3\n')
+    lightdm_conf['autologin-user'] = 'kano'
+
+    assert lightdm_conf.dumps() == '[LightDM]\na=1\n\n[SeatDefaults]\nb=2\n' \
+        'autologin-user=kano\n\n[VNCServer]\nc=3\n'
+
+
+def test_save_only_changes(tmpdir):
+    '''
+    Checks that `kano_init.lightdm.edit_lightdm_conf` writes the file once,
+    and not at all when nothing changes.
+    '''
+
+    from kano_init.lightdm import edit_lightdm_conf
+
+    conf_path = str(tmpdir.join('lightdm.conf'))
+    with open(conf_path, 'w') as conf_file:
+        conf_file.write(load_conf_file(SINGLE_USER_LIGHTDM_CONF))
+    inode = os.stat(conf_path).st_ino
+
+    with edit_lightdm_conf(conf_path) as lightdm_conf:
+        lightdm_conf['autologin-user'] = 'kano'
+        lightdm_conf['autologin-user-timeout'] = '0'
+
+    assert os.stat(conf_path).st_ino == inode
+
+    with edit_lightdm_conf(conf_path) as lightdm_conf:
+        lightdm_conf.comment_out('autologin-user', placeholder='none')
+        del lightdm_conf['autologin-user-timeout']
+
+    assert os.stat(conf_path).st_ino != inode
+    assert load_conf_file(conf_path) == load_conf_file(NO_USER_LIGHTDM_CONF)
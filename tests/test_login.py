@@ -112,3 +112,131 @@ def test_ensure_lightdm_conf_with_conf(
     # Checks
     with open(kano_init.utils.LIGHTDM_CONF_FILE, 'r') as conf_f:
         assert conf_f.read() == lightdm_conf_file.contents
+
+
+
+def test_reconfigure_autostart_policy_up_to_date(
+        fs, lightdm_conf, mock_console_autologin,
+        mock_ldm_autostart, mock_get_group_members
+    ):
+    '''
+    Checks that `kano_init.utils.reconfigure_autostart_policy()` doesn't
+    change anything when the kit is already set up for its users.
+    '''
+
+    import kano_init.utils
+    import kano_init.systemd_manager
+
+    users = lightdm_conf['users']
+    desired = kano_init.utils.get_desired_autostart_state(users)
+
+    fs.CreateFile(kano_init.utils.LIGHTDM_CONF_FILE,
+                  contents=lightdm_conf['conf'])
+    fs.CreateFile(kano_init.utils.KANOINIT_UNIT)
+    fs.CreateFile(kano_init.utils.SYSTEMD_GETTY_UNIT)
+    fs.CreateFile(kano_init.utils.KANOAUTOLOGIN_UNIT)
+
+    if desired.tty1_user is None:
+        tty1_unit = kano_init.utils.SYSTEMD_GETTY_UNIT
+    elif desired.tty1_user == 'root':
+        tty1_unit = kano_init.utils.KANOINIT_UNIT
+    else:
+        tty1_unit = kano_init.utils.KANOAUTOLOGIN_UNIT
+
+    fs.CreateDirectory(os.path.dirname(kano_init.utils.SYSTEMD_TTY1_LINK))
+    os.symlink(tty1_unit, kano_init.utils.SYSTEMD_TTY1_LINK)
+
+    if tty1_unit == kano_init.utils.KANOAUTOLOGIN_UNIT:
+        env_path = os.path.join(kano_init.utils.AUTOLOGIN_ENV_DIR,
+                                '{}.conf'.format(desired.tty1_user))
+        fs.CreateFile(env_path, contents='KANO_AUTOLOGIN_USER={}\n'.format(
+            desired.tty1_user))
+        os.symlink(env_path, kano_init.utils.AUTOLOGIN_ENV_LINK)
+    os.symlink(
+        os.path.join('/lib/systemd/system', desired.default_target),
+        kano_init.systemd_manager.DEFAULT_TARGET_LINK
+    )
+
+    mock_get_group_members(users)
+
+    assert kano_init.utils.get_current_autostart_state() == desired
+    assert kano_init.utils.reconfigure_autostart_policy() == []
+
+    with open(kano_init.utils.LIGHTDM_CONF_FILE, 'r') as conf_f:
+        assert conf_f.read() == lightdm_conf['conf']
+
+
+
+def test_console_autologin_switch(fs, monkeypatch):
+    '''
+    Checks that switching the tty1 autologin user only swaps links, without
+    touching the packaged units, and that repeating it does nothing.
+    '''
+
+    import kano_init.utils
+
+    restarts = []
+    monkeypatch.setattr(kano_init.utils, 'restart_tty1',
+                        lambda reload_units=True: restarts.append(reload_units))
+
+    for unit in (kano_init.utils.KANOAUTOLOGIN_UNIT,
+                 kano_init.utils.KANOINIT_UNIT,
+                 kano_init.utils.SYSTEMD_GETTY_UNIT):
+        fs.CreateFile(unit, contents='[Service]\n')
+    fs.CreateDirectory(os.path.dirname(kano_init.utils.SYSTEMD_TTY1_LINK))
+    os.symlink(kano_init.utils.KANOINIT_UNIT,
+               kano_init.utils.SYSTEMD_TTY1_LINK)
+
+    assert kano_init.utils.enable_console_autologin('kano', restart=True)
+    assert restarts == [True]
+    assert kano_init.utils._get_tty1_user() == 'kano'
+
+    assert not kano_init.utils.enable_console_autologin('kano', restart=True)
+    assert restarts == [True]
+
+    assert kano_init.utils.enable_console_autologin('other', restart=True)
+    assert restarts == [True, False]
+    assert kano_init.utils._get_tty1_user() == 'other'
+
+    assert kano_init.utils.disable_console_autologin()
+    assert not kano_init.utils.disable_console_autologin()
+    assert kano_init.utils._get_tty1_user() is None
+
+    with open(kano_init.utils.KANOAUTOLOGIN_UNIT, 'r') as unit_file:
+        assert unit_file.read() == '[Service]\n'
+
+
+def test_start_dashboard_services_once(stand_in_bus, monkeypatch):
+    '''
+    Checks that a Dashboard service refused by the user manager doesn't make
+    `kano_init.utils.start_dashboard_services` start them all again with
+    systemctl.
+    '''
+
+    import collections
+
+    import kano_init.utils
+    import kano_init.systemd_manager
+
+    commands = []
+    monkeypatch.setattr(kano_init.systemd_manager, 'run',
+                        lambda argv, **kwargs: commands.append(argv))
+    monkeypatch.setattr(kano_init.utils, 'USER_SYSTEMD_BUS_ADDRESS',
+                        stand_in_bus.address)
+    monkeypatch.setattr(
+        kano_init.utils.pwd, 'getpwnam',
+        lambda name: collections.namedtuple('pwd', 'pw_uid')(1001))
+
+    stand_in_bus.errors['StartUnit'] = 'org.freedesktop.systemd1.NoSuchUnit'
+    stand_in_bus.replies['GetUnit'] = ('o', ('/org/freedesktop/systemd1/unit',))
+    stand_in_bus.replies['Get'] = ('v', (('s', 'active'),))
+
+    latencies = kano_init.utils.start_dashboard_services('kano',
+                                                         wait_timeout=5)
+
+    assert commands == []
+    assert [member for member, _ in stand_in_bus.calls] == [
+        'StartUnit', 'RestartUnit', 'GetUnit', 'Get'
+    ]
+    assert latencies['kano-dashboard.service'] is None
+    assert latencies['kano-common.target'] is not None
@@ -0,0 +1,90 @@
+#
+# test_skeleton.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for populating home directories from the skeleton
+#
+
+
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='function', params=(True, False))
+def skel_root(request, tmpdir, monkeypatch):
+    '''
+    Provides a scratch root directory with a small skeleton, populated either
+    from the cached archive or by cloning the tree.
+    '''
+
+    import kano_init.skeleton
+
+    monkeypatch.setattr(kano_init.skeleton, 'USE_SKEL_ARCHIVE', request.param)
+
+    skel = tmpdir.mkdir('etc').mkdir('skel')
+    skel.join('.bashrc').write('# bashrc\n')
+    skel.mkdir('.config').mkdir('app').join('settings').write('a=1\n')
+    skel.join('.profile').mksymlinkto('.bashrc')
+
+    return str(tmpdir)
+
+
+def test_populate_home(skel_root):
+    '''
+    Checks that `kano_init.skeleton.populate_home()` reproduces the skeleton
+    with the requested mode and ownership.
+    '''
+
+    import kano_init.skeleton
+
+    home = os.path.join(skel_root, 'home', 'kano')
+    os.mkdir(os.path.dirname(home))
+
+    for dummy in range(2):
+        kano_init.skeleton.populate_home(
+            home, os.getuid(), os.getgid(), 0o700, root=skel_root
+        )
+
+        assert os.stat(home).st_mode & 0o777 == 0o700
+        assert os.readlink(os.path.join(home, '.profile')) == '.bashrc'
+        with open(os.path.join(home, '.config/app/settings'), 'r') as f:
+            assert f.read() == 'a=1\n'
+
+        # The second run uses the archive cached by the first one
+        os.rename(home, '{}-{}'.format(home, dummy))
+
+
+def test_archive_follows_edited_files(skel_root):
+    '''
+    Checks that the cached skeleton archive is rebuilt when a file of the
+    skeleton is edited in place, which doesn't change any directory mtime.
+    '''
+
+    import kano_init.skeleton
+
+    if not kano_init.skeleton.USE_SKEL_ARCHIVE:
+        pytest.skip("Only applies to the cached archive")
+
+    settings = os.path.join(skel_root, 'etc/skel/.config/app/settings')
+    app_dir = os.path.dirname(settings)
+    home = os.path.join(skel_root, 'home', 'kano')
+    os.mkdir(os.path.dirname(home))
+
+    kano_init.skeleton.populate_home(
+        home, os.getuid(), os.getgid(), 0o700, root=skel_root
+    )
+
+    app_dir_mtime = os.stat(app_dir).st_mtime
+    with open(settings, 'w') as f:
+        f.write('a=22\n')
+    os.utime(app_dir, (app_dir_mtime, app_dir_mtime))
+
+    kano_init.skeleton.populate_home(
+        home + '2', os.getuid(), os.getgid(), 0o700, root=skel_root
+    )
+
+    with open(os.path.join(home + '2', '.config/app/settings'), 'r') as f:
+        assert f.read() == 'a=22\n'
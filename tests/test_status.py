@@ -0,0 +1,123 @@
+#
+# test_status.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the kano-init status store
+#
+
+
+import os
+import json
+import time
+
+import pytest
+
+
+def test_save_atomic(status_file):
+    '''
+    Checks that the status file is replaced as a whole and that no
+    temporary files are left behind.
+    '''
+
+    from kano_init.status import Status
+
+    status = Status.get_instance()
+    inode = os.stat(status_file).st_ino
+
+    status.stage = Status.RESET_STAGE
+    status.save()
+
+    assert os.stat(status_file).st_ino != inode
+    assert sorted(os.listdir(os.path.dirname(status_file))) == [
+        'stage', 'status.json'
+    ]
+    with open(status_file, 'r') as status_f:
+        assert json.load(status_f) == {'stage': 'reset', 'username': None}
+
+
+def test_transaction(status_file, monkeypatch):
+    '''
+    Checks that the changes in a transaction are written once, when the
+    outermost transaction ends, and dropped if it fails.
+    '''
+
+    from kano_init.status import Status
+
+    status = Status.get_instance()
+
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync',
+                        lambda fd: fsyncs.append(fd) or real_fsync(fd))
+
+    with status.transaction():
+        status.stage = Status.DELETE_USER_STAGE
+        status.save()
+        with status.transaction():
+            status.username = 'kano'
+            status.save()
+
+        with open(status_file, 'r') as status_f:
+            assert json.load(status_f)['stage'] == Status.DISABLED_STAGE
+
+    # One for each file and one for their directory
+    assert len(fsyncs) == 3
+    with open(status_file, 'r') as status_f:
+        assert json.load(status_f) == {'stage': 'delete-user',
+                                       'username': 'kano'}
+
+    with pytest.raises(RuntimeError):
+        with status.transaction():
+            status.stage = Status.RESET_STAGE
+            raise RuntimeError()
+
+    assert status.stage == Status.DELETE_USER_STAGE
+    assert len(fsyncs) == 3
+
+
+def test_watch_stage(status_file):
+    '''
+    Checks that the watch yields the current stage and then each new stage
+    saved by another process, and stops once nothing changes.
+    '''
+
+    import threading
+    from kano_init.status import Status, watch_stage
+
+    status = Status.get_instance()
+    watch = watch_stage(timeout=1, status_file=status_file)
+    assert next(watch) == Status.DISABLED_STAGE
+
+    def save_stages():
+        for stage in (Status.RESET_STAGE, Status.RESET_STAGE,
+                      Status.ADD_USER_STAGE):
+            time.sleep(0.1)
+            status.stage = stage
+            status.save()
+
+    threading.Thread(target=save_stages).start()
+
+    assert list(watch) == [Status.RESET_STAGE, Status.ADD_USER_STAGE]
+
+
+def test_stage_mirror(status_file):
+    '''
+    Checks that the plain text stage mirror follows the status file and can
+    be read by the shell's `read` builtin.
+    '''
+
+    import subprocess
+    from kano_init.status import Status
+
+    status = Status.get_instance()
+    stage_file = os.path.join(os.path.dirname(status_file), 'stage')
+
+    for stage in (Status.DELETE_USER_STAGE, Status.DISABLED_STAGE):
+        status.stage = stage
+        status.save()
+
+        shell_stage = subprocess.check_output(
+            ['sh', '-c', 'read stage < "$0"; printf %s "$stage"', stage_file])
+        assert shell_stage == stage
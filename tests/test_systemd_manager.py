@@ -0,0 +1,175 @@
+#
+# test_systemd_manager.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for managing systemd without systemctl
+#
+
+
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='function')
+def systemd_root(tmpdir):
+    '''
+    Provides a root with the targets and an empty /etc/systemd/system.
+    '''
+
+    from kano_init.systemd_manager import SYSTEMD_UNIT_DIR
+
+    unit_dir = tmpdir.join(SYSTEMD_UNIT_DIR)
+    unit_dir.ensure(dir=True)
+    unit_dir.join('graphical.target').write('')
+    unit_dir.join('multi-user.target').write('')
+    tmpdir.join('etc/systemd/system').ensure(dir=True)
+
+    return str(tmpdir)
+
+
+def test_set_default_target(systemd_root):
+    '''
+    Checks that the default.target link is swapped only when it changes.
+    '''
+
+    from kano_init.systemd_manager import set_default_target, \
+        get_default_target, DEFAULT_TARGET_LINK, SystemdError
+
+    link = os.path.join(systemd_root, DEFAULT_TARGET_LINK.lstrip('/'))
+
+    assert get_default_target(systemd_root) is None
+    assert set_default_target('graphical.target', systemd_root)
+    assert os.readlink(link) == '/lib/systemd/system/graphical.target'
+    assert get_default_target(systemd_root) == 'graphical.target'
+
+    assert not set_default_target('graphical.target', systemd_root)
+    assert set_default_target('multi-user.target', systemd_root)
+    assert get_default_target(systemd_root) == 'multi-user.target'
+    assert os.listdir(os.path.dirname(link)) == ['default.target']
+
+    with pytest.raises(SystemdError):
+        set_default_target('missing.target', systemd_root)
+    assert get_default_target(systemd_root) == 'multi-user.target'
+
+
+def test_manager_batches_requests(stand_in_bus):
+    '''
+    Checks that the queued requests go over one connection, with a single
+    reload before the unit jobs.
+    '''
+
+    from kano_init.systemd_manager import SystemdManager
+
+    with SystemdManager(stand_in_bus.address) as systemd:
+        systemd.reload()
+        systemd.restart_unit('getty@tty1.service')
+        systemd.reload()
+        systemd.start_unit('lightdm.service')
+
+    assert stand_in_bus.calls == [
+        ('Reload', ()),
+        ('RestartUnit', ('getty@tty1.service', 'replace')),
+        ('StartUnit', ('lightdm.service', 'replace'))
+    ]
+    assert systemd.flush() == 0
+
+
+def test_manager_falls_back_to_systemctl(tmpdir, monkeypatch):
+    '''
+    Checks that systemctl is used when the manager can't be reached.
+    '''
+
+    import kano_init.systemd_manager
+    from kano_init.systemd_manager import SystemdManager
+
+    commands = []
+    monkeypatch.setattr(kano_init.systemd_manager, 'run',
+                        lambda argv, **kwargs: commands.append(argv))
+
+    systemd = SystemdManager('unix:path={}'.format(tmpdir.join('missing')))
+    systemd.reload()
+    systemd.restart_unit('getty@tty1.service')
+    assert systemd.flush() == 2
+
+    assert commands == [
+        ['systemctl', 'daemon-reload'],
+        ['systemctl', '--no-block', '--job-mode=replace', 'restart',
+         'getty@tty1.service']
+    ]
+
+
+def test_manager_waits_for_units(stand_in_bus):
+    '''
+    Checks that the started units are tracked until they are active.
+    '''
+
+    from kano_init.systemd_manager import SystemdManager
+
+    stand_in_bus.replies['GetUnit'] = ('o', ('/org/freedesktop/systemd1/unit',))
+    stand_in_bus.replies['Get'] = ('v', (('s', 'active'),))
+
+    systemd = SystemdManager(stand_in_bus.address)
+    systemd.start_unit('kano-dashboard.service')
+    systemd.restart_unit('kano-common.target')
+    systemd.flush(wait_timeout=5)
+
+    assert sorted(systemd.latencies) == ['kano-common.target',
+                                         'kano-dashboard.service']
+    assert all(latency is not None and latency < 5
+               for latency in systemd.latencies.itervalues())
+    assert [member for member, _ in stand_in_bus.calls] == [
+        'StartUnit', 'RestartUnit', 'GetUnit', 'GetUnit', 'Get', 'Get'
+    ]
+
+
+def test_manager_wait_timeout(stand_in_bus):
+    '''
+    Checks that units which don't become active in time have no latency.
+    '''
+
+    from kano_init.systemd_manager import SystemdManager
+
+    stand_in_bus.replies['GetUnit'] = ('o', ('/org/freedesktop/systemd1/unit',))
+    stand_in_bus.replies['Get'] = ('v', (('s', 'activating'),))
+
+    systemd = SystemdManager(stand_in_bus.address)
+    systemd.start_unit('kano-dashboard.service')
+    systemd.flush(wait_timeout=0.2)
+
+    assert systemd.latencies == {'kano-dashboard.service': None}
+
+
+def test_manager_reports_refused_jobs(stand_in_bus, monkeypatch):
+    '''
+    Checks that a job refused by systemd is reported once, without running
+    the jobs sent already again through systemctl.
+    '''
+
+    import kano_init.systemd_manager
+    from kano_init.systemd_manager import SystemdManager
+
+    commands = []
+    monkeypatch.setattr(kano_init.systemd_manager, 'run',
+                        lambda argv, **kwargs: commands.append(argv))
+
+    stand_in_bus.errors['StartUnit'] = 'org.freedesktop.systemd1.NoSuchUnit'
+    stand_in_bus.replies['GetUnit'] = ('o', ('/org/freedesktop/systemd1/unit',))
+    stand_in_bus.replies['Get'] = ('v', (('s', 'active'),))
+
+    systemd = SystemdManager(stand_in_bus.address)
+    systemd.restart_unit('getty@tty1.service')
+    systemd.start_unit('missing.service')
+    assert systemd.flush(wait_timeout=5) == 2
+
+    assert commands == []
+    assert [member for member, _ in stand_in_bus.calls] == [
+        'RestartUnit', 'StartUnit', 'GetUnit', 'Get'
+    ]
+    assert list(systemd.errors) == ['missing.service']
+    assert 'NoSuchUnit' in systemd.errors['missing.service']
+    assert systemd.latencies['missing.service'] is None
+    assert systemd.latencies['getty@tty1.service'] is not None
+    assert systemd.flush() == 0
@@ -0,0 +1,112 @@
+#
+# test_task_graph.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the concurrent, resumable task graph
+#
+
+
+import os
+import json
+import threading
+
+import pytest
+
+
+def test_task_graph_order(tmpdir):
+    '''
+    Checks that independent tasks run concurrently and that every task only
+    starts after its dependencies.
+    '''
+
+    from kano_init.task_graph import TaskGraph
+
+    events = []
+    lock = threading.Lock()
+    both_running = threading.Event()
+    running = set()
+
+    def task(name):
+        def run():
+            with lock:
+                events.append(('start', name))
+                running.add(name)
+                if running >= set(['a', 'b']):
+                    both_running.set()
+            if name in ('a', 'b'):
+                both_running.wait(5)
+            with lock:
+                running.discard(name)
+                events.append(('end', name))
+        return run
+
+    journal_path = str(tmpdir.join('journal.json'))
+    graph = TaskGraph(journal_path)
+    graph.add('a', task('a'))
+    graph.add('b', task('b'))
+    graph.add('c', task('c'), deps=['a', 'b'])
+    durations = graph.run()
+
+    assert both_running.is_set()
+    assert sorted(durations) == ['a', 'b', 'c']
+    assert events.index(('start', 'c')) > events.index(('end', 'a'))
+    assert events.index(('start', 'c')) > events.index(('end', 'b'))
+    assert not os.path.exists(journal_path)
+
+
+def test_task_graph_resume(tmpdir):
+    '''
+    Checks that a failed task stops its dependants, keeps the finished tasks
+    in the journal and that the next run only runs the rest.
+    '''
+
+    from kano_init.task_graph import TaskGraph, TaskError
+
+    calls = []
+    broken = [True]
+
+    def task(name):
+        def run():
+            calls.append(name)
+            if name == 'flaky' and broken[0]:
+                raise IOError('Power cut')
+        return run
+
+    journal_path = str(tmpdir.join('journal.json'))
+
+    def get_graph():
+        graph = TaskGraph(journal_path)
+        graph.add('settings', task('settings'))
+        graph.add('flaky', task('flaky'))
+        graph.add('after-flaky', task('after-flaky'), deps=['flaky'])
+        return graph
+
+    with pytest.raises(TaskError):
+        get_graph().run()
+
+    assert sorted(calls) == ['flaky', 'settings']
+    with open(journal_path, 'r') as journal_file:
+        assert json.load(journal_file)['finished'].keys() == ['settings']
+
+    broken[0] = False
+    del calls[:]
+    graph = get_graph()
+    graph.run()
+
+    assert calls == ['flaky', 'after-flaky']
+    assert sorted(graph.durations) == ['after-flaky', 'flaky', 'settings']
+    assert not os.path.exists(journal_path)
+
+
+def test_task_graph_unknown_dependency():
+    '''
+    Checks that dependencies have to be added before their dependants.
+    '''
+
+    from kano_init.task_graph import TaskGraph, TaskError
+
+    graph = TaskGraph()
+    with pytest.raises(TaskError):
+        graph.add('autostart', lambda: None, deps=['delete-users'])
@@ -0,0 +1,258 @@
+#
+# test_temp_users.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the temporary users
+#
+
+
+import os
+import time
+
+from tests.fixtures.accounts import read_db
+
+
+def test_reap_temp_users(account_root):
+    '''
+    Checks that `kano_init.temp_users.reap_temp_users` only deletes the
+    temporary users whose TTL ran out.
+    '''
+
+    from kano_init.account_db import AccountDB
+    from kano_init.temp_users import reap_temp_users, set_expiry
+
+    with AccountDB(account_root) as account_db:
+        for uid, name in enumerate(['kano0a0a0a0a', 'kano1b1b1b1b'], 1100):
+            account_db.add_user(name, uid, '/home/' + name)
+    set_expiry('kano0a0a0a0a', time.time() - 60, root=account_root)
+    set_expiry('kano1b1b1b1b', time.time() + 60, root=account_root)
+    set_expiry('kano1', time.time() - 60, root=account_root)
+
+    for name in ['kano0a0a0a0a', 'kano1b1b1b1b']:
+        os.makedirs(os.path.join(account_root, 'home', name))
+
+    assert reap_temp_users(dry_run=True, root=account_root) == \
+        ['kano0a0a0a0a']
+    assert 'kano0a0a0a0a' in read_db(account_root, 'passwd')
+
+    assert reap_temp_users(root=account_root) == ['kano0a0a0a0a']
+
+    passwd = read_db(account_root, 'passwd')
+    assert 'kano0a0a0a0a' not in passwd
+    assert 'kano1b1b1b1b' in passwd
+    assert 'kano1:' in passwd
+    assert not os.path.exists(
+        os.path.join(account_root, 'home', 'kano0a0a0a0a'))
+
+
+def test_rename_temp_user(account_root):
+    '''
+    Checks that `kano_init.user.rename_user` turns a temporary user into a
+    regular one, moving its home in place and clearing its expiry.
+    '''
+
+    from kano_init.account_db import AccountDB
+    from kano_init.user import rename_user
+
+    with AccountDB(account_root) as account_db:
+        account_db.add_user('kano0a0a0a0a', 1100, '/home/kano0a0a0a0a')
+        account_db.set_expiry('kano0a0a0a0a', 17000)
+
+    home = os.path.join(account_root, 'home', 'kano0a0a0a0a')
+    os.makedirs(home)
+    with open(os.path.join(home, '.bashrc'), 'w') as bashrc:
+        bashrc.write('# bashrc\n')
+    inode = os.stat(home).st_ino
+
+    rename_user('kano0a0a0a0a', 'alice', root=account_root)
+
+    new_home = os.path.join(account_root, 'home', 'alice')
+    assert not os.path.exists(home)
+    assert os.stat(new_home).st_ino == inode
+    assert os.path.isfile(os.path.join(new_home, '.bashrc'))
+    assert 'alice:x:1100:1100::/home/alice:/bin/bash\n' in \
+        read_db(account_root, 'passwd')
+    assert 'kano0a0a0a0a' not in read_db(account_root, 'group')
+
+    shadow = read_db(account_root, 'shadow')
+    assert 'kano0a0a0a0a' not in shadow
+    assert [line for line in shadow.splitlines()
+            if line.startswith('alice:')][0].split(':')[7] == ''
+
+
+def test_renamed_temp_user_never_expires(account_root):
+    '''
+    Checks that a temporary user renamed into a regular one neither gets an
+    account expiry in /etc/shadow nor is reaped once its TTL ran out.
+    '''
+
+    from kano_init.account_db import AccountDB
+    from kano_init.user import rename_user
+    from kano_init.temp_users import reap_temp_users, set_expiry
+
+    with AccountDB(account_root) as account_db:
+        account_db.add_user('kano0a0a0a0a', 1100, '/home/kano0a0a0a0a')
+    set_expiry('kano0a0a0a0a', time.time() - 60, root=account_root)
+
+    rename_user('kano0a0a0a0a', 'alice', root=account_root)
+
+    shadow = read_db(account_root, 'shadow')
+    assert [line for line in shadow.splitlines()
+            if line.startswith('alice:')][0].split(':')[7] == ''
+
+    # A new temporary user which happens to get the same name
+    with AccountDB(account_root) as account_db:
+        account_db.add_user('kano0a0a0a0a', 1101, '/home/kano0a0a0a0a')
+
+    assert reap_temp_users(root=account_root) == []
+    passwd = read_db(account_root, 'passwd')
+    assert 'alice:' in passwd
+    assert 'kano0a0a0a0a:' in passwd
+
+
+def test_rename_copied_home_rollback(account_root, monkeypatch):
+    '''
+    Checks that when the accounts can't be written after the home was
+    copied to another filesystem, `kano_init.user.rename_user` removes the
+    copy and keeps the original home.
+    '''
+
+    import errno
+
+    import pytest
+
+    import kano_init.user
+    from kano_init.account_db import AccountDB, AccountDBError
+    from kano_init.user import rename_user, UserError
+
+    with AccountDB(account_root) as account_db:
+        account_db.add_user('kano0a0a0a0a', 1100, '/home/kano0a0a0a0a')
+
+    home = os.path.join(account_root, 'home', 'kano0a0a0a0a')
+    os.makedirs(home)
+    with open(os.path.join(home, '.bashrc'), 'w') as bashrc:
+        bashrc.write('# bashrc\n')
+
+    def rename_across_devices(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    def fail_commit(account_db):
+        raise AccountDBError("Unable to write passwd")
+
+    monkeypatch.setattr(kano_init.user.os, 'rename', rename_across_devices)
+    monkeypatch.setattr(AccountDB, 'commit', fail_commit)
+
+    with pytest.raises(UserError):
+        rename_user('kano0a0a0a0a', 'alice', root=account_root)
+
+    monkeypatch.undo()
+
+    assert os.path.isfile(os.path.join(home, '.bashrc'))
+    assert not os.path.exists(os.path.join(account_root, 'home', 'alice'))
+    assert 'kano0a0a0a0a:' in read_db(account_root, 'passwd')
+
+
+def test_temp_user_lives_a_whole_day(account_root, monkeypatch):
+    '''
+    Checks that a temporary user created just before midnight isn't reaped
+    until TEMP_USER_TTL whole days later.
+    '''
+
+    import kano_init.temp_users
+    from kano_init.account_db import AccountDB
+    from kano_init.temp_users import find_expired_temp_users, set_expiry, \
+        _get_deadline, TEMP_USER_TTL, SECONDS_PER_DAY
+
+    with AccountDB(account_root) as account_db:
+        account_db.add_user('kano0a0a0a0a', 1100, '/home/kano0a0a0a0a')
+
+    midnight = 17000 * SECONDS_PER_DAY
+    now = [midnight - 60]
+    monkeypatch.setattr(kano_init.temp_users.time, 'time', lambda: now[0])
+
+    set_expiry('kano0a0a0a0a', _get_deadline(), root=account_root)
+
+    now[0] = midnight + 60
+    assert find_expired_temp_users(account_root) == ([], [])
+
+    now[0] = midnight - 60 + TEMP_USER_TTL * SECONDS_PER_DAY
+    assert find_expired_temp_users(account_root) == (['kano0a0a0a0a'], [])
+
+
+def test_reserved_uids_are_skipped(account_root):
+    '''
+    Checks that the uid reserved for a temporary user being created isn't
+    handed out to other accounts, e.g. by a pool refill.
+    '''
+
+    from kano_init.user import get_next_uid
+    from kano_init.temp_users import reserve_temp_user, release_temp_user
+
+    first_uid = get_next_uid(root=account_root)
+
+    username, uid = reserve_temp_user(root=account_root)
+    assert uid == first_uid
+    assert get_next_uid(root=account_root) != uid
+
+    release_temp_user(username, root=account_root)
+
+
+def _add_pooled_user(root, name, uid):
+    import json
+
+    from kano_init.account_db import AccountDB
+    from kano_init.paths import TEMP_USER_POOL_PATH
+
+    with AccountDB(root) as account_db:
+        account_db.add_user(name, uid, '/home/' + name)
+
+    pool_path = os.path.join(root, TEMP_USER_POOL_PATH.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(pool_path)):
+        os.makedirs(os.path.dirname(pool_path))
+    with open(pool_path, 'w') as pool_file:
+        json.dump({'size': 1, 'users': [name]}, pool_file)
+
+
+def test_failed_claim_deletes_pooled_user(account_root, monkeypatch):
+    '''
+    Checks that a pooled user which can't be claimed is deleted rather than
+    left outside of the pool with no expiry.
+    '''
+
+    import kano_init.temp_users
+    from kano_init.user import UserError
+    from kano_init.temp_users import claim_pooled_user, get_pool_size
+
+    _add_pooled_user(account_root, 'kano0a0a0a0a', 1100)
+
+    def fail_label(username, root='/'):
+        raise UserError("Unable to add {} to kanousers".format(username))
+
+    monkeypatch.setattr(kano_init.temp_users, '_label_claimed_user',
+                        fail_label)
+
+    assert claim_pooled_user(root=account_root) is None
+    assert 'kano0a0a0a0a' not in read_db(account_root, 'passwd')
+    assert get_pool_size(account_root) == 1
+
+
+def test_reset_deletes_pooled_users(account_root):
+    '''
+    Checks that `kano_init.user.delete_all_users` deletes the pooled users,
+    which aren't kanousers members yet, along with the kano users.
+    '''
+
+    from kano_init.user import delete_all_users
+    from kano_init.temp_users import drain_pool
+
+    _add_pooled_user(account_root, 'kano0a0a0a0a', 1100)
+
+    delete_all_users(root=account_root)
+
+    passwd = read_db(account_root, 'passwd')
+    for name in ['kano0a0a0a0a', 'kano:', 'kano1:']:
+        assert name not in passwd
+    assert 'root:' in passwd
+    assert drain_pool(account_root) == []
@@ -0,0 +1,182 @@
+#
+# test_user.py
+#
+# Copyright (C) 2018 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+# Tests for the account functions in `kano_init.user`
+#
+
+
+import os
+
+import pytest
+
+
+def test_account_predicates(account_db):
+    '''
+    Checks that the predicates of `kano_init.user` are answered from the
+    local passwd and group databases.
+    '''
+
+    import kano_init.user
+
+    assert kano_init.user.user_exists('kano')
+    assert not kano_init.user.user_exists('kano2')
+    assert kano_init.user.group_exists('kanousers')
+    assert not kano_init.user.group_exists('kano2')
+    assert kano_init.user.get_group_members('kanousers') == ['kano', 'kano1']
+    assert kano_init.user.get_group_members('kano') == []
+    assert kano_init.user.get_group_members('missing') == []
+
+
+def test_account_index_invalidation(account_db):
+    '''
+    Checks that the `kano_init.user.AccountIndex` is rebuilt once the
+    passwd database is replaced.
+    '''
+
+    import kano_init.user
+
+    index = kano_init.user.AccountIndex.get_instance()
+    assert 'kano2' not in index.users
+
+    new_passwd = '/etc/passwd+'
+    with open(new_passwd, 'w') as passwd_file:
+        passwd_file.write(account_db['passwd'].contents)
+        passwd_file.write('kano2:x:1003:1003:,,,:/home/kano2:/bin/bash\n')
+    os.rename(new_passwd, '/etc/passwd')
+
+    assert kano_init.user.user_exists('kano2')
+    assert 1003 in kano_init.user.AccountIndex.get_instance().uids
+
+
+def test_get_next_uid(account_db):
+    '''
+    Checks that `kano_init.user.get_next_uid()` skips the uids in use.
+    '''
+
+    import kano_init.user
+
+    assert kano_init.user.get_next_uid() == 1003
+
+
+def test_uid_allocator():
+    '''
+    Checks the free interval bookkeeping of
+    `kano_init.uid_allocator.UidAllocator`.
+    '''
+
+    from kano_init.uid_allocator import UidAllocator, UidAllocationError
+
+    allocator = UidAllocator(
+        [0, 1001, 1003, 1004, 65534], last_uid=1020,
+        reserved_ranges=[(1008, 1015)]
+    )
+
+    assert allocator.next_uid() == 1002
+    assert allocator.reserve_block(4) == [1002, 1005, 1006, 1007]
+    assert allocator.allocate() == 1016
+    assert not allocator.is_free(1010)
+
+    allocator.release(1005)
+    assert allocator.allocate() == 1005
+
+    assert allocator.reserve_block(4) == [1017, 1018, 1019, 1020]
+    try:
+        allocator.allocate()
+        assert False, 'The allocator should be exhausted'
+    except UidAllocationError:
+        pass
+
+
+def test_make_username_unique(account_db):
+    '''
+    Checks the unique username generation in `kano_init.user`.
+    '''
+
+    import kano_init.user
+
+    assert kano_init.user.make_username_unique('kano') == 'kano2'
+    assert kano_init.user.make_username_unique('someone') == 'someone'
+    assert kano_init.user.get_username_suggestions('kano', 3) == \
+        ['kano2', 'kano3', 'kano4']
+    assert kano_init.user.get_username_suggestions('kan', 2) == \
+        ['kan', 'kan1']
+
+
+def test_failed_batch_keeps_old_homes(account_root):
+    '''
+    Checks that `kano_init.user.create_users()` leaves the home directories
+    of earlier users in place when the batch can't be committed.
+    '''
+
+    from kano_init.user import create_users, UserError, USE_NATIVE_ACCOUNT_DB
+    from tests.fixtures.accounts import read_db
+
+    if not USE_NATIVE_ACCOUNT_DB:
+        pytest.skip("Only applies to the native account databases")
+
+    home = os.path.join(account_root, 'home', 'alice')
+    os.makedirs(home)
+    with open(os.path.join(home, 'notes'), 'w') as notes:
+        notes.write('keep me\n')
+
+    # There is a 'sudo' group already, so the whole batch fails
+    with pytest.raises(UserError):
+        create_users(['alice', 'sudo'], root=account_root)
+
+    assert os.path.isfile(os.path.join(home, 'notes'))
+    assert not os.path.exists(home + '-old')
+    assert 'alice' not in read_db(account_root, 'passwd')
+
+
+def test_get_process_uids(tmpdir):
+    '''
+    Checks that `kano_init.user.get_process_uids()` reads the real and
+    effective uids of the processes rather than the owner of their /proc
+    entries, which is root for non-dumpable ones.
+    '''
+
+    from kano_init.user import get_process_uids
+
+    proc = tmpdir.mkdir('proc')
+    for pid, uid_line in (('1', '0\t0\t0\t0'), ('42', '1100\t1100\t0\t0'),
+                          ('43', '1101\t0\t0\t0'), ('44', '0\t1102\t0\t0')):
+        proc.mkdir(pid).join('status').write(
+            'Name:\tproc\nUid:\t{}\nGid:\t0\t0\t0\t0\n'.format(uid_line))
+    proc.mkdir('self')
+    proc.mkdir('45')
+
+    assert get_process_uids(str(proc)) == set([0, 1100, 1101, 1102])
+
+
+def test_rolled_back_users_restore_old_homes(account_root, monkeypatch):
+    '''
+    Checks that when the home of a new user can't be populated, the home
+    left behind by an earlier user with the same name is put back.
+    '''
+
+    import kano_init.user
+    from kano_init.user import create_users, USE_NATIVE_ACCOUNT_DB
+    from tests.fixtures.accounts import read_db
+
+    if not USE_NATIVE_ACCOUNT_DB:
+        pytest.skip("Only applies to the native account databases")
+
+    home = os.path.join(account_root, 'home', 'alice')
+    os.makedirs(home)
+    with open(os.path.join(home, 'notes'), 'w') as notes:
+        notes.write('keep me\n')
+
+    def failing_populate(home_path, uid, gid, root='/', tmpfs=False):
+        raise IOError(28, 'No space left on device')
+
+    monkeypatch.setattr(kano_init.user, 'populate_home', failing_populate)
+
+    results = create_users(['alice'], root=account_root)
+
+    assert results['alice']
+    assert os.path.isfile(os.path.join(home, 'notes'))
+    assert not os.path.exists(home + '-old')
+    assert 'alice' not in read_db(account_root, 'passwd')